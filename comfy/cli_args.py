@@ -37,6 +37,8 @@ parser.add_argument("--listen", type=str, default="127.0.0.1", metavar="IP", nar
 parser.add_argument("--port", type=int, default=8188, help="Set the listen port.")
 parser.add_argument("--enable-cors-header", type=str, default=None, metavar="ORIGIN", nargs="?", const="*", help="Enable CORS (Cross-Origin Resource Sharing) with optional origin or allow all with default '*'.")
 parser.add_argument("--max-upload-size", type=float, default=100, help="Set the maximum upload size in MB.")
+parser.add_argument("--view-cache-size", type=float, default=64, metavar="MB", help="Size in MB of the in memory cache of the previews and channel splits encoded by /view.")
+parser.add_argument("--view-cache-directory", type=str, default=None, metavar="PATH", help="Also keep the images encoded by /view in this directory.")
 
 parser.add_argument("--extra-model-paths-config", type=str, default=None, metavar="PATH", nargs='+', action='append', help="Load one or more extra_model_paths.yaml files.")
 parser.add_argument("--output-directory", type=str, default=None, help="Set the ComfyUI output directory.")
@@ -101,6 +103,39 @@ vram_group.add_argument("--novram", action="store_true", help="When lowvram isn'
 vram_group.add_argument("--cpu", action="store_true", help="To use the CPU for everything (slow).")
 
 
+parser.add_argument("--cache-lru", type=int, default=0, metavar="N", help="Keep up to N node outputs in a LRU cache shared between prompts. Outputs are keyed by the node inputs instead of the node id so they can be reused after graph edits. (0 disables it)")
+
+parser.add_argument("--cache-spill-directory", type=str, default=None, help="Store the LATENT, CONDITIONING, IMAGE and MASK outputs evicted from the --cache-lru cache in this directory so they can be reused later, even after a restart.")
+parser.add_argument("--cache-spill-size", type=float, default=10.0, metavar="GB", help="Maximum size of the --cache-spill-directory in GB, the least recently used outputs are deleted first.")
+
+parser.add_argument("--parallel-nodes", type=int, default=1, metavar="N", help="Run up to N nodes from independent branches of the graph at the same time on worker threads. Only nodes marked as THREAD_SAFE (image loading/saving, mask operations) are run in parallel, nodes using the GPU or loading models always run one at a time.")
+
+parser.add_argument("--output-writer-threads", type=int, default=2, metavar="N", help="Number of background threads used to encode and write output images so the next prompt can start right away. 0 writes them on the prompt worker thread.")
+
+parser.add_argument("--coalesce-prompts", type=int, default=1, metavar="N", help="Merge up to N queued prompts that only differ in their seeds or prompt texts into a single batched sampler run.")
+parser.add_argument("--dedupe-prompts", action="store_true", help="Execute a queued prompt identical to one that is pending or running only once, every submitter gets the results with its own prompt_id.")
+
+parser.add_argument("--sampler-checkpoint-directory", type=str, default=None, help="Save the progress of KSampler runs using the euler, heun, heunpp2, dpm_2 or ddim samplers in this directory so an interrupted run, or a run continuing the same schedule further, resumes where the previous one stopped.")
+parser.add_argument("--sampler-checkpoint-interval", type=int, default=10, metavar="STEPS", help="Save a sampler checkpoint every STEPS steps (it is also saved when the run is interrupted).")
+
+parser.add_argument("--queue-database", type=str, default=None, metavar="PATH", help="Keep the queue and the history in this SQLite database: queued prompts are executed after a restart and the history isn't kept in memory.")
+
+def client_weight(value):
+    client_id, sep, weight = value.rpartition("=")
+    try:
+        weight = float(weight)
+    except ValueError:
+        weight = 0
+    if sep == "" or len(client_id) == 0 or not weight > 0:
+        raise argparse.ArgumentTypeError("expected CLIENT_ID=WEIGHT with a positive weight, got: {}".format(value))
+    return (client_id, weight)
+
+parser.add_argument("--client-weights", type=client_weight, nargs="+", default=[], metavar="CLIENT_ID=WEIGHT", help="Weights of clients in the fair scheduling of the queue, the others have a weight of 1: a client with a weight of 2 gets two prompts executed for every prompt of a client with a weight of 1 when both have prompts queued.")
+parser.add_argument("--queue-budget", type=float, default=None, metavar="SECONDS", help="Reject new prompts with a 429 status when the estimated time to execute the queue would go over this many seconds.")
+parser.add_argument("--model-affinity", type=int, default=0, metavar="MAX_SKIPS", help="Run queued prompts that use the models already loaded by the worker before the others to avoid reloading models. A prompt is skipped at most MAX_SKIPS times. 0 disables it.")
+parser.add_argument("--workers", type=int, default=1, metavar="N", help="Number of prompts executed at the same time. Every worker has its own executor and loaded models so several workers need --worker-devices with one accelerator each unless they run on the cpu.")
+parser.add_argument("--worker-devices", type=str, default=None, metavar="DEVICES", help="Comma separated list of torch devices to start one worker on each of them, for example: cuda:0,cuda:1 or cpu,cpu,cpu. Overrides --workers.")
+
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
 
@@ -4,6 +4,7 @@ from comfy.cli_args import args
 import comfy.utils
 import torch
 import sys
+import contextvars
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -70,9 +71,15 @@ def is_intel_xpu():
             return True
     return False
 
+# set in the threads of the prompt workers when several of them run at the same time
+worker_device = contextvars.ContextVar("worker_device", default=None)
+
 def get_torch_device():
     global directml_enabled
     global cpu_state
+    device = worker_device.get()
+    if device is not None:
+        return device
     if directml_enabled:
         global directml_device
         return directml_device
@@ -265,6 +272,19 @@ except:
 print("VAE dtype:", VAE_DTYPE)
 
 current_loaded_models = []
+worker_loaded_models = contextvars.ContextVar("worker_loaded_models", default=current_loaded_models)
+
+def loaded_models():
+    # every prompt worker keeps track of its own loaded models, the first one uses current_loaded_models
+    return worker_loaded_models.get()
+
+def set_worker_device(device, own_loaded_models=True):
+    """Pins the current thread to device, used by the prompt workers when there are several of them."""
+    worker_device.set(device)
+    if own_loaded_models:
+        worker_loaded_models.set([])
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
 
 class LoadedModel:
     def __init__(self, model):
@@ -322,6 +342,7 @@ def minimum_inference_memory():
     return (1024 * 1024 * 1024)
 
 def unload_model_clones(model):
+    current_loaded_models = loaded_models()
     to_unload = []
     for i in range(len(current_loaded_models)):
         if model.is_clone(current_loaded_models[i].model):
@@ -332,6 +353,7 @@ def unload_model_clones(model):
         current_loaded_models.pop(i).model_unload()
 
 def free_memory(memory_required, device, keep_loaded=[]):
+    current_loaded_models = loaded_models()
     unloaded_model = False
     for i in range(len(current_loaded_models) -1, -1, -1):
         if not DISABLE_SMART_MEMORY:
@@ -355,6 +377,7 @@ def free_memory(memory_required, device, keep_loaded=[]):
 
 def load_models_gpu(models, memory_required=0):
     global vram_state
+    current_loaded_models = loaded_models()
 
     inference_memory = minimum_inference_memory()
     extra_mem = max(inference_memory, memory_required)
@@ -420,6 +443,7 @@ def load_model_gpu(model):
     return load_models_gpu([model])
 
 def cleanup_models():
+    current_loaded_models = loaded_models()
     to_delete = []
     for i in range(len(current_loaded_models)):
         if sys.getrefcount(current_loaded_models[i].model) <= 2:
@@ -758,22 +782,49 @@ class InterruptProcessingException(Exception):
 interrupt_processing_mutex = threading.RLock()
 
 interrupt_processing = False
-def interrupt_current_processing(value=True):
+# the prompt workers after the first one have their own InterruptFlag, the first one uses interrupt_processing
+worker_interrupt = contextvars.ContextVar("worker_interrupt", default=None)
+
+class InterruptFlag:
+    def __init__(self):
+        self.value = False
+
+def set_worker_interrupt(flag):
+    """Gives the current thread its own interrupt flag, used by the prompt workers when there are several of them."""
+    worker_interrupt.set(flag)
+
+def interrupt_worker(flag, value=True):
+    """Sets the interrupt flag of a worker, None is the one of the first worker."""
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        interrupt_processing = value
+        if flag is None:
+            interrupt_processing = value
+        else:
+            flag.value = value
+
+def interrupt_current_processing(value=True):
+    interrupt_worker(worker_interrupt.get(), value)
 
 def processing_interrupted():
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        return interrupt_processing
+        flag = worker_interrupt.get()
+        if flag is None:
+            return interrupt_processing
+        return flag.value
 
 def throw_exception_if_processing_interrupted():
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        if interrupt_processing:
+        flag = worker_interrupt.get()
+        if flag is None:
+            interrupted = interrupt_processing
             interrupt_processing = False
+        else:
+            interrupted = flag.value
+            flag.value = False
+        if interrupted:
             raise InterruptProcessingException()
@@ -0,0 +1,102 @@
+import os
+import glob
+import json
+import logging
+
+import torch
+import safetensors
+import safetensors.torch
+
+# samplers where the latent at a step is the whole state: no history of previous steps and no random noise added while sampling
+RESUMABLE_SAMPLERS = ("euler", "heun", "heunpp2", "dpm_2", "ddim")
+
+# checkpoints of the most recent runs kept in the directory
+MAX_CHECKPOINTS = 64
+
+def resumable(sampler_name):
+    return sampler_name in RESUMABLE_SAMPLERS
+
+class SamplerCheckpoint:
+    """
+    Saves the latent of a sampling run every interval steps in directory, keyed by the signature of
+    the sampling (model, conditioning, latent, seed, sampler settings) with the sigmas used so far.
+    A later run with the same key whose sigmas start with the same values resumes from it.
+    """
+    def __init__(self, directory, key, interval, sigmas):
+        self.directory = directory
+        self.key = key
+        self.interval = interval
+        self.sigmas = sigmas.detach().to("cpu", torch.float32)
+        self.saved = []
+        self.last_x = None
+        self.last_step = None
+
+    def path(self, step):
+        return os.path.join(self.directory, "{}-{:05}.safetensors".format(self.key, step))
+
+    def load(self, shape):
+        """returns (step, x) of the latest checkpoint matching the sigmas or None"""
+        paths = sorted(glob.glob(os.path.join(glob.escape(self.directory), glob.escape(self.key) + "-*.safetensors")), reverse=True)
+        for path in paths:
+            try:
+                with safetensors.safe_open(path, framework="pt") as f:
+                    step = json.loads(f.metadata()["step"])
+                    sigmas = f.get_tensor("sigmas")
+                    if step >= len(self.sigmas) - 1 or len(sigmas) != step + 1:
+                        continue
+                    if not torch.allclose(sigmas, self.sigmas[:step + 1], rtol=1e-05, atol=1e-08):
+                        continue
+                    x = f.get_tensor("x")
+            except Exception as e:
+                logging.warning("Failed to load sampler checkpoint {}: {}".format(path, e))
+                continue
+            if x.shape != shape:
+                continue
+            # replaced by the next checkpoint of this run
+            self.saved = [(step, path)]
+            return step, x
+        return None
+
+    def step(self, step, x):
+        # x is the latent at sigmas[step], before that step is run
+        self.last_step = step
+        self.last_x = x
+        if self.interval > 0 and step > 0 and step % self.interval == 0:
+            self.save()
+
+    def finish(self, x):
+        # a fully denoised latent can't be continued
+        if float(self.sigmas[-1]) == 0:
+            return
+        self.last_step = len(self.sigmas) - 1
+        self.last_x = x
+        self.save()
+
+    def save(self):
+        if self.last_x is None or (len(self.saved) > 0 and self.saved[-1][0] == self.last_step):
+            return
+        step = self.last_step
+        path = self.path(step)
+        tensors = {"x": self.last_x.detach().to("cpu").contiguous(), "sigmas": self.sigmas[:step + 1].contiguous()}
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            safetensors.torch.save_file(tensors, path + ".tmp", metadata={"step": json.dumps(step)})
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            logging.warning("Failed to save sampler checkpoint {}: {}".format(path, e))
+            return
+
+        # only the latest checkpoint of the run is kept
+        for _, old_path in self.saved:
+            if os.path.exists(old_path):
+                os.remove(old_path)
+        self.saved = [(step, path)]
+        prune(self.directory)
+
+def prune(directory):
+    files = sorted(glob.glob(os.path.join(glob.escape(directory), "*.safetensors")), key=lambda a: os.path.getmtime(a))
+    for path in files[:-MAX_CHECKPOINTS]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -8,6 +8,8 @@ import math
 from comfy import model_base
 import comfy.utils
 import comfy.conds
+import comfy.sampler_checkpoint
+from comfy.cli_args import args
 
 def get_area_and_mult(conds, x_in, timestep_in):
     area = (x_in.shape[2], x_in.shape[3], 0, 0)
@@ -535,7 +537,7 @@ class KSAMPLER(Sampler):
         self.extra_options = extra_options
         self.inpaint_options = inpaint_options
 
-    def sample(self, model_wrap, sigmas, extra_args, callback, noise, latent_image=None, denoise_mask=None, disable_pbar=False):
+    def sample(self, model_wrap, sigmas, extra_args, callback, noise, latent_image=None, denoise_mask=None, disable_pbar=False, checkpoint=None):
         extra_args["denoise_mask"] = denoise_mask
         model_k = KSamplerX0Inpaint(model_wrap)
         model_k.latent_image = latent_image
@@ -545,20 +547,41 @@ class KSAMPLER(Sampler):
         else:
             model_k.noise = noise
 
-        if self.max_denoise(model_wrap, sigmas):
-            noise = noise * torch.sqrt(1.0 + sigmas[0] ** 2.0)
-        else:
-            noise = noise * sigmas[0]
+        start_step = 0
+        resume = None
+        if checkpoint is not None:
+            resume = checkpoint.load(noise.shape)
 
-        k_callback = None
-        total_steps = len(sigmas) - 1
-        if callback is not None:
-            k_callback = lambda x: callback(x["i"], x["denoised"], x["x"], total_steps)
+        if resume is not None:
+            start_step, x = resume
+            print("Resuming sampling from step {} of {}".format(start_step, len(sigmas) - 1))
+            noise = x.to(noise.device, noise.dtype)
+        else:
+            if self.max_denoise(model_wrap, sigmas):
+                noise = noise * torch.sqrt(1.0 + sigmas[0] ** 2.0)
+            else:
+                noise = noise * sigmas[0]
 
-        if latent_image is not None:
-            noise += latent_image
+            if latent_image is not None:
+                noise += latent_image
 
-        samples = self.sampler_function(model_k, noise, sigmas, extra_args=extra_args, callback=k_callback, disable=disable_pbar, **self.extra_options)
+        total_steps = len(sigmas) - 1
+        def k_callback(x):
+            i = x["i"] + start_step
+            if checkpoint is not None:
+                checkpoint.step(i, x["x"])
+            if callback is not None:
+                callback(i, x["denoised"], x["x"], total_steps)
+
+        try:
+            samples = self.sampler_function(model_k, noise, sigmas[start_step:], extra_args=extra_args, callback=k_callback, disable=disable_pbar, **self.extra_options)
+        except:
+            if checkpoint is not None:
+                # interrupted: keep the last step that was reached
+                checkpoint.save()
+            raise
+        if checkpoint is not None:
+            checkpoint.finish(samples)
         return samples
 
 
@@ -587,7 +610,7 @@ def wrap_model(model):
     model_denoise = CFGNoisePredictor(model)
     return model_denoise
 
-def sample(model, noise, positive, negative, cfg, device, sampler, sigmas, model_options={}, latent_image=None, denoise_mask=None, callback=None, disable_pbar=False, seed=None):
+def sample(model, noise, positive, negative, cfg, device, sampler, sigmas, model_options={}, latent_image=None, denoise_mask=None, callback=None, disable_pbar=False, seed=None, checkpoint=None):
     positive = positive[:]
     negative = negative[:]
 
@@ -619,7 +642,10 @@ def sample(model, noise, positive, negative, cfg, device, sampler, sigmas, model
 
     extra_args = {"cond":positive, "uncond":negative, "cond_scale": cfg, "model_options": model_options, "seed":seed}
 
-    samples = sampler.sample(model_wrap, sigmas, extra_args, callback, noise, latent_image, denoise_mask, disable_pbar)
+    if checkpoint is not None:
+        samples = sampler.sample(model_wrap, sigmas, extra_args, callback, noise, latent_image, denoise_mask, disable_pbar, checkpoint=checkpoint)
+    else:
+        samples = sampler.sample(model_wrap, sigmas, extra_args, callback, noise, latent_image, denoise_mask, disable_pbar)
     return model.process_latent_out(samples.to(torch.float32))
 
 SCHEDULER_NAMES = ["normal", "karras", "exponential", "sgm_uniform", "simple", "ddim_uniform"]
@@ -693,7 +719,7 @@ class KSampler:
             sigmas = self.calculate_sigmas(new_steps).to(self.device)
             self.sigmas = sigmas[-(steps + 1):]
 
-    def sample(self, noise, positive, negative, cfg, latent_image=None, start_step=None, last_step=None, force_full_denoise=False, denoise_mask=None, sigmas=None, callback=None, disable_pbar=False, seed=None):
+    def sample(self, noise, positive, negative, cfg, latent_image=None, start_step=None, last_step=None, force_full_denoise=False, denoise_mask=None, sigmas=None, callback=None, disable_pbar=False, seed=None, checkpoint_key=None):
         if sigmas is None:
             sigmas = self.sigmas
 
@@ -713,4 +739,8 @@ class KSampler:
 
         sampler = sampler_object(self.sampler)
 
-        return sample(self.model, noise, positive, negative, cfg, self.device, sampler, sigmas, self.model_options, latent_image=latent_image, denoise_mask=denoise_mask, callback=callback, disable_pbar=disable_pbar, seed=seed)
+        checkpoint = None
+        if checkpoint_key is not None and args.sampler_checkpoint_directory is not None and comfy.sampler_checkpoint.resumable(self.sampler):
+            checkpoint = comfy.sampler_checkpoint.SamplerCheckpoint(args.sampler_checkpoint_directory, checkpoint_key, args.sampler_checkpoint_interval, sigmas)
+
+        return sample(self.model, noise, positive, negative, cfg, self.device, sampler, sigmas, self.model_options, latent_image=latent_image, denoise_mask=denoise_mask, callback=callback, disable_pbar=disable_pbar, seed=seed, checkpoint=checkpoint)
@@ -0,0 +1,315 @@
+import os
+import hashlib
+import json
+import math
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+
+import torch
+import safetensors
+import safetensors.torch
+
+import nodes
+import folder_paths
+from comfy_execution import output_writer
+from comfy_execution import schema
+
+class Uncacheable(Exception):
+    pass
+
+def canonical_value(value):
+    # Converts a prompt value into something that can be serialized in a stable way.
+    # Values that can't be compared reliably (NaN, arbitrary objects) make the node uncacheable.
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        if math.isnan(value):
+            raise Uncacheable()
+        return value
+    if isinstance(value, (list, tuple)):
+        return [canonical_value(x) for x in value]
+    if isinstance(value, dict):
+        return {str(k): canonical_value(v) for k, v in value.items()}
+    raise Uncacheable()
+
+def hash_value(value):
+    data = json.dumps(value, sort_keys=True, separators=(',', ':'), allow_nan=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def node_signature(prompt, unique_id, signatures):
+    """
+    signature of a node = hash of (class_type, literal inputs, IS_CHANGED value, upstream signatures)
+    returns None if the output of the node should never be shared
+    """
+    node = prompt[unique_id]
+    class_type = node['class_type']
+    class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+
+    if hasattr(class_def, 'IS_CHANGED'):
+        if 'is_changed' not in node:
+            # IS_CHANGED raised an exception: always execute
+            return None
+        is_changed = node['is_changed']
+    else:
+        is_changed = None
+
+    try:
+        inputs = {}
+        for x, input_data in node['inputs'].items():
+            if isinstance(input_data, list):
+                upstream = signatures.get(input_data[0], None)
+                if upstream is None:
+                    return None
+                inputs[x] = ["link", upstream, input_data[1]]
+            else:
+                inputs[x] = canonical_value(input_data)
+
+        key = [class_type, inputs, canonical_value(is_changed)]
+    except Uncacheable:
+        return None
+
+    hidden = schema.get_input_types(class_def).get("hidden", {})
+    if "UNIQUE_ID" in hidden.values():
+        # the output can depend on the node id
+        key.append(unique_id)
+
+    states = file_states(class_def, node['inputs'])
+    if len(states) > 0:
+        key.append(states)
+
+    return hash_value(key)
+
+def file_states(class_def, inputs):
+    """
+    size and modification time of the files a node loads: its inputs naming a file of a model folder listed
+    by its INPUT_TYPES (ckpt_name, lora_name...). A file replaced under the same name changes the signature.
+    """
+    folders = schema.get_folders(class_def)
+    states = {}
+    if len(folders) == 0:
+        return states
+    for x, value in inputs.items():
+        if not isinstance(value, str):
+            continue
+        for folder in folders:
+            path = folder_paths.get_full_path(folder, value)
+            if path is None:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            states[x] = [stat.st_size, stat.st_mtime_ns]
+            break
+    return states
+
+# set by the executor for nodes that keep state keyed by their inputs
+prompt_signatures = contextvars.ContextVar("prompt_signatures", default=None)
+executing_node = contextvars.ContextVar("executing_node", default=None)
+
+def executing_node_signature(ignore_inputs=()):
+    """signature of the node being executed in the current context without the given inputs, None if there isn't one"""
+    signatures = prompt_signatures.get()
+    unique_id = executing_node.get()
+    if signatures is None or unique_id is None:
+        return None
+    prompt, signatures = signatures
+    node = dict(prompt[unique_id])
+    node['inputs'] = {k: v for k, v in node['inputs'].items() if k not in ignore_inputs}
+    return node_signature({unique_id: node}, unique_id, signatures)
+
+def tensor_hash(tensor):
+    t = tensor.detach().to("cpu").contiguous()
+    return hashlib.sha256(t.view(torch.uint8).numpy().tobytes() if t.numel() > 0 else b"").hexdigest() + str(tuple(t.shape)) + str(t.dtype)
+
+class CacheEntry:
+    def __init__(self, outputs, ui, output_types=None):
+        self.outputs = outputs
+        self.ui = ui
+        self.output_types = output_types
+
+class LRUCache:
+    def __init__(self, max_size, disk=None):
+        self.max_size = max_size
+        self.disk = disk
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return self.max_size > 0 or self.disk is not None
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.cache.get(key, None)
+            if entry is not None:
+                self.cache.move_to_end(key)
+                return entry
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.set(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        if key is None or not self.enabled():
+            return
+        evicted = []
+        with self.lock:
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                evicted.append(self.cache.popitem(last=False))
+        if self.disk is not None:
+            for k, e in evicted:
+                self.disk.set(k, e)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def __len__(self):
+        return len(self.cache)
+
+# output types that can be spilled to disk
+SPILL_TYPES = ("LATENT", "CONDITIONING", "IMAGE", "MASK")
+
+def pack_value(value, tensors):
+    # describes value as json with the tensors stored separately
+    if isinstance(value, torch.Tensor):
+        key = str(len(tensors))
+        tensors[key] = value.detach().to("cpu").contiguous()
+        return {"tensor": key}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {"value": value}
+    if isinstance(value, list):
+        return {"list": [pack_value(x, tensors) for x in value]}
+    if isinstance(value, tuple):
+        return {"tuple": [pack_value(x, tensors) for x in value]}
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        return {"dict": {k: pack_value(v, tensors) for k, v in value.items()}}
+    raise Uncacheable()
+
+def unpack_value(packed, tensors):
+    if "tensor" in packed:
+        return tensors[packed["tensor"]]
+    if "value" in packed:
+        return packed["value"]
+    if "list" in packed:
+        return [unpack_value(x, tensors) for x in packed["list"]]
+    if "tuple" in packed:
+        return tuple(unpack_value(x, tensors) for x in packed["tuple"])
+    return {k: unpack_value(v, tensors) for k, v in packed["dict"].items()}
+
+class DiskCache:
+    """
+    Second cache tier: outputs evicted from memory are stored as safetensors files in a
+    directory, limited to max_bytes with the least recently used files deleted first.
+    Survives restarts since the keys are node signatures. The files are written on the
+    output writer threads.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()
+        self.total_bytes = 0
+        # keys being written
+        self.writing = set()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        found = []
+        for f in os.scandir(directory):
+            if f.is_file() and f.name.endswith(".safetensors"):
+                stat = f.stat()
+                found.append((stat.st_mtime, f.name[:-len(".safetensors")], stat.st_size))
+        for _, key, size in sorted(found):
+            self.files[key] = size
+            self.total_bytes += size
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".safetensors")
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.files:
+                return None
+            self.files.move_to_end(key)
+        path = self.path(key)
+        try:
+            with safetensors.safe_open(path, framework="pt") as f:
+                metadata = json.loads(f.metadata()["entry"])
+                tensors = {k: f.get_tensor(k) for k in f.keys()}
+            os.utime(path)
+        except Exception as e:
+            logging.warning("Failed to load cached output {}: {}".format(path, e))
+            self.remove(key)
+            return None
+        return CacheEntry(unpack_value(metadata["outputs"], tensors), metadata["ui"], metadata["output_types"])
+
+    def set(self, key, entry):
+        # output nodes aren't spilled, the files they point to might not exist anymore when they get reloaded
+        if entry.output_types is None or len(entry.output_types) == 0 or any(t not in SPILL_TYPES for t in entry.output_types):
+            return
+        with self.lock:
+            if key in self.files:
+                self.files.move_to_end(key)
+                return
+            if key in self.writing:
+                return
+            self.writing.add(key)
+        # the prompt doesn't wait for it, the entry is only found once the file is complete
+        output_writer.writer.submit(self.write, key, entry, track=False)
+
+    def write(self, key, entry):
+        try:
+            self.write_file(key, entry)
+        finally:
+            with self.lock:
+                self.writing.discard(key)
+
+    def write_file(self, key, entry):
+        tensors = {}
+        try:
+            metadata = {"outputs": pack_value(entry.outputs, tensors), "ui": entry.ui, "output_types": list(entry.output_types)}
+            metadata = json.dumps(metadata)
+        except (Uncacheable, TypeError, ValueError):
+            return
+
+        path = self.path(key)
+        try:
+            safetensors.torch.save_file(tensors, path + ".tmp", metadata={"entry": metadata})
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            logging.warning("Failed to spill cached output to {}: {}".format(path, e))
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+            return
+
+        with self.lock:
+            size = os.path.getsize(path)
+            self.total_bytes += size - self.files.get(key, 0)
+            self.files[key] = size
+            self.files.move_to_end(key)
+            self.evict()
+
+    def remove(self, key):
+        with self.lock:
+            self.total_bytes -= self.files.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.files) > 0:
+            key, size = self.files.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,204 @@
+"""
+Prompt coalescing: queued prompts that only differ in the inputs listed in the COALESCE_INPUTS
+of their nodes (seeds, prompt text) are merged into one prompt where those inputs hold one value
+per original prompt. Nodes with COALESCE_INPUTS return batches that contain the results of every
+prompt one after the other and the nodes downstream of them must be BATCH_INDEPENDENT so the
+results can be split back to the original prompts. Those with PROMPT or EXTRA_PNGINFO hidden inputs
+must also set COALESCED_METADATA, they get CoalescedValues with the metadata of every prompt.
+"""
+
+import math
+
+import torch
+
+import nodes
+from comfy_execution import caching
+from comfy_execution import graph
+from comfy_execution import schema
+
+# samplers whose results depend on the rest of the batch: they add noise during sampling or
+# pick their step size from the error over the whole batch (dpm_adaptive)
+STOCHASTIC_SAMPLERS = ("ancestral", "sde", "ddpm", "lcm", "dpm_adaptive")
+
+class CoalescedValues(tuple):
+    pass
+
+def item_value(value, index):
+    if isinstance(value, CoalescedValues):
+        return value[index]
+    return value
+
+def get_coalesce_inputs(class_def):
+    return getattr(class_def, "COALESCE_INPUTS", ())
+
+def structure_key(prompt, execute_outputs):
+    """
+    Returns a key that is the same for prompts that can be coalesced together or None if the prompt can't be coalesced.
+    """
+    masked = {}
+    coalescing_nodes = set()
+    for unique_id, node in prompt.items():
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(node['class_type'], None)
+        if class_def is None:
+            return None
+        inputs = dict(node['inputs'])
+        coalesce_inputs = get_coalesce_inputs(class_def)
+        if len(coalesce_inputs) > 0:
+            sampler_name = inputs.get("sampler_name", "")
+            if isinstance(sampler_name, str) and any(x in sampler_name for x in STOCHASTIC_SAMPLERS):
+                return None
+            for x in coalesce_inputs:
+                if isinstance(inputs.get(x, None), list):
+                    return None
+                inputs.pop(x, None)
+            coalescing_nodes.add(unique_id)
+        masked[unique_id] = [node['class_type'], inputs]
+
+    if len(coalescing_nodes) == 0 or not batch_independent(prompt, coalescing_nodes):
+        return None
+
+    try:
+        return caching.hash_value([caching.canonical_value(masked), sorted(execute_outputs)])
+    except caching.Uncacheable:
+        return None
+
+def dedupe_key(item):
+    """
+    Same for queue items that give the same results: the prompt, the outputs to execute and the extra data
+    apart from the client. None if the item can't be deduplicated.
+    """
+    extra_data = {k: v for k, v in item[3].items() if k not in ("client_id", "priority_class")}
+    try:
+        return caching.hash_value([caching.canonical_value(item[2]), sorted(item[4]), caching.canonical_value(extra_data)])
+    except caching.Uncacheable:
+        return None
+
+def takes_prompt_metadata(class_def):
+    hidden = schema.get_input_types(class_def).get("hidden", {})
+    return any(v in ("PROMPT", "EXTRA_PNGINFO") for v in hidden.values())
+
+def get_coalescing_nodes(prompt):
+    return set(x for x, node in prompt.items() if len(get_coalesce_inputs(nodes.NODE_CLASS_MAPPINGS[node['class_type']])) > 0)
+
+def batch_independent(prompt, coalescing_nodes):
+    return batched_nodes(prompt, coalescing_nodes) is not None
+
+def batched_nodes(prompt, coalescing_nodes):
+    """
+    The coalescing nodes and the nodes downstream of them, their outputs (and ui) hold the results of every prompt.
+    None if one of them doesn't keep the items of the batch independent or can't take the metadata of every prompt.
+    """
+    batched = set()
+    for unique_id in graph.topological_order(prompt, prompt.keys()):
+        class_def = nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]['class_type']]
+        batched_inputs = [l for l in graph.get_input_links(prompt, unique_id) if l[1] in batched]
+        if unique_id in coalescing_nodes:
+            # the latent of a coalescing node gets repeated for every prompt so it must be the same for all of them
+            required = schema.get_input_types(class_def).get("required", {})
+            for x, _, _ in batched_inputs:
+                if x in required and required[x][0] == "LATENT":
+                    return None
+            batched.add(unique_id)
+        elif len(batched_inputs) > 0:
+            if not getattr(class_def, "BATCH_INDEPENDENT", False):
+                return None
+            batched.add(unique_id)
+        if unique_id in batched and takes_prompt_metadata(class_def) and not getattr(class_def, "COALESCED_METADATA", False):
+            return None
+    return batched
+
+def merge_prompts(prompts):
+    merged = {}
+    for unique_id, node in prompts[0].items():
+        merged[unique_id] = dict(node)
+        merged[unique_id]['inputs'] = inputs = dict(node['inputs'])
+        class_def = nodes.NODE_CLASS_MAPPINGS[node['class_type']]
+        for x in get_coalesce_inputs(class_def):
+            if x in inputs:
+                inputs[x] = CoalescedValues(p[unique_id]['inputs'][x] for p in prompts)
+    return merged
+
+def split_ui(ui, index, count):
+    out = {}
+    for k, v in ui.items():
+        if isinstance(v, list) and len(v) % count == 0:
+            size = len(v) // count
+            out[k] = v[index * size:(index + 1) * size]
+        else:
+            out[k] = v
+    return out
+
+def repeat_latent(latent, count):
+    out = latent.copy()
+    out["samples"] = latent["samples"].repeat([count] + [1] * (latent["samples"].ndim - 1))
+    if "batch_index" in latent:
+        out["batch_index"] = latent["batch_index"] * count
+    if "noise_mask" in latent and latent["noise_mask"].shape[0] == latent["samples"].shape[0]:
+        mask = latent["noise_mask"]
+        out["noise_mask"] = mask.repeat([count] + [1] * (mask.ndim - 1))
+    return out
+
+def expand_conditioning(conditioning, count, batch_size):
+    """conditioning with one entry per prompt gets repeated for every item of the batch of that prompt"""
+    if count <= 1 or batch_size <= 1:
+        return conditioning
+    out = []
+    for t in conditioning:
+        cond = t[0]
+        options = t[1].copy()
+        if cond.shape[0] == count:
+            cond = cond.repeat_interleave(batch_size, dim=0)
+        pooled = options.get("pooled_output", None)
+        if pooled is not None and pooled.shape[0] == count:
+            options["pooled_output"] = pooled.repeat_interleave(batch_size, dim=0)
+        out.append([cond, options])
+    return out
+
+def concat_conditioning(conds, pooled):
+    # pads with repeats like CONDCrossAttn.concat, this doesn't change the result
+    max_len = 1
+    for c in conds:
+        max_len = max_len * c.shape[1] // math.gcd(max_len, c.shape[1])
+    conds = [c.repeat(1, max_len // c.shape[1], 1) for c in conds]
+    if any(p is None for p in pooled):
+        pooled = None
+    else:
+        pooled = torch.cat(pooled)
+    return torch.cat(conds), pooled
+
+class FanOutServer:
+    """
+    Forwards the messages of a coalesced execution to the client of every coalesced prompt,
+    with its own prompt_id and its part of the outputs of the batched nodes (see batched_nodes).
+    targets: (item, followers) for every coalesced prompt, the followers get the same messages as the item.
+    """
+    def __init__(self, server, targets, batched=()):
+        object.__setattr__(self, "server", server)
+        object.__setattr__(self, "targets", targets)
+        object.__setattr__(self, "batched", batched)
+
+    def __getattr__(self, name):
+        return getattr(self.server, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.server, name, value)
+
+    def send_sync(self, event, data, sid=None):
+        if sid is None or not isinstance(data, dict):
+            self.server.send_sync(event, data, sid)
+            return
+        count = len(self.targets)
+        for index, (item, followers) in enumerate(self.targets):
+            output = None
+            if event == "executed" and data.get("node", None) in self.batched:
+                output = split_ui(data["output"], index, count)
+            for x in [item] + list(followers):
+                client_id = x[3].get("client_id", None)
+                if client_id is None:
+                    continue
+                message = dict(data)
+                if "prompt_id" in message:
+                    message["prompt_id"] = x[1]
+                if output is not None:
+                    message["output"] = output
+                self.server.send_sync(event, message, client_id)
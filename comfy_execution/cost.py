@@ -0,0 +1,84 @@
+import threading
+
+# cost units are megapixel sampling steps
+SAMPLER_STEP_COST = 1.0
+VAE_COST = 3.0
+NODE_COST = 0.01
+DEFAULT_RESOLUTION = (512 * 512, 1)
+# followed first to find the resolution, other links (conditioning, models) only when there are none of these
+IMAGE_INPUTS = ("latent_image", "samples", "latent", "pixels", "image", "images")
+
+def literal(value):
+    return not (isinstance(value, list) and len(value) == 2)
+
+def number_input(inputs, name, default=None):
+    value = inputs.get(name, default)
+    if not literal(value) or isinstance(value, bool) or not isinstance(value, (int, float)):
+        return default
+    return value
+
+def estimate(prompt):
+    """
+    Rough cost of executing a prompt from its graph: the sampling steps (nodes with a steps input) and the
+    VAE nodes weighted by the megapixels and batch size of the latent they work on, found upstream from the
+    nodes with width/height inputs.
+    """
+    resolutions = {}
+
+    def resolution(unique_id, visiting=()):
+        # (pixels, batch size) or None if unknown
+        if unique_id in resolutions:
+            return resolutions[unique_id]
+        node = prompt.get(unique_id, None)
+        if node is None or unique_id in visiting:
+            return None
+        inputs = node.get("inputs", {})
+        width = number_input(inputs, "width")
+        height = number_input(inputs, "height")
+        batch = number_input(inputs, "batch_size")
+        if width is not None and height is not None:
+            result = (width * height, batch or 1)
+        else:
+            links = [v for k, v in inputs.items() if not literal(v) and k in IMAGE_INPUTS]
+            if len(links) == 0:
+                links = [v for v in inputs.values() if not literal(v)]
+            upstream = [r for r in (resolution(v[0], visiting + (unique_id,)) for v in links) if r is not None]
+            result = max(upstream, default=None)
+            if batch is not None:
+                result = ((result or DEFAULT_RESOLUTION)[0], batch)
+        resolutions[unique_id] = result
+        return result
+
+    total = 0.0
+    for unique_id, node in prompt.items():
+        inputs = node.get("inputs", {})
+        class_type = node.get("class_type", "")
+        total += NODE_COST
+        steps = number_input(inputs, "steps")
+        if steps is not None:
+            end = number_input(inputs, "end_at_step", steps)
+            start = number_input(inputs, "start_at_step", 0)
+            pixels, batch = resolution(unique_id) or DEFAULT_RESOLUTION
+            total += SAMPLER_STEP_COST * max(min(steps, end) - start, 0) * pixels / 1e6 * batch
+        elif "VAEDecode" in class_type or "VAEEncode" in class_type:
+            pixels, batch = resolution(unique_id) or DEFAULT_RESOLUTION
+            total += VAE_COST * pixels / 1e6 * batch
+    return total
+
+class CostModel:
+    """
+    Converts costs to seconds, the rate is an exponential moving average of the measured execution times.
+    """
+    def __init__(self, seconds_per_unit=0.25, smoothing=0.2):
+        self.seconds_per_unit = seconds_per_unit
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+
+    def observe(self, cost, seconds):
+        if cost <= 0:
+            return
+        with self.lock:
+            self.seconds_per_unit += self.smoothing * (seconds / cost - self.seconds_per_unit)
+
+    def seconds(self, cost):
+        return cost * self.seconds_per_unit
@@ -0,0 +1,169 @@
+import heapq
+
+import nodes
+from comfy_execution import schema
+
+def get_input_links(prompt, unique_id):
+    # [(input_name, from_node_id, output_index)] for every linked input of a node
+    links = []
+    for x, input_data in prompt[unique_id]['inputs'].items():
+        if isinstance(input_data, list):
+            links.append((x, input_data[0], input_data[1]))
+    return links
+
+def get_lazy_inputs(class_def):
+    """names of the inputs declared with {"lazy": True}, they only get evaluated if check_lazy_status asks for them"""
+    lazy = set()
+    valid_inputs = schema.get_input_types(class_def)
+    for category in ("required", "optional"):
+        for x, info in valid_inputs.get(category, {}).items():
+            if len(info) > 1 and isinstance(info[1], dict) and info[1].get("lazy", False):
+                lazy.add(x)
+    return lazy
+
+def get_dependency_links(prompt, unique_id):
+    # linked inputs that have to be evaluated before the node can run
+    links = get_input_links(prompt, unique_id)
+    if len(links) == 0:
+        return links
+    lazy = get_lazy_inputs(nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]['class_type']])
+    return [l for l in links if l[0] not in lazy]
+
+def topological_order(prompt, node_ids):
+    """
+    Returns the given nodes and all the nodes they depend on, dependencies first.
+    Links to nodes that aren't in the prompt are ignored, nodes that are part of a cycle are left out.
+    """
+    to_visit = list(node_ids)
+    seen = set(to_visit)
+    inputs = {}
+    while len(to_visit) > 0:
+        unique_id = to_visit.pop()
+        inputs[unique_id] = set(l[1] for l in get_input_links(prompt, unique_id) if l[1] in prompt)
+        for x in inputs[unique_id]:
+            if x not in seen:
+                seen.add(x)
+                to_visit.append(x)
+
+    in_degree = {}
+    dependents = {}
+    for unique_id, node_inputs in inputs.items():
+        in_degree[unique_id] = len(node_inputs)
+        for x in node_inputs:
+            dependents.setdefault(x, []).append(unique_id)
+
+    ready = [x for x in inputs if in_degree[x] == 0]
+    order = []
+    while len(ready) > 0:
+        unique_id = ready.pop()
+        order.append(unique_id)
+        for x in dependents.get(unique_id, []):
+            in_degree[x] -= 1
+            if in_degree[x] == 0:
+                ready.append(x)
+    return order
+
+class DependencyCycleError(Exception):
+    pass
+
+class ExecutionPlan:
+    """
+    DAG of the nodes that still have to run to produce the requested outputs.
+    Nodes are handed out in topological order using in-degree counts so that each
+    node becomes ready once all the nodes it depends on are completed.
+    """
+    def __init__(self, prompt, outputs):
+        self.prompt = prompt
+        self.outputs = outputs
+        self.pending = set()
+        self.executing = set()
+        self.blocking = {}
+        self.dependents = {}
+        self.priority = {}
+        self.ready = []
+        self.counter = 0
+
+    def uncached_dependencies(self, unique_id):
+        # number of nodes that will run if this node gets executed (including itself)
+        if unique_id in self.outputs:
+            return 0
+        to_visit = [unique_id]
+        seen = set(to_visit)
+        while len(to_visit) > 0:
+            for _, from_id, _ in get_dependency_links(self.prompt, to_visit.pop()):
+                if from_id not in seen and from_id in self.prompt and from_id not in self.outputs:
+                    seen.add(from_id)
+                    to_visit.append(from_id)
+        return len(seen)
+
+    def add_node(self, unique_id, priority=0):
+        if unique_id in self.pending or unique_id in self.outputs:
+            return
+        to_visit = [unique_id]
+        self.pending.add(unique_id)
+        added = []
+        while len(to_visit) > 0:
+            node_id = to_visit.pop()
+            added.append(node_id)
+            self.priority[node_id] = priority
+            self.blocking[node_id] = set()
+            for _, from_id, _ in get_dependency_links(self.prompt, node_id):
+                if from_id in self.outputs or from_id not in self.prompt:
+                    continue
+                self.blocking[node_id].add(from_id)
+                self.dependents.setdefault(from_id, set()).add(node_id)
+                if from_id not in self.pending:
+                    self.pending.add(from_id)
+                    to_visit.append(from_id)
+
+        for node_id in added:
+            if len(self.blocking[node_id]) == 0:
+                self.make_ready(node_id)
+
+    def add_lazy_dependencies(self, unique_id, input_names):
+        """
+        Called when a node that was handed out asked for some of its lazy inputs:
+        the nodes linked to them get added to the plan and the node waits for them.
+        """
+        self.executing.discard(unique_id)
+        for x, from_id, _ in get_input_links(self.prompt, unique_id):
+            if x not in input_names or from_id in self.outputs or from_id not in self.prompt:
+                continue
+            self.add_node(from_id, self.priority[unique_id])
+            self.blocking[unique_id].add(from_id)
+            self.dependents.setdefault(from_id, set()).add(unique_id)
+
+        if len(self.blocking[unique_id]) == 0:
+            self.make_ready(unique_id)
+
+    def make_ready(self, unique_id):
+        heapq.heappush(self.ready, (self.priority[unique_id], self.counter, unique_id))
+        self.counter += 1
+
+    def is_empty(self):
+        return len(self.pending) == 0
+
+    def next_node(self):
+        """
+        Returns the next node that can be executed or None if the remaining nodes
+        are waiting on nodes that are still executing. Raises DependencyCycleError
+        if nodes are left that can never become ready.
+        """
+        if len(self.ready) == 0:
+            if len(self.executing) == 0 and len(self.pending) > 0:
+                raise DependencyCycleError("Dependency cycle detected between nodes: {}".format(", ".join(sorted(self.pending))))
+            return None
+        unique_id = heapq.heappop(self.ready)[-1]
+        self.executing.add(unique_id)
+        return unique_id
+
+    def complete_node(self, unique_id):
+        self.pending.discard(unique_id)
+        self.executing.discard(unique_id)
+        self.blocking.pop(unique_id, None)
+        self.priority.pop(unique_id, None)
+        for node_id in self.dependents.pop(unique_id, set()):
+            blocking = self.blocking[node_id]
+            blocking.discard(unique_id)
+            if len(blocking) == 0:
+                self.make_ready(node_id)
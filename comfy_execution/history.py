@@ -0,0 +1,125 @@
+import json
+import bisect
+import collections.abc
+
+def entry_client_id(entry):
+    return entry["prompt"][3].get("client_id", None)
+
+def entry_status(entry):
+    return entry.get("status", {}).get("status_str", None)
+
+def serialize_page(entries):
+    # entries: [(prompt_id, json text)], the entries are serialized once and reused for every response
+    return "{" + ", ".join(json.dumps(prompt_id) + ": " + text for prompt_id, text in entries) + "}"
+
+class HistoryItem:
+    def __init__(self, cursor, prompt_id, entry):
+        self.cursor = cursor
+        self.prompt_id = prompt_id
+        self.entry = entry
+        self.client_id = entry_client_id(entry)
+        self.status = entry_status(entry)
+        self.text = None
+
+    def json(self):
+        if self.text is None:
+            self.text = json.dumps(self.entry, default=str)
+        return self.text
+
+class History(collections.abc.Mapping):
+    """
+    In memory prompt history, oldest entries first. Every entry gets an increasing cursor, the entries are
+    indexed by cursor, client_id and status so pages can be found with a bisection instead of a scan.
+    Reads like a dict of prompt_id -> entry.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.wipe()
+
+    def wipe(self):
+        self.items = {}
+        self.cursors = []
+        self.by_cursor = {}
+        self.indexes = {}
+        self.next_cursor = 0
+
+    def __getitem__(self, prompt_id):
+        return self.items[prompt_id].entry
+
+    def __iter__(self):
+        return (self.by_cursor[c].prompt_id for c in self.cursors)
+
+    def __len__(self):
+        return len(self.items)
+
+    def index_keys(self, item):
+        return [("client_id", item.client_id), ("status", item.status)]
+
+    def add(self, prompt_id, entry):
+        self.delete(prompt_id)
+        if len(self.items) >= self.max_size:
+            self.delete(self.by_cursor[self.cursors[0]].prompt_id)
+        item = HistoryItem(self.next_cursor, prompt_id, entry)
+        self.next_cursor += 1
+        self.items[prompt_id] = item
+        self.by_cursor[item.cursor] = item
+        self.cursors.append(item.cursor)
+        for key in self.index_keys(item):
+            self.indexes.setdefault(key, []).append(item.cursor)
+
+    def delete(self, prompt_id):
+        item = self.items.pop(prompt_id, None)
+        if item is None:
+            return
+        del self.by_cursor[item.cursor]
+        remove_sorted(self.cursors, item.cursor)
+        for key in self.index_keys(item):
+            remove_sorted(self.indexes[key], item.cursor)
+            if len(self.indexes[key]) == 0:
+                del self.indexes[key]
+
+    def get_item(self, prompt_id):
+        return self.items.get(prompt_id, None)
+
+    def page(self, max_items=None, offset=-1, after=None, client_id=None, status=None):
+        """
+        The entries with a cursor bigger than after (all of them if None) matching the filters, skipping offset of them.
+        A negative offset with max_items returns the last max_items entries, or the first ones after the cursor.
+        """
+        if after is not None:
+            offset = max(offset, 0)
+        filters = []
+        if client_id is not None:
+            filters.append(("client_id", client_id))
+        if status is not None:
+            filters.append(("status", status))
+
+        cursors = self.cursors
+        if len(filters) > 0:
+            # walk the smallest index, check the other filter on the entries
+            lists = sorted((self.indexes.get(f, []) for f in filters), key=len)
+            cursors = lists[0]
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(cursors, after)
+
+        def matches(item):
+            return all(getattr(item, k) == v for k, v in filters)
+
+        if len(filters) <= 1:
+            count = len(cursors) - start
+            if offset < 0:
+                offset = 0 if max_items is None else max(count - max_items, 0)
+            end = len(cursors) if max_items is None else start + offset + max_items
+            return [self.by_cursor[c] for c in cursors[start + offset:end]]
+
+        selected = [self.by_cursor[c] for c in cursors[start:] if matches(self.by_cursor[c])]
+        if offset < 0:
+            offset = 0 if max_items is None else max(len(selected) - max_items, 0)
+        end = len(selected) if max_items is None else offset + max_items
+        return selected[offset:end]
+
+def remove_sorted(values, value):
+    i = bisect.bisect_left(values, value)
+    if i < len(values) and values[i] == value:
+        del values[i]
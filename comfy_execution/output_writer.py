@@ -0,0 +1,113 @@
+import os
+import logging
+import threading
+import contextlib
+import contextvars
+import concurrent.futures
+
+from comfy.cli_args import args
+
+class OutputWriter:
+    """
+    Pool of threads that encode and write output files so the executor doesn't have to wait for them.
+    The number of pending writes is bounded: submit() blocks when the writer falls too far behind.
+    """
+    def __init__(self, threads, max_pending):
+        self.pool = None
+        if threads > 0:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="output_writer")
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        # a context variable so the nodes running on the node pool (copied contexts) are tracked too
+        self.tracked = contextvars.ContextVar("output_writer_tracked", default=None)
+
+    def submit(self, function, *args, ui=None, track=True):
+        """
+        ui: the entry of the node ui that shows the file, see remove_failed.
+        track: False for writes the prompt doesn't have to wait for, see track().
+        """
+        tracked = self.tracked.get() if track else None
+        if self.pool is None:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+            log_write_error(future)
+        else:
+            self.slots.acquire()
+            future = self.pool.submit(function, *args)
+            future.add_done_callback(self.write_done)
+
+        future.ui = ui
+        if tracked is not None:
+            tracked.append(future)
+        return future
+
+    def write_done(self, future):
+        self.slots.release()
+        log_write_error(future)
+
+    @contextlib.contextmanager
+    def track(self):
+        """
+        collects the writes submitted in the current context, used by the executor to know when the files of a node
+        or a prompt landed. The writes are also added to the enclosing track() when there is one.
+        """
+        futures = []
+        token = self.tracked.set(futures)
+        try:
+            yield futures
+        finally:
+            self.tracked.reset(token)
+            previous = self.tracked.get()
+            if previous is not None:
+                previous.extend(futures)
+
+def log_write_error(future):
+    ex = future.exception()
+    if ex is not None:
+        logging.error("Failed to write output file: {}".format(ex))
+
+def remove_failed(ui, futures):
+    """the node ui without the entries of the files that couldn't be written, the futures must be done"""
+    failed = set(id(f.ui) for f in futures if f.ui is not None and f.exception() is not None)
+    if len(failed) == 0:
+        return ui
+    return {k: [x for x in v if id(x) not in failed] if isinstance(v, list) else v for k, v in ui.items()}
+
+def when_done(futures, callback):
+    """calls callback once all the futures are finished (immediately if there are none)"""
+    if len(futures) == 0:
+        callback()
+        return
+
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            callback()
+
+    for f in futures:
+        f.add_done_callback(done)
+
+def reserve_file(path):
+    # create an empty placeholder so the name isn't picked again while the file is being written
+    open(path, "wb").close()
+
+def write_file_atomic(path, write_function):
+    # the file only appears at its final path once it is complete
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            write_function(f)
+        os.replace(temp_path, path)
+    except:
+        for p in (temp_path, path):
+            if os.path.exists(p):
+                os.remove(p)
+        raise
+
+writer = OutputWriter(args.output_writer_threads, args.output_writer_threads * 8)
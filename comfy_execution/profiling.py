@@ -0,0 +1,83 @@
+import time
+import threading
+
+import psutil
+import torch
+
+import comfy.model_management
+
+process = psutil.Process()
+
+# the profilers of the nodes running at the moment, on the node pool or on other prompt workers
+lock = threading.Lock()
+active = set()
+
+class NodeProfiler:
+    """
+    Measures the execution of a node:
+    wall_time: seconds the node took
+    cpu_time: CPU seconds used by the thread running the node (not the threads started by torch)
+    ram_delta: change of the process resident memory in bytes
+    vram_peak: peak memory allocated by torch on the device in bytes (cuda only)
+    vram_delta: change of the memory allocated by torch on the device in bytes (cuda only)
+    The memory figures are for the whole process or device, they are left out and the result is
+    marked as overlapped when other nodes ran at the same time.
+    """
+    def __enter__(self):
+        self.device = comfy.model_management.get_torch_device()
+        self.track_vram = self.device.type == "cuda"
+        self.overlapped = False
+        self.vram_shared = False
+        with lock:
+            for other in active:
+                self.overlap(other)
+                other.overlap(self)
+            active.add(self)
+            # the peak of the device can only be reset when no other node uses it
+            if self.track_vram and not self.vram_shared:
+                torch.cuda.reset_peak_memory_stats(self.device)
+        if self.track_vram:
+            self.vram_start = torch.cuda.memory_allocated(self.device)
+        self.ram_start = process.memory_info().rss
+        self.cpu_start = time.thread_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def overlap(self, other):
+        self.overlapped = True
+        if other.device == self.device:
+            self.vram_shared = True
+
+    def __exit__(self, *exc):
+        self.wall_time = time.perf_counter() - self.wall_start
+        self.cpu_time = time.thread_time() - self.cpu_start
+        self.ram_delta = process.memory_info().rss - self.ram_start
+        if self.track_vram:
+            self.vram_peak = torch.cuda.max_memory_allocated(self.device)
+            self.vram_delta = torch.cuda.memory_allocated(self.device) - self.vram_start
+        with lock:
+            active.discard(self)
+        return False
+
+    def result(self):
+        out = {
+            "cached": False,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+        }
+        if self.overlapped:
+            out["overlapped"] = True
+        else:
+            out["ram_delta"] = self.ram_delta
+        if self.track_vram and not self.vram_shared:
+            out["vram_peak"] = self.vram_peak
+            out["vram_delta"] = self.vram_delta
+        return out
+
+def cached_result():
+    return {"cached": True}
+
+def record(profile, unique_id, result):
+    # the nodes running on the pool threads add their result to the profile of the prompt at the same time
+    with lock:
+        profile[unique_id] = result
@@ -0,0 +1,122 @@
+import json
+import time
+import sqlite3
+import threading
+
+from comfy_execution import history
+
+# a queue item that was running this many times when the process stopped isn't queued again,
+# it is most likely what killed it (out of memory, crash in a node)
+MAX_ATTEMPTS = 2
+
+class SQLiteQueueStore:
+    """
+    Keeps the queue items and the history of a PromptQueue in a SQLite database (WAL mode) so
+    queued prompts survive a restart and the history doesn't have to be kept in memory.
+    Queue items that were running when the process stopped are queued again, up to MAX_ATTEMPTS times.
+    """
+    def __init__(self, path, max_history):
+        self.max_history = max_history
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS queue (prompt_id TEXT PRIMARY KEY, number REAL, item TEXT, running INTEGER DEFAULT 0, created REAL, attempts INTEGER DEFAULT 0)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, prompt_id TEXT UNIQUE, timestamp REAL, entry TEXT, client_id TEXT, status TEXT)")
+        if "attempts" not in [r[1] for r in self.conn.execute("PRAGMA table_info(queue)").fetchall()]:
+            self.conn.execute("ALTER TABLE queue ADD COLUMN attempts INTEGER DEFAULT 0")
+        columns = [r[1] for r in self.conn.execute("PRAGMA table_info(history)").fetchall()]
+        for column in ["client_id", "status"]:
+            if column not in columns:
+                self.conn.execute("ALTER TABLE history ADD COLUMN {} TEXT".format(column))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS history_client_id ON history (client_id, id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS history_status ON history (status, id)")
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            return self.conn.execute(sql, parameters).fetchall()
+
+    def add_pending(self, item):
+        # an item queued again by recover keeps its attempts
+        self.execute("INSERT INTO queue (prompt_id, number, item, running, created) VALUES (?, ?, ?, 0, ?) "
+                     "ON CONFLICT (prompt_id) DO UPDATE SET number = excluded.number, item = excluded.item, running = 0",
+                     (item[1], item[0], json.dumps(item), time.time()))
+
+    def set_running(self, prompt_id):
+        self.execute("UPDATE queue SET running = 1, attempts = attempts + 1 WHERE prompt_id = ?", (prompt_id,))
+
+    def remove_pending(self, prompt_id):
+        self.execute("DELETE FROM queue WHERE prompt_id = ?", (prompt_id,))
+
+    def wipe_pending(self):
+        self.execute("DELETE FROM queue WHERE running = 0")
+
+    def pending_items(self):
+        # [(item, attempts)], the running items didn't finish before the restart and have attempts > 0
+        return [(tuple(json.loads(r[0])), r[1]) for r in self.execute("SELECT item, attempts FROM queue ORDER BY number")]
+
+    def add_history(self, prompt_id, entry):
+        data = json.dumps(entry, default=str)
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.execute("DELETE FROM queue WHERE prompt_id = ?", (prompt_id,))
+                self.conn.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,))
+                self.conn.execute("INSERT INTO history (prompt_id, timestamp, entry, client_id, status) VALUES (?, ?, ?, ?, ?)",
+                                  (prompt_id, time.time(), data, history.entry_client_id(entry), history.entry_status(entry)))
+                self.conn.execute("DELETE FROM history WHERE id <= (SELECT MAX(id) FROM history) - ?", (self.max_history,))
+
+    def get_history(self, prompt_id):
+        rows = self.execute("SELECT entry FROM history WHERE prompt_id = ?", (prompt_id,))
+        if len(rows) == 0:
+            return None
+        return json.loads(rows[0][0])
+
+    def get_history_page(self, max_items=None, offset=-1):
+        if max_items is None:
+            max_items = -1
+        elif offset < 0:
+            count = self.execute("SELECT COUNT(*) FROM history")[0][0]
+            offset = count - max_items
+        rows = self.execute("SELECT prompt_id, entry FROM history ORDER BY id LIMIT ? OFFSET ?", (max_items, max(offset, 0)))
+        return {r[0]: json.loads(r[1]) for r in rows}
+
+    def get_history_json_item(self, prompt_id):
+        return [(r[0], r[1]) for r in self.execute("SELECT prompt_id, entry FROM history WHERE prompt_id = ?", (prompt_id,))]
+
+    def get_history_json(self, max_items=None, offset=-1, after=None, client_id=None, status=None):
+        """
+        Page of the history as [(prompt_id, json text)] without parsing the entries, the row id is the cursor.
+        Same arguments as History.page, the filters use the indexes.
+        """
+        where = []
+        parameters = []
+        if after is not None:
+            offset = max(offset, 0)
+            where.append("id > ?")
+            parameters.append(after)
+        if client_id is not None:
+            where.append("client_id = ?")
+            parameters.append(client_id)
+        if status is not None:
+            where.append("status = ?")
+            parameters.append(status)
+        condition = "" if len(where) == 0 else " WHERE " + " AND ".join(where)
+
+        if max_items is None:
+            max_items = -1
+            offset = max(offset, 0)
+        elif offset < 0:
+            # the last max_items entries, read backwards
+            rows = self.execute("SELECT id, prompt_id, entry FROM history{} ORDER BY id DESC LIMIT ?".format(condition), parameters + [max_items])
+            rows.reverse()
+            return [(r[1], r[2]) for r in rows], rows[-1][0] if len(rows) > 0 else None
+        rows = self.execute("SELECT id, prompt_id, entry FROM history{} ORDER BY id LIMIT ? OFFSET ?".format(condition), parameters + [max_items, offset])
+        return [(r[1], r[2]) for r in rows], rows[-1][0] if len(rows) > 0 else None
+
+    def delete_history(self, prompt_id):
+        self.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,))
+
+    def wipe_history(self):
+        self.execute("DELETE FROM history")
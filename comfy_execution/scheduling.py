@@ -0,0 +1,209 @@
+import time
+import heapq
+import collections
+
+import nodes
+
+# served in this order, a batch prompt only runs when no interactive prompt is pending
+PRIORITY_CLASSES = ("interactive", "batch")
+DEFAULT_PRIORITY_CLASS = "interactive"
+
+def priority_class(item):
+    c = item[3].get("priority_class", DEFAULT_PRIORITY_CLASS)
+    if c not in PRIORITY_CLASSES:
+        return DEFAULT_PRIORITY_CLASS
+    return c
+
+def client_key(item):
+    return item[3].get("client_id", None)
+
+def is_loader(class_def):
+    return class_def is not None and "loaders" in getattr(class_def, "CATEGORY", "").split("/")
+
+def model_keys(prompt):
+    """
+    the models a prompt loads: the class and the file names (string inputs) of its loader nodes,
+    the nodes with a loaders category
+    """
+    keys = set()
+    for node in prompt.values():
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(node.get("class_type", None), None)
+        if not is_loader(class_def):
+            continue
+        names = tuple(sorted((k, v) for k, v in node.get("inputs", {}).items() if isinstance(v, str)))
+        keys.add((node["class_type"], names))
+    return frozenset(keys)
+
+class Flow:
+    def __init__(self, virtual_time):
+        self.items = []
+        self.virtual_time = virtual_time
+
+class ClassMetrics:
+    def __init__(self):
+        self.pending = 0
+        self.started = 0
+        self.waits = collections.deque(maxlen=100)
+
+    def status(self):
+        waits = list(self.waits)
+        return {
+            "pending": self.pending,
+            "started": self.started,
+            "wait_avg": sum(waits) / len(waits) if len(waits) > 0 else 0.0,
+            "wait_max": max(waits, default=0.0),
+        }
+
+class FairScheduler:
+    """
+    The pending queue items, split by priority class and by client.
+    Classes are served in the order of PRIORITY_CLASSES. Within a class the clients are served with weighted
+    fair queueing: every client has a virtual time that advances by 1 / weight per prompt it gets, the client
+    with the lowest one goes next so a client that queued 500 prompts alternates with the others instead of
+    blocking them. The prompts of a client run in the order of their number, prompts queued to the front
+    (negative number) run before everything else of their class.
+    """
+    def __init__(self):
+        self.flows = {c: {} for c in PRIORITY_CLASSES}
+        self.virtual_time = {c: 0.0 for c in PRIORITY_CLASSES}
+        self.metrics = {c: ClassMetrics() for c in PRIORITY_CLASSES}
+        self.weights = {}
+        self.queued_at = {}
+        self.count = 0
+        # model affinity: prompt_id -> model_keys of the pending prompts and number of times they were skipped
+        self.models = {}
+        self.skips = {}
+        self.reordered = 0
+        # prompt_ids of the prompts run before the fair choice, until their execution is recorded
+        self.affinity_picks = set()
+
+    def set_weight(self, client, weight):
+        # the share of the class a client gets relative to the others, 1 by default
+        if not weight > 0:
+            raise ValueError("client weights must be positive")
+        self.weights[client] = weight
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, prompt_id):
+        return prompt_id in self.queued_at
+
+    def __iter__(self):
+        for flows in self.flows.values():
+            for flow in flows.values():
+                yield from flow.items
+
+    def put(self, item):
+        c = priority_class(item)
+        key = client_key(item)
+        flow = self.flows[c].get(key, None)
+        if flow is None:
+            # idle clients don't keep credit, they start at the current virtual time of the class
+            flow = Flow(self.virtual_time[c])
+            self.flows[c][key] = flow
+        heapq.heappush(flow.items, item)
+        self.queued_at[item[1]] = time.perf_counter()
+        self.metrics[c].pending += 1
+        self.count += 1
+
+    def remove(self, item):
+        c = priority_class(item)
+        key = client_key(item)
+        flow = self.flows[c][key]
+        flow.items.remove(item)
+        heapq.heapify(flow.items)
+        self.removed(c, key, item)
+
+    def removed(self, c, key, item):
+        if len(self.flows[c][key].items) == 0:
+            del self.flows[c][key]
+        self.queued_at.pop(item[1], None)
+        self.models.pop(item[1], None)
+        self.skips.pop(item[1], None)
+        self.metrics[c].pending -= 1
+        self.count -= 1
+
+    def clear(self):
+        for c in PRIORITY_CLASSES:
+            self.flows[c] = {}
+            self.metrics[c].pending = 0
+        self.queued_at = {}
+        self.models = {}
+        self.skips = {}
+        self.count = 0
+
+    def next_flow(self, c):
+        # the key of the client served next, there must be one
+        flows = self.flows[c]
+        front = [k for k, f in flows.items() if f.items[0][0] < 0]
+        if len(front) > 0:
+            return min(front, key=lambda k: flows[k].items[0])
+        return min(flows, key=lambda k: (flows[k].virtual_time, flows[k].items[0]))
+
+    def item_models(self, item):
+        keys = self.models.get(item[1], None)
+        if keys is None:
+            keys = model_keys(item[2])
+            self.models[item[1]] = keys
+        return keys
+
+    def affinity_choice(self, c, item, resident, max_skips):
+        """
+        A pending prompt of class c that only uses resident models to run instead of item, the fair choice,
+        or None. item is skipped at most max_skips times and prompts queued to the front are never skipped.
+        """
+        if item[0] < 0 or self.skips.get(item[1], 0) >= max_skips:
+            return None
+        if self.item_models(item) <= resident:
+            return None
+        best = None
+        for key, flow in self.flows[c].items():
+            for x in flow.items:
+                models = self.item_models(x)
+                if len(models) > 0 and models <= resident and (best is None or x < best[1]):
+                    best = (key, x)
+        if best is None:
+            return None
+        self.skips[item[1]] = self.skips.get(item[1], 0) + 1
+        self.reordered += 1
+        self.affinity_picks.add(best[1][1])
+        return best
+
+    def pop(self, resident=None, max_skips=0):
+        """
+        The next item. With the model_keys of the models loaded by the worker as resident and max_skips > 0,
+        a prompt that only needs these models can run before the fair choice, see affinity_choice.
+        """
+        for c in PRIORITY_CLASSES:
+            if len(self.flows[c]) == 0:
+                continue
+            # prompts without a client_id share the None key
+            key = self.next_flow(c)
+            flow = self.flows[c][key]
+            item = flow.items[0]
+            if resident is not None and max_skips > 0:
+                choice = self.affinity_choice(c, item, resident, max_skips)
+                if choice is not None:
+                    key, item = choice
+                    flow = self.flows[c][key]
+            if item is flow.items[0]:
+                heapq.heappop(flow.items)
+            else:
+                flow.items.remove(item)
+                heapq.heapify(flow.items)
+            if item[0] >= 0:
+                self.virtual_time[c] = max(self.virtual_time[c], flow.virtual_time)
+            flow.virtual_time = max(flow.virtual_time, self.virtual_time[c]) + 1.0 / self.weights.get(key, 1.0)
+
+            metrics = self.metrics[c]
+            metrics.started += 1
+            queued_at = self.queued_at.get(item[1], None)
+            if queued_at is not None:
+                metrics.waits.append(time.perf_counter() - queued_at)
+            self.removed(c, key, item)
+            return item
+        return None
+
+    def status(self):
+        return {c: m.status() for c, m in self.metrics.items()}
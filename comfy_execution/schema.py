@@ -0,0 +1,66 @@
+import itertools
+import threading
+
+import folder_paths
+
+versions = itertools.count()
+
+class SchemaEntry:
+    def __init__(self, input_types, dependencies, change_counter):
+        self.input_types = input_types
+        self.dependencies = dependencies
+        self.change_counter = change_counter
+        # changes every time the schema gets recomputed
+        self.version = next(versions)
+
+class SchemaRegistry:
+    """
+    Caches the result of INPUT_TYPES() for every node class.
+    The file lists used by INPUT_TYPES (folder_paths.get_filename_list, folder_paths.get_file_list)
+    are recorded with the schema and it gets recomputed when one of them changes or when
+    folder_paths.notify_changed() is called. The returned dicts are shared and must not be modified.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def valid(self, entry):
+        if entry.change_counter != folder_paths.change_counter:
+            return False
+        for key, state in entry.dependencies.items():
+            if folder_paths.dependency_state(key) is not state:
+                return False
+        return True
+
+    def get(self, class_def):
+        return self.get_entry(class_def).input_types
+
+    def get_entry(self, class_def):
+        entry = self.entries.get(class_def, None)
+        if entry is not None and self.valid(entry):
+            return entry
+
+        change_counter = folder_paths.change_counter
+        with folder_paths.track_dependencies() as used:
+            input_types = class_def.INPUT_TYPES()
+        dependencies = {key: folder_paths.dependency_state(key) for key in used}
+        entry = SchemaEntry(input_types, dependencies, change_counter)
+        with self.lock:
+            self.entries[class_def] = entry
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+registry = SchemaRegistry()
+
+def get_input_types(class_def):
+    return registry.get(class_def)
+
+def get_version(class_def):
+    return registry.get_entry(class_def).version
+
+def get_folders(class_def):
+    """the model folders (folder_paths.get_filename_list) whose files INPUT_TYPES lists"""
+    return [name for kind, name in registry.get_entry(class_def).dependencies if kind == "folder"]
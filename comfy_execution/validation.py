@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+
+import nodes
+import folder_paths
+from comfy_execution import caching
+from comfy_execution import graph
+from comfy_execution import schema
+
+def validation_key(prompt, unique_id, keys):
+    """
+    hash of the sub-graph ending at the node: class_type, literal inputs, schema version and the keys
+    of the linked nodes, the validation result of a node only depends on these.
+    returns None if the node can't be memoized
+    """
+    node = prompt[unique_id]
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(node.get('class_type', None), None)
+    if class_def is None:
+        return None
+
+    try:
+        inputs = {}
+        for x, input_data in node['inputs'].items():
+            if isinstance(input_data, list) and len(input_data) == 2:
+                upstream = keys.get(input_data[0], None)
+                if upstream is None:
+                    return None
+                inputs[x] = ["link", upstream, caching.canonical_value(input_data[1])]
+            else:
+                inputs[x] = caching.canonical_value(input_data)
+        key = [node['class_type'], inputs, schema.get_version(class_def), folder_paths.change_counter]
+    except caching.Uncacheable:
+        return None
+
+    hidden = schema.get_input_types(class_def).get("hidden", {})
+    if "UNIQUE_ID" in hidden.values():
+        key.append(unique_id)
+    return caching.hash_value(key)
+
+def compute_validation_keys(prompt):
+    keys = {}
+    try:
+        for unique_id in graph.topological_order(prompt, prompt.keys()):
+            keys[unique_id] = validation_key(prompt, unique_id, keys)
+    except Exception:
+        # malformed prompt, validate_inputs reports what is wrong with it
+        return {}
+    return keys
+
+class ValidationCache:
+    """
+    Remembers the nodes that passed validation with the literal input values they were converted to,
+    a resubmitted prompt only re-validates the nodes whose sub-graph changed.
+    Failures aren't stored, their errors refer to node ids.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            converted = self.cache.get(key, None)
+            if converted is not None:
+                self.cache.move_to_end(key)
+            return converted
+
+    def set(self, key, converted):
+        if key is None:
+            return
+        with self.lock:
+            self.cache[key] = converted
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+cache = ValidationCache(4096)
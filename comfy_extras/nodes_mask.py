@@ -58,6 +58,7 @@ class LatentCompositeMasked:
     FUNCTION = "composite"
 
     CATEGORY = "latent"
+    THREAD_SAFE = True
 
     def composite(self, destination, source, x, y, resize_source, mask = None):
         output = destination.copy()
@@ -85,6 +86,7 @@ class ImageCompositeMasked:
     FUNCTION = "composite"
 
     CATEGORY = "image"
+    THREAD_SAFE = True
 
     def composite(self, destination, source, x, y, resize_source, mask = None):
         destination = destination.clone().movedim(-1, 1)
@@ -101,6 +103,7 @@ class MaskToImage:
         }
 
     CATEGORY = "mask"
+    THREAD_SAFE = True
 
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "mask_to_image"
@@ -120,6 +123,7 @@ class ImageToMask:
         }
 
     CATEGORY = "mask"
+    THREAD_SAFE = True
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "image_to_mask"
@@ -140,6 +144,7 @@ class ImageColorToMask:
         }
 
     CATEGORY = "mask"
+    THREAD_SAFE = True
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "image_to_mask"
@@ -162,6 +167,7 @@ class SolidMask:
         }
 
     CATEGORY = "mask"
+    THREAD_SAFE = True
 
     RETURN_TYPES = ("MASK",)
 
@@ -181,6 +187,7 @@ class InvertMask:
         }
 
     CATEGORY = "mask"
+    THREAD_SAFE = True
 
     RETURN_TYPES = ("MASK",)
 
@@ -204,6 +211,7 @@ class CropMask:
         }
 
     CATEGORY = "mask"
+    THREAD_SAFE = True
 
     RETURN_TYPES = ("MASK",)
 
@@ -228,6 +236,7 @@ class MaskComposite:
         }
 
     CATEGORY = "mask"
+    THREAD_SAFE = True
 
     RETURN_TYPES = ("MASK",)
 
@@ -275,6 +284,7 @@ class FeatherMask:
         }
 
     CATEGORY = "mask"
+    THREAD_SAFE = True
 
     RETURN_TYPES = ("MASK",)
 
@@ -318,6 +328,7 @@ class GrowMask:
         }
     
     CATEGORY = "mask"
+    THREAD_SAFE = True
 
     RETURN_TYPES = ("MASK",)
 
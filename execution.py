@@ -4,17 +4,31 @@ import copy
 import json
 import logging
 import threading
-import heapq
 import traceback
+import math
 import gc
+import contextvars
+import concurrent.futures
 
 import torch
 import nodes
 
 import comfy.model_management
+from comfy.cli_args import args
+from comfy_execution import caching
+from comfy_execution import coalescing
+from comfy_execution import cost
+from comfy_execution import graph
+from comfy_execution import history
+from comfy_execution import output_writer
+from comfy_execution import profiling
+from comfy_execution import queue_store
+from comfy_execution import scheduling
+from comfy_execution import schema
+from comfy_execution import validation
 
 def get_input_data(inputs, class_def, unique_id, outputs={}, prompt={}, extra_data={}):
-    valid_inputs = class_def.INPUT_TYPES()
+    valid_inputs = schema.get_input_types(class_def)
     input_data_all = {}
     for x in inputs:
         input_data = inputs[x]
@@ -33,15 +47,83 @@ def get_input_data(inputs, class_def, unique_id, outputs={}, prompt={}, extra_da
     if "hidden" in valid_inputs:
         h = valid_inputs["hidden"]
         for x in h:
+            # coalesced prompts: the batched nodes get the metadata of every prompt, the others the metadata of the first one
+            coalesced = unique_id in extra_data.get("coalesced_nodes", ())
             if h[x] == "PROMPT":
-                input_data_all[x] = [prompt]
+                if "coalesced_prompts" in extra_data:
+                    prompts = extra_data["coalesced_prompts"]
+                    input_data_all[x] = [prompts if coalesced else prompts[0]]
+                else:
+                    input_data_all[x] = [prompt]
             if h[x] == "EXTRA_PNGINFO":
-                if "extra_pnginfo" in extra_data:
+                if coalesced:
+                    input_data_all[x] = [extra_data["coalesced_extra_pnginfo"]]
+                elif "extra_pnginfo" in extra_data:
                     input_data_all[x] = [extra_data['extra_pnginfo']]
             if h[x] == "UNIQUE_ID":
                 input_data_all[x] = [unique_id]
     return input_data_all
 
+def batch_item_size(value):
+    # number of batch items in a list element that can be stacked, None if it can't be
+    if isinstance(value, torch.Tensor) and value.ndim > 0:
+        return value.shape[0]
+    if isinstance(value, dict) and list(value.keys()) == ["samples"] and isinstance(value["samples"], torch.Tensor):
+        return value["samples"].shape[0]
+    return None
+
+def concat_batch_items(values):
+    if isinstance(values[0], dict):
+        return {"samples": torch.cat([v["samples"] for v in values])}
+    return torch.cat(values)
+
+def split_batch_items(value, sizes):
+    if batch_item_size(value) != sum(sizes):
+        return None
+    if isinstance(value, dict):
+        return [{"samples": x} for x in torch.split(value["samples"], sizes)]
+    return list(torch.split(value, sizes))
+
+def map_node_over_batched_list(obj, input_data_all, func, max_len_input, allow_interrupt=False):
+    """
+    For BATCHABLE_LIST nodes: the list inputs get stacked into one batch, the node is called once
+    and the results are split back into one result per list element.
+    Returns None when the elements can't be stacked (different shapes, lists of other values).
+    """
+    sizes = None
+    batched = {}
+    for k, v in input_data_all.items():
+        if len(v) == 1:
+            batched[k] = v[0]
+            continue
+        if len(v) != max_len_input:
+            return None
+        item_sizes = [batch_item_size(x) for x in v]
+        if None in item_sizes or (sizes is not None and item_sizes != sizes):
+            return None
+        sizes = item_sizes
+        try:
+            batched[k] = concat_batch_items(v)
+        except (RuntimeError, KeyError):
+            return None
+
+    if sizes is None:
+        return None
+
+    if allow_interrupt:
+        nodes.before_node_execution()
+    result = getattr(obj, func)(**batched)
+    if not isinstance(result, tuple):
+        return None
+
+    outputs = []
+    for value in result:
+        split = split_batch_items(value, sizes)
+        if split is None:
+            return None
+        outputs.append(split)
+    return [tuple(o[i] for o in outputs) for i in range(max_len_input)]
+
 def map_node_over_list(obj, input_data_all, func, allow_interrupt=False):
     # check if node wants the lists
     input_is_list = False
@@ -52,6 +134,11 @@ def map_node_over_list(obj, input_data_all, func, allow_interrupt=False):
         max_len_input = 0
     else:
         max_len_input = max([len(x) for x in input_data_all.values()])
+
+    if max_len_input > 1 and not input_is_list and func == getattr(obj, "FUNCTION", None) and getattr(obj, "BATCHABLE_LIST", False):
+        results = map_node_over_batched_list(obj, input_data_all, func, max_len_input, allow_interrupt)
+        if results is not None:
+            return results
      
     # get a slice of inputs, repeat last input when list isn't long enough
     def slice_dict(d, i):
@@ -118,7 +205,11 @@ def format_value(x):
     else:
         return str(x)
 
-def recursive_execute(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui, object_storage):
+def get_unevaluated_lazy_inputs(prompt, unique_id, class_def, outputs):
+    lazy = graph.get_lazy_inputs(class_def)
+    return [x for x, from_id, _ in graph.get_input_links(prompt, unique_id) if x in lazy and from_id not in outputs]
+
+def execute_node(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui, object_storage, profile, pending_inputs):
     unique_id = current_item
     inputs = prompt[unique_id]['inputs']
     class_type = prompt[unique_id]['class_type']
@@ -126,36 +217,45 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
     if unique_id in outputs:
         return (True, None, None)
 
-    for x in inputs:
-        input_data = inputs[x]
-
-        if isinstance(input_data, list):
-            input_unique_id = input_data[0]
-            output_index = input_data[1]
-            if input_unique_id not in outputs:
-                result = recursive_execute(server, prompt, outputs, input_unique_id, extra_data, executed, prompt_id, outputs_ui, object_storage)
-                if result[0] is not True:
-                    # Another node failed further upstream
-                    return result
-
     input_data_all = None
     try:
         input_data_all = get_input_data(inputs, class_def, unique_id, outputs, prompt, extra_data)
-        if server.client_id is not None:
-            server.last_node_id = unique_id
-            server.send_sync("executing", { "node": unique_id, "prompt_id": prompt_id }, server.client_id)
 
         obj = object_storage.get((unique_id, class_type), None)
         if obj is None:
             obj = class_def()
             object_storage[(unique_id, class_type)] = obj
 
-        output_data, output_ui = get_output_data(obj, input_data_all)
+        if hasattr(obj, "check_lazy_status"):
+            # the lazy inputs that weren't evaluated yet are None, the node tells which ones it needs
+            unevaluated = get_unevaluated_lazy_inputs(prompt, unique_id, class_def, outputs)
+            if len(unevaluated) > 0:
+                needed = map_node_over_list(obj, input_data_all, "check_lazy_status", allow_interrupt=True)
+                needed = set(x for r in needed if r is not None for x in r if x in unevaluated)
+                if len(needed) > 0:
+                    pending_inputs[unique_id] = needed
+                    return (True, None, None)
+
+        if server.client_id is not None:
+            server.last_node_id = unique_id
+            server.send_sync("executing", { "node": unique_id, "prompt_id": prompt_id }, server.client_id)
+
+        caching.executing_node.set(unique_id)
+        with output_writer.writer.track() as pending_writes, profiling.NodeProfiler() as profiler:
+            output_data, output_ui = get_output_data(obj, input_data_all)
+        node_profile = profiler.result()
+        profiling.record(profile, unique_id, node_profile)
         outputs[unique_id] = output_data
         if len(output_ui) > 0:
             outputs_ui[unique_id] = output_ui
             if server.client_id is not None:
-                server.send_sync("executed", { "node": unique_id, "output": output_ui, "prompt_id": prompt_id }, server.client_id)
+                # only tell the client about the files once they are written
+                message = { "node": unique_id, "output": output_ui, "prompt_id": prompt_id, "profile": node_profile }
+                client_id = server.client_id
+                def written():
+                    message["output"] = output_writer.remove_failed(output_ui, pending_writes)
+                    server.send_sync("executed", message, client_id)
+                output_writer.when_done(pending_writes, written)
     except comfy.model_management.InterruptProcessingException as iex:
         logging.info("Processing interrupted")
 
@@ -175,7 +275,7 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
                 input_data_formatted[name] = [format_value(x) for x in inputs]
 
         output_data_formatted = {}
-        for node_id, node_outputs in outputs.items():
+        for node_id, node_outputs in list(outputs.items()):
             output_data_formatted[node_id] = [[format_value(x) for x in l] for l in node_outputs]
 
         logging.error("!!! Exception during processing !!!")
@@ -195,84 +295,88 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
 
     return (True, None, None)
 
-def recursive_will_execute(prompt, outputs, current_item):
-    unique_id = current_item
-    inputs = prompt[unique_id]['inputs']
-    will_execute = []
-    if unique_id in outputs:
-        return []
-
-    for x in inputs:
-        input_data = inputs[x]
-        if isinstance(input_data, list):
-            input_unique_id = input_data[0]
-            output_index = input_data[1]
-            if input_unique_id not in outputs:
-                will_execute += recursive_will_execute(prompt, outputs, input_unique_id)
-
-    return will_execute + [unique_id]
+def execute_node_threaded(*args):
+    # inference mode is thread local
+    with torch.inference_mode():
+        return execute_node(*args)
 
-def recursive_output_delete_if_changed(prompt, old_prompt, outputs, current_item):
-    unique_id = current_item
-    inputs = prompt[unique_id]['inputs']
-    class_type = prompt[unique_id]['class_type']
-    class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+def set_is_changed(prompt, unique_id, outputs):
+    class_def = nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]['class_type']]
+    if not hasattr(class_def, 'IS_CHANGED') or 'is_changed' in prompt[unique_id]:
+        return
+    input_data_all = get_input_data(prompt[unique_id]['inputs'], class_def, unique_id, outputs)
+    try:
+        prompt[unique_id]['is_changed'] = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
+    except:
+        # no is_changed: the signature is None and the node always executes
+        pass
+
+def delete_changed_outputs(prompt, old_signatures, outputs):
+    """
+    Computes the signature of every node in a single pass over the graph and deletes the outputs
+    of the nodes whose signature isn't the one they were executed with. Returns the signatures.
+    """
+    signatures = {}
+    for unique_id in graph.topological_order(prompt, prompt.keys()):
+        # computed after the nodes it depends on so their changed outputs are already gone
+        set_is_changed(prompt, unique_id, outputs)
+        signatures[unique_id] = caching.node_signature(prompt, unique_id, signatures)
+
+    for unique_id in prompt:
+        signature = signatures.get(unique_id, None)
+        if unique_id in outputs and (signature is None or old_signatures.get(unique_id, None) != signature):
+            d = outputs.pop(unique_id)
+            del d
+    return signatures
 
-    is_changed_old = ''
-    is_changed = ''
-    to_delete = False
-    if hasattr(class_def, 'IS_CHANGED'):
-        if unique_id in old_prompt and 'is_changed' in old_prompt[unique_id]:
-            is_changed_old = old_prompt[unique_id]['is_changed']
-        if 'is_changed' not in prompt[unique_id]:
-            input_data_all = get_input_data(inputs, class_def, unique_id, outputs)
-            if input_data_all is not None:
-                try:
-                    #is_changed = class_def.IS_CHANGED(**input_data_all)
-                    is_changed = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
-                    prompt[unique_id]['is_changed'] = is_changed
-                except:
-                    to_delete = True
-        else:
-            is_changed = prompt[unique_id]['is_changed']
-
-    if unique_id not in outputs:
-        return True
-
-    if not to_delete:
-        if is_changed != is_changed_old:
-            to_delete = True
-        elif unique_id not in old_prompt:
-            to_delete = True
-        elif inputs == old_prompt[unique_id]['inputs']:
-            for x in inputs:
-                input_data = inputs[x]
-
-                if isinstance(input_data, list):
-                    input_unique_id = input_data[0]
-                    output_index = input_data[1]
-                    if input_unique_id in outputs:
-                        to_delete = recursive_output_delete_if_changed(prompt, old_prompt, outputs, input_unique_id)
-                    else:
-                        to_delete = True
-                    if to_delete:
-                        break
-        else:
-            to_delete = True
+disk_cache = None
+disk_cache_lock = threading.Lock()
 
-    if to_delete:
-        d = outputs.pop(unique_id)
-        del d
-    return to_delete
+def get_disk_cache():
+    # shared by the executors of all the prompt workers
+    global disk_cache
+    with disk_cache_lock:
+        if disk_cache is None and args.cache_spill_directory is not None:
+            disk_cache = caching.DiskCache(args.cache_spill_directory, int(args.cache_spill_size * 1024 * 1024 * 1024))
+        return disk_cache
 
 class PromptExecutor:
     def __init__(self, server):
         self.outputs = {}
         self.object_storage = {}
         self.outputs_ui = {}
-        self.old_prompt = {}
+        self.old_signatures = {}
+        self.profile = {}
+        self.pending_inputs = {}
+        # the output file writes of the last prompt, it is only done once they are finished
+        self.pending_writes = []
+        # number of loader nodes (see scheduling.is_loader) of the last prompt whose models were still loaded
+        self.reused_loads = 0
+        # "success", "error" or "interrupted", how the last prompt ended
+        self.status = "success"
+        self.output_cache = caching.LRUCache(args.cache_lru, disk=get_disk_cache())
+        self.node_pool = None
+        if args.parallel_nodes > 1:
+            self.node_pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel_nodes, thread_name_prefix="node")
         self.server = server
 
+    def finish_threaded_nodes(self, futures, in_flight, plan):
+        failure = None
+        for future in futures:
+            node_id = in_flight.pop(future)
+            success, error, ex = future.result()
+            if success is True:
+                self.finish_node(node_id, plan)
+            elif failure is None:
+                failure = (error, ex)
+        return failure
+
+    def finish_node(self, node_id, plan):
+        if node_id in self.pending_inputs:
+            plan.add_lazy_dependencies(node_id, self.pending_inputs.pop(node_id))
+        else:
+            plan.complete_node(node_id)
+
     def handle_execution_error(self, prompt_id, prompt, current_outputs, executed, error, ex):
         node_id = error["node_id"]
         class_type = prompt[node_id]["class_type"]
@@ -280,6 +384,7 @@ class PromptExecutor:
         # First, send back the status to the frontend depending
         # on the exception type
         if isinstance(ex, comfy.model_management.InterruptProcessingException):
+            self.status = "interrupted"
             mes = {
                 "prompt_id": prompt_id,
                 "node_id": node_id,
@@ -288,6 +393,7 @@ class PromptExecutor:
             }
             self.server.send_sync("execution_interrupted", mes, self.server.client_id)
         else:
+            self.status = "error"
             if self.server.client_id is not None:
                 mes = {
                     "prompt_id": prompt_id,
@@ -308,15 +414,52 @@ class PromptExecutor:
         for o in self.outputs:
             if (o not in current_outputs) and (o not in executed):
                 to_delete += [o]
-                if o in self.old_prompt:
-                    d = self.old_prompt.pop(o)
-                    del d
+                self.old_signatures.pop(o, None)
         for o in to_delete:
             d = self.outputs.pop(o)
             del d
 
+    def execute_coalesced(self, items, followers=None):
+        """
+        Executes queue items that only differ in their coalesced inputs as a single prompt.
+        followers: the items that get the messages of each item, see PromptQueue.get_followers.
+        Returns the outputs_ui of each item.
+        """
+        if followers is None:
+            followers = [[] for x in items]
+        prompts = [x[2] for x in items]
+        prompt = coalescing.merge_prompts(prompts)
+        # only the ui of these nodes has the results of every prompt, the others are the same for all of them
+        batched = coalescing.batched_nodes(prompt, coalescing.get_coalescing_nodes(prompt))
+
+        extra_data = dict(items[0][3])
+        extra_data["coalesced_prompts"] = coalescing.CoalescedValues(prompts)
+        extra_data["coalesced_extra_pnginfo"] = coalescing.CoalescedValues(x[3].get("extra_pnginfo", None) for x in items)
+        extra_data["coalesced_nodes"] = batched
+        server = self.server
+        self.server = coalescing.FanOutServer(server, list(zip(items, followers)), batched)
+        try:
+            self.execute(prompt, items[0][1], extra_data, items[0][4])
+        finally:
+            self.server = server
+
+        outputs_ui = []
+        for i in range(len(items)):
+            outputs_ui.append({k: coalescing.split_ui(v, i, len(items)) if k in batched else v for k, v in self.outputs_ui.items()})
+        return outputs_ui
+
+    def execute_with_followers(self, item, followers):
+        """executes a queue item, its messages also go to the clients of the identical prompts queued with it"""
+        server = self.server
+        self.server = coalescing.FanOutServer(server, [(item, followers)])
+        try:
+            self.execute(item[2], item[1], item[3], item[4])
+        finally:
+            self.server = server
+
     def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
         nodes.interrupt_processing(False)
+        self.status = "success"
 
         if "client_id" in extra_data:
             self.server.client_id = extra_data["client_id"]
@@ -326,7 +469,7 @@ class PromptExecutor:
         if self.server.client_id is not None:
             self.server.send_sync("execution_start", { "prompt_id": prompt_id}, self.server.client_id)
 
-        with torch.inference_mode():
+        with torch.inference_mode(), output_writer.writer.track() as self.pending_writes:
             #delete cached outputs if nodes don't exist for them
             to_delete = []
             for o in self.outputs:
@@ -347,8 +490,20 @@ class PromptExecutor:
                 d = self.object_storage.pop(o)
                 del d
 
-            for x in prompt:
-                recursive_output_delete_if_changed(prompt, self.old_prompt, self.outputs, x)
+            signatures = delete_changed_outputs(prompt, self.old_signatures, self.outputs)
+            caching.prompt_signatures.set((prompt, signatures))
+
+            cache_hits = set()
+            if self.output_cache.enabled():
+                for x in prompt:
+                    if x in self.outputs:
+                        continue
+                    entry = self.output_cache.get(signatures.get(x, None))
+                    if entry is not None:
+                        self.outputs[x] = entry.outputs
+                        if entry.ui is not None:
+                            self.outputs_ui[x] = entry.ui
+                        cache_hits.add(x)
 
             current_outputs = set(self.outputs.keys())
             for x in list(self.outputs_ui.keys()):
@@ -356,36 +511,86 @@ class PromptExecutor:
                     d = self.outputs_ui.pop(x)
                     del d
 
+            self.profile = {x: profiling.cached_result() for x in current_outputs}
+
             comfy.model_management.cleanup_models()
             if self.server.client_id is not None:
                 self.server.send_sync("execution_cached", { "nodes": list(current_outputs) , "prompt_id": prompt_id}, self.server.client_id)
             executed = set()
-            output_node_id = None
-            to_execute = []
+            self.pending_inputs = {}
+            plan = graph.ExecutionPlan(prompt, self.outputs)
+
+            #always execute the output that depends on the least amount of unexecuted nodes first
+            for rank, node_id in enumerate(sorted(execute_outputs, key=lambda a: plan.uncached_dependencies(a))):
+                plan.add_node(node_id, priority=rank)
+
+            in_flight = {}
+            failure = None
+            while not plan.is_empty():
+                try:
+                    node_id = plan.next_node()
+                except graph.DependencyCycleError as ex:
+                    error = {
+                        "node_id": sorted(plan.pending)[0],
+                        "exception_message": str(ex),
+                        "exception_type": full_type_name(type(ex)),
+                        "traceback": [],
+                        "current_inputs": {},
+                        "current_outputs": {},
+                    }
+                    failure = (error, ex)
+                    break
 
-            for node_id in list(execute_outputs):
-                to_execute += [(0, node_id)]
+                if node_id is None:
+                    # everything left is waiting on nodes running on the worker threads
+                    done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    failure = self.finish_threaded_nodes(done, in_flight, plan)
+                    if failure is not None:
+                        break
+                    continue
 
-            while len(to_execute) > 0:
-                #always execute the output that depends on the least amount of unexecuted nodes first
-                to_execute = sorted(list(map(lambda a: (len(recursive_will_execute(prompt, self.outputs, a[-1])), a[-1]), to_execute)))
-                output_node_id = to_execute.pop(0)[-1]
+                class_def = nodes.NODE_CLASS_MAPPINGS[prompt[node_id]['class_type']]
+                if self.node_pool is not None and getattr(class_def, "THREAD_SAFE", False):
+                    # the device and server state of the prompt worker are context variables
+                    future = self.node_pool.submit(contextvars.copy_context().run, execute_node_threaded, self.server, prompt, self.outputs, node_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage, self.profile, self.pending_inputs)
+                    in_flight[future] = node_id
+                    continue
 
                 # This call shouldn't raise anything if there's an error deep in
                 # the actual SD code, instead it will report the node where the
                 # error was raised
-                success, error, ex = recursive_execute(self.server, prompt, self.outputs, output_node_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage)
+                success, error, ex = execute_node(self.server, prompt, self.outputs, node_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage, self.profile, self.pending_inputs)
                 if success is not True:
-                    self.handle_execution_error(prompt_id, prompt, current_outputs, executed, error, ex)
+                    failure = (error, ex)
+                    break
+                self.finish_node(node_id, plan)
+
+                failure = self.finish_threaded_nodes([f for f in in_flight if f.done()], in_flight, plan)
+                if failure is not None:
                     break
 
+            if len(in_flight) > 0:
+                # nodes that already started can't be cancelled, wait for them before reporting anything
+                concurrent.futures.wait(in_flight)
+                threaded_failure = self.finish_threaded_nodes(list(in_flight), in_flight, plan)
+                if failure is None:
+                    failure = threaded_failure
+
+            if failure is not None:
+                self.handle_execution_error(prompt_id, prompt, current_outputs, executed, *failure)
+
             for x in executed:
-                self.old_prompt[x] = copy.deepcopy(prompt[x])
+                output_types = nodes.NODE_CLASS_MAPPINGS[prompt[x]['class_type']].RETURN_TYPES
+                self.output_cache.set(signatures.get(x, None), caching.CacheEntry(self.outputs[x], self.outputs_ui.get(x, None), output_types))
+
+            for x in executed | cache_hits:
+                self.old_signatures[x] = signatures.get(x, None)
+            self.reused_loads = len([x for x in current_outputs if x in prompt and scheduling.is_loader(nodes.NODE_CLASS_MAPPINGS[prompt[x]['class_type']])])
             self.server.last_node_id = None
 
 
 
-def validate_inputs(prompt, item, validated):
+def validate_inputs(prompt, item, validated, validation_keys={}):
     unique_id = item
     if unique_id in validated:
         return validated[unique_id]
@@ -394,9 +599,30 @@ def validate_inputs(prompt, item, validated):
     class_type = prompt[unique_id]['class_type']
     obj_class = nodes.NODE_CLASS_MAPPINGS[class_type]
 
-    class_inputs = obj_class.INPUT_TYPES()
+    class_inputs = schema.get_input_types(obj_class)
     required_inputs = class_inputs['required']
 
+    key = validation_keys.get(unique_id, None)
+    converted = validation.cache.get(key)
+    if converted is not None:
+        # the same sub-graph passed validation before, only the converted values and the linked nodes need updating
+        inputs.update(converted)
+        linked_valid = True
+        for x in required_inputs:
+            if isinstance(inputs.get(x, None), list):
+                try:
+                    r = validate_inputs(prompt, inputs[x][0], validated, validation_keys)
+                except Exception:
+                    r = (False,)
+                if r[0] is False:
+                    linked_valid = False
+                    break
+        if linked_valid:
+            ret = (True, [], unique_id)
+            validated[unique_id] = ret
+            return ret
+        # a linked node that isn't memoized anymore fails now, the full validation below reports it
+
     errors = []
     valid = True
 
@@ -451,7 +677,7 @@ def validate_inputs(prompt, item, validated):
                 errors.append(error)
                 continue
             try:
-                r = validate_inputs(prompt, o_id, validated)
+                r = validate_inputs(prompt, o_id, validated, validation_keys)
                 if r[0] is False:
                     # `r` will be set in `validated[o_id]` already
                     valid = False
@@ -582,6 +808,7 @@ def validate_inputs(prompt, item, validated):
         ret = (False, errors, unique_id)
     else:
         ret = (True, [], unique_id)
+        validation.cache.set(key, {x: inputs[x] for x in required_inputs if not isinstance(inputs[x], list)})
 
     validated[unique_id] = ret
     return ret
@@ -612,11 +839,12 @@ def validate_prompt(prompt):
     errors = []
     node_errors = {}
     validated = {}
+    validation_keys = validation.compute_validation_keys(prompt)
     for o in outputs:
         valid = False
         reasons = []
         try:
-            m = validate_inputs(prompt, o, validated)
+            m = validate_inputs(prompt, o, validated, validation_keys)
             valid = m[0]
             reasons = m[1]
         except Exception as ex:
@@ -684,97 +912,350 @@ def validate_prompt(prompt):
 MAXIMUM_HISTORY_SIZE = 10000
 
 class PromptQueue:
-    def __init__(self, server):
+    def __init__(self, server, store=None):
         self.server = server
         self.mutex = threading.RLock()
         self.not_empty = threading.Condition(self.mutex)
         self.task_counter = 0
-        self.queue = []
+        # pending items, per priority class and client
+        self.scheduler = scheduling.FairScheduler()
+        for client_id, weight in args.client_weights:
+            self.scheduler.set_weight(client_id, weight)
         self.currently_running = {}
-        self.history = {}
+        self.history = history.History(MAXIMUM_HISTORY_SIZE)
+        self.coalesce_keys = {}
+        # bumped on every change of the queue, the snapshot and its json are reused until then
+        self.version = 0
+        self.snapshot = None
+        self.snapshot_json = None
+        # estimated cost of the pending and running prompts by prompt_id
+        self.costs = {}
+        self.outstanding_cost = 0.0
+        self.cost_model = cost.CostModel()
+        # loader nodes reused by the prompts that ran early because their models were loaded (--model-affinity)
+        self.loads_avoided = 0
+        # --dedupe-prompts: dedupe key -> prompt_id of the pending or running prompt with it, the identical
+        # prompts queued after it are its followers, they are executed with it and finish with its outputs
+        self.dedupe_keys = {}
+        self.leader_keys = {}
+        self.followers = {}
+        self.follower_ids = {}
+        # optional SQLiteQueueStore, the history is only kept in it when there is one
+        self.store = store
         server.prompt_queue = self
 
+    @property
+    def queue(self):
+        # the pending items in the order they were queued
+        return sorted(list(self.scheduler) + self.pending_followers())
+
+    def pending_followers(self):
+        return [x for f in self.followers.values() for x in f if x[1] not in self.follower_ids]
+
+    def queue_changed(self):
+        self.version += 1
+        self.snapshot = None
+        self.server.queue_updated()
+
+    def recover(self):
+        """queues the items left in the store by the previous run, call once the nodes are loaded"""
+        if self.store is None:
+            return 0
+        count = 0
+        for item, attempts in self.store.pending_items():
+            if attempts >= queue_store.MAX_ATTEMPTS:
+                logging.warning("Not queueing prompt {} again, the server stopped the {} times it was executing it".format(item[1], attempts))
+                self.store.add_history(item[1], { "prompt": item, "outputs": {}, "profile": {},
+                                                  "status": { "status_str": "error", "completed": False } })
+                continue
+            valid = validate_prompt(item[2])
+            if valid[0]:
+                self.put(item)
+                self.server.number = max(self.server.number, int(item[0]) + 1)
+                count += 1
+            else:
+                logging.warning("Dropping queued prompt {} that isn't valid anymore: {}".format(item[1], valid[1]))
+                self.store.remove_pending(item[1])
+        return count
+
     def put(self, item):
+        coalesce_key = None
+        if args.coalesce_prompts > 1:
+            coalesce_key = coalescing.structure_key(item[2], item[4])
+        dedupe_key = None
+        if args.dedupe_prompts:
+            dedupe_key = coalescing.dedupe_key(item)
+        prompt_cost = cost.estimate(item[2])
         with self.mutex:
-            heapq.heappush(self.queue, item)
-            self.server.queue_updated()
+            if self.store is not None:
+                self.store.add_pending(item)
+            leader = self.dedupe_keys.get(dedupe_key, None)
+            if leader is not None:
+                self.followers[leader].append(item)
+                if leader not in self.scheduler:
+                    # the leader is already running
+                    self.start_follower(item)
+                self.queue_changed()
+                return
+            if dedupe_key is not None:
+                self.dedupe_keys[dedupe_key] = item[1]
+                self.leader_keys[item[1]] = dedupe_key
+                self.followers[item[1]] = []
+            self.forget_cost(item[1])
+            self.costs[item[1]] = prompt_cost
+            self.outstanding_cost += prompt_cost
+            if coalesce_key is not None:
+                self.coalesce_keys[item[1]] = coalesce_key
+            self.scheduler.put(item)
+            self.queue_changed()
             self.not_empty.notify()
 
-    def get(self, timeout=None):
+    def get(self, timeout=None, resident=None):
+        """resident: the model_keys of the models loaded by the worker, used with --model-affinity"""
         with self.not_empty:
-            while len(self.queue) == 0:
+            while len(self.scheduler) == 0:
                 self.not_empty.wait(timeout=timeout)
-                if timeout is not None and len(self.queue) == 0:
+                if timeout is not None and len(self.scheduler) == 0:
                     return None
-            item = heapq.heappop(self.queue)
-            i = self.task_counter
-            self.currently_running[i] = copy.deepcopy(item)
-            self.task_counter += 1
-            self.server.queue_updated()
-            return (item, i)
-
-    def task_done(self, item_id, outputs):
+            item = self.scheduler.pop(resident, args.model_affinity)
+            i = self.start(item)
+            self.queue_changed()
+            # the executor gets its own copy, it adds is_changed to the nodes
+            return (copy.deepcopy(item), i)
+
+    def start(self, item):
+        # marks an item taken from the scheduler as running, returns its item_id
+        if self.store is not None:
+            self.store.set_running(item[1])
+        i = self.task_counter
+        self.currently_running[i] = item
+        self.task_counter += 1
+        for x in self.followers.get(item[1], []):
+            self.start_follower(x)
+        return i
+
+    def start_follower(self, item):
+        self.follower_ids[item[1]] = self.start(item)
+
+    def get_followers(self, prompt_id):
+        """
+        The items executed with the prompt, to send them its messages. The list is extended
+        while the prompt runs when identical prompts get queued.
+        """
+        with self.mutex:
+            return self.followers.get(prompt_id, [])
+
+    def get_leader(self, prompt_id):
+        """the prompt_id of the prompt an identical prompt is executed with, prompt_id if it isn't a follower"""
+        with self.mutex:
+            for leader, followers in self.followers.items():
+                if any(x[1] == prompt_id for x in followers):
+                    return leader
+            return prompt_id
+
+    def take_coalescable(self, item, max_items):
+        """
+        Removes up to max_items pending items that can be coalesced with item from the queue
+        and marks them as running. Returns a list of (item, item_id).
+        """
+        with self.mutex:
+            key = self.coalesce_keys.pop(item[1], None)
+            if key is None or max_items <= 0:
+                return []
+            matches = sorted(x for x in self.scheduler if self.coalesce_keys.get(x[1], None) == key)[:max_items]
+            if len(matches) == 0:
+                return []
+
+            out = []
+            for x in matches:
+                self.scheduler.remove(x)
+                self.coalesce_keys.pop(x[1], None)
+                out.append((copy.deepcopy(x), self.start(x)))
+            self.queue_changed()
+            return out
+
+    def task_done(self, item_id, outputs, profile={}, status="success"):
+        """
+        Adds the prompt to the history, its followers finish with the same outputs.
+        Returns the items that finished.
+        """
         with self.mutex:
             prompt = self.currently_running.pop(item_id)
-            if len(self.history) > MAXIMUM_HISTORY_SIZE:
-                self.history.pop(next(iter(self.history)))
-            self.history[prompt[1]] = { "prompt": prompt, "outputs": {} }
-            for o in outputs:
-                self.history[prompt[1]]["outputs"][o] = outputs[o]
-            self.server.queue_updated()
+            self.forget_cost(prompt[1])
+            key = self.leader_keys.pop(prompt[1], None)
+            if key is not None:
+                self.dedupe_keys.pop(key, None)
+            finished = [prompt]
+            for x in self.followers.pop(prompt[1], []):
+                finished.append(self.currently_running.pop(self.follower_ids.pop(x[1])))
+            for x in finished:
+                entry = { "prompt": x, "outputs": {}, "profile": profile,
+                          "status": { "status_str": status, "completed": status == "success" } }
+                for o in outputs:
+                    entry["outputs"][o] = outputs[o]
+                if self.store is not None:
+                    self.store.add_history(x[1], entry)
+                else:
+                    self.history.add(x[1], entry)
+            self.queue_changed()
+            return finished
 
     def get_current_queue(self):
+        """
+        Returns (running, pending). Queued items are never modified (get and take_coalescable hand the executor
+        a copy) so the lists share them with the queue and are reused until it changes, they must not be modified.
+        """
         with self.mutex:
-            out = []
-            for x in self.currently_running.values():
-                out += [x]
-            return (out, copy.deepcopy(self.queue))
+            if self.snapshot is None:
+                self.snapshot = (list(self.currently_running.values()), self.queue)
+            return self.snapshot
+
+    def get_current_queue_json(self):
+        """returns (version, json of the /queue response), the json is only built once per version"""
+        with self.mutex:
+            version = self.version
+            cached = self.snapshot_json
+            if cached is not None and cached[0] == version:
+                return cached
+            running, pending = self.get_current_queue()
+        # serialized without holding the lock, the snapshot doesn't change
+        cached = (version, json.dumps({"queue_running": running, "queue_pending": pending}, default=str))
+        with self.mutex:
+            if self.version == version:
+                self.snapshot_json = cached
+        return cached
 
     def get_tasks_remaining(self):
         with self.mutex:
-            return len(self.queue) + len(self.currently_running)
+            return len(self.scheduler) + len(self.pending_followers()) + len(self.currently_running)
+
+    def forget_cost(self, prompt_id):
+        self.outstanding_cost -= self.costs.pop(prompt_id, 0.0)
+
+    def record_execution(self, prompt_ids, seconds, reused_loads=0):
+        """
+        calibrates the cost model with the time it took to execute these prompts. reused_loads: the loader nodes
+        whose models were still loaded, they count as avoided loads when the prompts were run early for them.
+        """
+        with self.mutex:
+            self.cost_model.observe(sum(self.costs.get(x, 0.0) for x in prompt_ids), seconds)
+            if any(x in self.scheduler.affinity_picks for x in prompt_ids):
+                self.loads_avoided += reused_loads
+            self.scheduler.affinity_picks.difference_update(prompt_ids)
+
+    def estimated_drain_time(self, workers=1):
+        with self.mutex:
+            return self.cost_model.seconds(max(self.outstanding_cost, 0.0)) / workers
+
+    def over_budget(self, prompt, budget, workers=1):
+        """
+        None if a prompt can be queued without the estimated time to execute the queue going over budget seconds,
+        otherwise the estimated number of seconds before it can. A prompt is always accepted by an empty queue.
+        """
+        seconds = self.cost_model.seconds(cost.estimate(prompt)) / workers
+        with self.mutex:
+            if len(self.costs) == 0:
+                return None
+            total = self.estimated_drain_time(workers) + seconds
+        if total <= budget:
+            return None
+        return max(math.ceil(total - budget), 1)
+
+    def get_class_status(self):
+        with self.mutex:
+            return self.scheduler.status()
+
+    def get_affinity_status(self):
+        with self.mutex:
+            return {"reordered": self.scheduler.reordered, "loads_avoided": self.loads_avoided}
 
     def wipe_queue(self):
         with self.mutex:
-            self.queue = []
-            self.server.queue_updated()
+            for x in self.scheduler:
+                self.forget_cost(x[1])
+                self.forget_leader(x[1])
+            self.scheduler.clear()
+            self.coalesce_keys = {}
+            if self.store is not None:
+                self.store.wipe_pending()
+            self.queue_changed()
 
     def delete_queue_item(self, function):
         with self.mutex:
-            for x in range(len(self.queue)):
-                if function(self.queue[x]):
-                    if len(self.queue) == 1:
-                        self.wipe_queue()
-                    else:
-                        self.queue.pop(x)
-                        heapq.heapify(self.queue)
-                    self.server.queue_updated()
+            for x in self.queue:
+                if function(x):
+                    self.coalesce_keys.pop(x[1], None)
+                    if self.store is not None:
+                        self.store.remove_pending(x[1])
+                    for followers in self.followers.values():
+                        if x in followers:
+                            followers.remove(x)
+                            self.queue_changed()
+                            return True
+                    self.scheduler.remove(x)
+                    self.forget_cost(x[1])
+                    followers = self.forget_leader(x[1])
+                    if len(followers) > 0:
+                        # the first follower takes its place
+                        self.put(followers[0])
+                        for f in followers[1:]:
+                            self.followers[followers[0][1]].append(f)
+                    self.queue_changed()
                     return True
         return False
 
+    def forget_leader(self, prompt_id):
+        # returns the followers of a pending prompt that gets removed
+        key = self.leader_keys.pop(prompt_id, None)
+        if key is not None:
+            self.dedupe_keys.pop(key, None)
+        return self.followers.pop(prompt_id, [])
+
     def get_history(self, prompt_id=None, max_items=None, offset=-1):
+        if self.store is not None:
+            if prompt_id is None:
+                return self.store.get_history_page(max_items, offset)
+            entry = self.store.get_history(prompt_id)
+            return {} if entry is None else {prompt_id: entry}
+
         with self.mutex:
             if prompt_id is None:
-                out = {}
-                i = 0
-                if offset < 0 and max_items is not None:
-                    offset = len(self.history) - max_items
-                for k in self.history:
-                    if i >= offset:
-                        out[k] = self.history[k]
-                        if max_items is not None and len(out) >= max_items:
-                            break
-                    i += 1
-                return out
+                return {x.prompt_id: x.entry for x in self.history.page(max_items, offset)}
             elif prompt_id in self.history:
                 return {prompt_id: copy.deepcopy(self.history[prompt_id])}
             else:
                 return {}
 
+    def get_history_json(self, prompt_id=None, max_items=None, offset=-1, after=None, client_id=None, status=None):
+        """
+        Same as get_history but returns the serialized json of the page with the cursor of its last entry (or after if it's empty),
+        pass it as after to get the entries that were added since. Every entry is only serialized once.
+        """
+        if self.store is not None:
+            if prompt_id is None:
+                entries, cursor = self.store.get_history_json(max_items, offset, after, client_id, status)
+            else:
+                entries, cursor = self.store.get_history_json_item(prompt_id), None
+            return history.serialize_page(entries), cursor if cursor is not None else after
+
+        with self.mutex:
+            if prompt_id is None:
+                items = self.history.page(max_items, offset, after, client_id, status)
+            else:
+                item = self.history.get_item(prompt_id)
+                items = [] if item is None else [item]
+            cursor = items[-1].cursor if len(items) > 0 else after
+            entries = [(x.prompt_id, x.json()) for x in items]
+        return history.serialize_page(entries), cursor
+
     def wipe_history(self):
         with self.mutex:
-            self.history = {}
+            self.history.wipe()
+            if self.store is not None:
+                self.store.wipe_history()
 
     def delete_history_item(self, id_to_delete):
         with self.mutex:
-            self.history.pop(id_to_delete, None)
+            self.history.delete(id_to_delete)
+            if self.store is not None:
+                self.store.delete_history(id_to_delete)
@@ -1,5 +1,7 @@
 import os
 import time
+import threading
+import contextlib
 
 supported_pt_extensions = set(['.ckpt', '.pt', '.bin', '.pth', '.safetensors'])
 
@@ -36,6 +38,11 @@ temp_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "temp
 input_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "input")
 
 filename_list_cache = {}
+file_list_cache = {}
+
+# incremented every time folders change in a way the mtime checks might not catch right away
+change_counter = 0
+dependency_tracker = threading.local()
 
 if not os.path.exists(input_directory):
     try:
@@ -46,14 +53,17 @@ if not os.path.exists(input_directory):
 def set_output_directory(output_dir):
     global output_directory
     output_directory = output_dir
+    notify_changed()
 
 def set_temp_directory(temp_dir):
     global temp_directory
     temp_directory = temp_dir
+    notify_changed()
 
 def set_input_directory(input_dir):
     global input_directory
     input_directory = input_dir
+    notify_changed()
 
 def get_output_directory():
     global output_directory
@@ -125,6 +135,7 @@ def add_model_folder_path(folder_name, full_folder_path):
         folder_names_and_paths[folder_name][0].append(full_folder_path)
     else:
         folder_names_and_paths[folder_name] = ([full_folder_path], set())
+    notify_changed()
 
 def get_folder_paths(folder_name):
     return folder_names_and_paths[folder_name][0][:]
@@ -206,8 +217,69 @@ def get_filename_list(folder_name):
         out = get_filename_list_(folder_name)
         global filename_list_cache
         filename_list_cache[folder_name] = out
+    track_dependency(("folder", folder_name))
+    return list(out[0])
+
+def cached_file_list_(directory):
+    if directory not in file_list_cache:
+        return None
+    out = file_list_cache[directory]
+    if time.perf_counter() < (out[2] + 0.5):
+        return out
+    if not os.path.isdir(directory) or os.path.getmtime(directory) != out[1]:
+        return None
+    return out
+
+def get_file_list(directory):
+    """the files directly in directory (not in its subfolders), cached until the mtime of the directory changes"""
+    out = cached_file_list_(directory)
+    if out is None:
+        files = []
+        mtime = None
+        if os.path.isdir(directory):
+            mtime = os.path.getmtime(directory)
+            files = [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
+        out = (files, mtime, time.perf_counter())
+        file_list_cache[directory] = out
+    track_dependency(("directory", directory))
     return list(out[0])
 
+def notify_directory_changed(directory):
+    """call after adding or removing files in directory, only its cached file list (see get_file_list) is refreshed"""
+    directory = os.path.normpath(directory)
+    for x in list(file_list_cache):
+        if os.path.normpath(x) == directory:
+            file_list_cache.pop(x, None)
+
+def notify_changed():
+    """call after adding or removing files so the cached file lists and the node schemas using them get refreshed"""
+    global change_counter
+    filename_list_cache.clear()
+    file_list_cache.clear()
+    change_counter += 1
+
+@contextlib.contextmanager
+def track_dependencies():
+    """collects the file lists used in the block, see dependency_state"""
+    previous = getattr(dependency_tracker, "used", None)
+    dependency_tracker.used = set()
+    try:
+        yield dependency_tracker.used
+    finally:
+        dependency_tracker.used = previous
+
+def track_dependency(key):
+    used = getattr(dependency_tracker, "used", None)
+    if used is not None:
+        used.add(key)
+
+def dependency_state(key):
+    # the cached list for key, a different object (or None) means the list changed
+    kind, name = key
+    if kind == "folder":
+        return cached_filename_list_(name)
+    return cached_file_list_(name)
+
 def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0):
     def map_filename(filename):
         prefix_len = len(os.path.basename(filename_prefix))
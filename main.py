@@ -49,6 +49,7 @@ execute_prestartup_script()
 # Main code
 import asyncio
 import itertools
+import functools
 import shutil
 import threading
 import gc
@@ -71,10 +72,14 @@ if __name__ == "__main__":
     import cuda_malloc
 
 import comfy.utils
+import torch
 import yaml
 
 import execution
 import server
+from comfy_execution.queue_store import SQLiteQueueStore
+from comfy_execution import scheduling
+from comfy_execution import output_writer
 from server import BinaryEventTypes
 from nodes import init_custom_nodes
 import comfy.model_management
@@ -90,27 +95,65 @@ def cuda_malloc_warning():
         if cuda_malloc_warning:
             print("\nWARNING: this card most likely does not support cuda-malloc, if you get \"CUDA error\" please run ComfyUI with: --disable-cuda-malloc\n")
 
-def prompt_worker(q, server):
+def get_worker_devices():
+    if args.worker_devices is not None:
+        devices = [torch.device(x.strip()) for x in args.worker_devices.split(",") if len(x.strip()) > 0]
+    else:
+        devices = [None] * max(args.workers, 1)
+
+    # every worker has its own list of loaded models and can only free the ones it loaded itself,
+    # several workers on the same accelerator would run it out of memory
+    keys = [(d.type, d.index or 0) for d in (x or comfy.model_management.get_torch_device() for x in devices)]
+    shared = sorted(set(k for k in keys if k[0] != "cpu" and keys.count(k) > 1))
+    if len(shared) > 0:
+        print("ERROR: several prompt workers on the same device: {}. Use --worker-devices with a different accelerator for every worker, only cpu workers can share a device.".format(", ".join("{}:{}".format(*k) for k in shared)))
+        exit(1)
+    return devices
+
+def prompt_worker(q, server, index=0, device=None):
+    server.set_current_worker(index)
+    if device is not None or index > 0:
+        # the first worker keeps using the global model state so nothing changes with a single worker
+        comfy.model_management.set_worker_device(device or comfy.model_management.get_torch_device(), own_loaded_models=index > 0)
+    worker = server.worker_state()
+    if worker.interrupt_flag is not None:
+        comfy.model_management.set_worker_interrupt(worker.interrupt_flag)
     e = execution.PromptExecutor(server)
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
+    # models of the last prompt, still loaded when the next one starts
+    resident = None
 
     while True:
         timeout = None
         if need_gc:
             timeout = max(gc_collect_interval - (current_time - last_gc_collect), 0.0)
 
-        queue_item = q.get(timeout=timeout)
+        queue_item = q.get(timeout=timeout, resident=resident)
         if queue_item is not None:
             item, item_id = queue_item
             execution_start_time = time.perf_counter()
-            prompt_id = item[1]
-            e.execute(item[2], prompt_id, item[3], item[4])
+            items = [queue_item] + q.take_coalescable(item, args.coalesce_prompts - 1)
+            worker.running = [x[0][1] for x in items]
+            server.queue_updated()
+            followers = [q.get_followers(x[0][1]) for x in items]
+            if len(items) > 1:
+                print("Coalesced {} prompts".format(len(items)))
+                outputs_ui = e.execute_coalesced([x[0] for x in items], followers)
+            elif args.dedupe_prompts:
+                e.execute_with_followers(item, followers[0])
+                outputs_ui = [dict(e.outputs_ui)]
+            else:
+                e.execute(item[2], item[1], item[3], item[4])
+                outputs_ui = [dict(e.outputs_ui)]
             need_gc = True
-            q.task_done(item_id, e.outputs_ui)
-            if server.client_id is not None:
-                server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, server.client_id)
+            q.record_execution([x[0][1] for x in items], time.perf_counter() - execution_start_time, e.reused_loads)
+            if args.model_affinity > 0:
+                resident = scheduling.model_keys(item[2])
+            worker.running = []
+            # the prompt is done once its output files are written, the next one can start meanwhile
+            output_writer.when_done(e.pending_writes, functools.partial(prompt_done, q, server, items, outputs_ui, e.profile, e.status, e.pending_writes))
 
             current_time = time.perf_counter()
             execution_time = current_time - execution_start_time
@@ -124,6 +167,14 @@ def prompt_worker(q, server):
                 last_gc_collect = current_time
                 need_gc = False
 
+def prompt_done(q, server, items, outputs_ui, profile, status, writes):
+    for (item, item_id), ui in zip(items, outputs_ui):
+        ui = {k: output_writer.remove_failed(v, writes) for k, v in ui.items()}
+        for x in q.task_done(item_id, ui, profile, status):
+            client_id = x[3].get("client_id", None)
+            if client_id is not None:
+                server.send_sync("executing", { "node": None, "prompt_id": x[1] }, client_id)
+
 async def run(server, address='', port=8188, verbose=True, call_on_start=None):
     await asyncio.gather(server.start(address, port, verbose, call_on_start), server.publish_loop())
 
@@ -174,7 +225,10 @@ if __name__ == "__main__":
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     server = server.PromptServer(loop)
-    q = execution.PromptQueue(server)
+    queue_store = None
+    if args.queue_database is not None:
+        queue_store = SQLiteQueueStore(args.queue_database, execution.MAXIMUM_HISTORY_SIZE)
+    q = execution.PromptQueue(server, queue_store)
 
     extra_model_paths_config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "extra_model_paths.yaml")
     if os.path.isfile(extra_model_paths_config_path):
@@ -186,12 +240,21 @@ if __name__ == "__main__":
 
     init_custom_nodes()
 
+    recovered = q.recover()
+    if recovered > 0:
+        print("Recovered {} queued prompts from {}".format(recovered, args.queue_database))
+
     cuda_malloc_warning()
 
     server.add_routes()
     hijack_progress(server)
 
-    threading.Thread(target=prompt_worker, daemon=True, args=(q, server,)).start()
+    worker_devices = get_worker_devices()
+    server.set_workers(worker_devices)
+    for i, device in enumerate(worker_devices):
+        if len(worker_devices) > 1:
+            print("Starting prompt worker {} on device: {}".format(i, device or comfy.model_management.get_torch_device()))
+        threading.Thread(target=prompt_worker, daemon=True, args=(q, server, i, device)).start()
 
     if args.output_directory:
         output_dir = os.path.abspath(args.output_directory)
@@ -8,6 +8,7 @@ import traceback
 import math
 import time
 import random
+import threading
 
 from PIL import Image, ImageOps, ImageSequence
 from PIL.PngImagePlugin import PngInfo
@@ -28,6 +29,9 @@ import comfy.clip_vision
 
 import comfy.model_management
 from comfy.cli_args import args
+from comfy_execution import output_writer
+from comfy_execution import coalescing
+from comfy_execution import caching
 
 import importlib
 
@@ -50,12 +54,28 @@ class CLIPTextEncode:
     FUNCTION = "encode"
 
     CATEGORY = "conditioning"
+    COALESCE_INPUTS = ("text",)
 
     def encode(self, clip, text):
+        if isinstance(text, coalescing.CoalescedValues):
+            return self.encode_coalesced(clip, text)
         tokens = clip.tokenize(text)
         cond, pooled = clip.encode_from_tokens(tokens, return_pooled=True)
         return ([[cond, {"pooled_output": pooled}]], )
 
+    def encode_coalesced(self, clip, texts):
+        # one batch entry per coalesced prompt, only encode once if they all have the same text
+        if len(set(texts)) == 1:
+            return self.encode(clip, texts[0])
+        conds = []
+        pooled = []
+        for text in texts:
+            c, p = clip.encode_from_tokens(clip.tokenize(text), return_pooled=True)
+            conds.append(c)
+            pooled.append(p)
+        cond, pooled = coalescing.concat_conditioning(conds, pooled)
+        return ([[cond, {"pooled_output": pooled}]], )
+
 class ConditioningCombine:
     @classmethod
     def INPUT_TYPES(s):
@@ -262,6 +282,8 @@ class VAEDecode:
     FUNCTION = "decode"
 
     CATEGORY = "latent"
+    BATCH_INDEPENDENT = True
+    BATCHABLE_LIST = True
 
     def decode(self, vae, samples):
         return (vae.decode(samples["samples"]), )
@@ -276,6 +298,8 @@ class VAEDecodeTiled:
     FUNCTION = "decode"
 
     CATEGORY = "_for_testing"
+    BATCH_INDEPENDENT = True
+    BATCHABLE_LIST = True
 
     def decode(self, vae, samples, tile_size):
         return (vae.decode_tiled(samples["samples"], tile_x=tile_size // 8, tile_y=tile_size // 8, ), )
@@ -288,6 +312,7 @@ class VAEEncode:
     FUNCTION = "encode"
 
     CATEGORY = "latent"
+    BATCHABLE_LIST = True
 
     @staticmethod
     def vae_encode_crop_pixels(pixels):
@@ -414,7 +439,7 @@ class LoadLatent:
     @classmethod
     def INPUT_TYPES(s):
         input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f)) and f.endswith(".latent")]
+        files = [f for f in folder_paths.get_file_list(input_dir) if f.endswith(".latent")]
         return {"required": {"latent": [sorted(files), ]}, }
 
     CATEGORY = "_for_testing"
@@ -1037,6 +1062,8 @@ class LatentUpscale:
     FUNCTION = "upscale"
 
     CATEGORY = "latent"
+    BATCH_INDEPENDENT = True
+    BATCHABLE_LIST = True
 
     def upscale(self, samples, upscale_method, width, height, crop):
         if width == 0 and height == 0:
@@ -1068,6 +1095,8 @@ class LatentUpscaleBy:
     FUNCTION = "upscale"
 
     CATEGORY = "latent"
+    BATCH_INDEPENDENT = True
+    BATCHABLE_LIST = True
 
     def upscale(self, samples, upscale_method, scale_by):
         s = samples.copy()
@@ -1253,22 +1282,42 @@ class SetLatentNoiseMask:
         return (s,)
 
 def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent, denoise=1.0, disable_noise=False, start_step=None, last_step=None, force_full_denoise=False):
+    seeds = [seed]
+    item_latent = latent
+    if isinstance(seed, coalescing.CoalescedValues):
+        # coalesced prompts: the latent is repeated for every prompt and each one gets the noise of its own seed
+        seeds = list(seed)
+        seed = seeds[0]
+        positive = coalescing.expand_conditioning(positive, len(seeds), latent["samples"].shape[0])
+        negative = coalescing.expand_conditioning(negative, len(seeds), latent["samples"].shape[0])
+        latent = coalescing.repeat_latent(latent, len(seeds))
+
     latent_image = latent["samples"]
     if disable_noise:
         noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
     else:
-        batch_inds = latent["batch_index"] if "batch_index" in latent else None
-        noise = comfy.sample.prepare_noise(latent_image, seed, batch_inds)
+        batch_inds = item_latent["batch_index"] if "batch_index" in item_latent else None
+        noise = torch.cat([comfy.sample.prepare_noise(item_latent["samples"], s, batch_inds) for s in seeds])
 
     noise_mask = None
     if "noise_mask" in latent:
         noise_mask = latent["noise_mask"]
 
+    checkpoint_key = None
+    if args.sampler_checkpoint_directory is not None:
+        # steps and the start/end steps aren't part of the key: runs continuing the same schedule resume from each other
+        signature = caching.executing_node_signature(ignore_inputs=("steps", "start_at_step", "end_at_step"))
+        if signature is not None:
+            checkpoint_key = caching.hash_value([signature, caching.tensor_hash(latent_image), caching.canonical_value(seeds),
+                                                 cfg, sampler_name, scheduler, denoise, disable_noise,
+                                                 None if noise_mask is None else caching.tensor_hash(noise_mask)])
+
     callback = latent_preview.prepare_callback(model, steps)
     disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
     samples = comfy.sample.sample(model, noise, steps, cfg, sampler_name, scheduler, positive, negative, latent_image,
                                   denoise=denoise, disable_noise=disable_noise, start_step=start_step, last_step=last_step,
-                                  force_full_denoise=force_full_denoise, noise_mask=noise_mask, callback=callback, disable_pbar=disable_pbar, seed=seed)
+                                  force_full_denoise=force_full_denoise, noise_mask=noise_mask, callback=callback, disable_pbar=disable_pbar, seed=seed,
+                                  checkpoint_key=checkpoint_key)
     out = latent.copy()
     out["samples"] = samples
     return (out, )
@@ -1294,6 +1343,7 @@ class KSampler:
     FUNCTION = "sample"
 
     CATEGORY = "sampling"
+    COALESCE_INPUTS = ("seed",)
 
     def sample(self, model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=1.0):
         return common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise)
@@ -1322,6 +1372,7 @@ class KSamplerAdvanced:
     FUNCTION = "sample"
 
     CATEGORY = "sampling"
+    COALESCE_INPUTS = ("noise_seed",)
 
     def sample(self, model, add_noise, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, start_at_step, end_at_step, return_with_leftover_noise, denoise=1.0):
         force_full_denoise = True
@@ -1353,34 +1404,57 @@ class SaveImage:
     OUTPUT_NODE = True
 
     CATEGORY = "image"
+    BATCH_INDEPENDENT = True
+    COALESCED_METADATA = True
+    THREAD_SAFE = True
+
+    # the file counter is found by scanning the output folder so two nodes can't pick file names at the same time
+    save_lock = threading.Lock()
 
     def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
         filename_prefix += self.prefix_append
-        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
+        # coalesced prompts: the images of each prompt follow each other and get the metadata of their prompt
+        count = len(prompt) if isinstance(prompt, coalescing.CoalescedValues) else 1
+        metadata = [None] * count
+        if not args.disable_metadata:
+            for i in range(count):
+                metadata[i] = self.png_metadata(coalescing.item_value(prompt, i), coalescing.item_value(extra_pnginfo, i))
+
         results = list()
-        for image in images:
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            metadata = None
-            if not args.disable_metadata:
-                metadata = PngInfo()
-                if prompt is not None:
-                    metadata.add_text("prompt", json.dumps(prompt))
-                if extra_pnginfo is not None:
-                    for x in extra_pnginfo:
-                        metadata.add_text(x, json.dumps(extra_pnginfo[x]))
-
-            file = f"{filename}_{counter:05}_.png"
-            img.save(os.path.join(full_output_folder, file), pnginfo=metadata, compress_level=self.compress_level)
-            results.append({
-                "filename": file,
-                "subfolder": subfolder,
-                "type": self.type
-            })
-            counter += 1
+        files = list()
+        with SaveImage.save_lock:
+            full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
+            for image in images:
+                file = f"{filename}_{counter:05}_.png"
+                output_writer.reserve_file(os.path.join(full_output_folder, file))
+                files.append(os.path.join(full_output_folder, file))
+                results.append({
+                    "filename": file,
+                    "subfolder": subfolder,
+                    "type": self.type
+                })
+                counter += 1
+
+        # PNG compression happens on the output writer threads
+        for i, (image, file) in enumerate(zip(images, files)):
+            output_writer.writer.submit(save_png, image, file, metadata[i * count // len(images)], self.compress_level, ui=results[i])
 
         return { "ui": { "images": results } }
 
+    def png_metadata(self, prompt, extra_pnginfo):
+        metadata = PngInfo()
+        if prompt is not None:
+            metadata.add_text("prompt", json.dumps(prompt))
+        if extra_pnginfo is not None:
+            for x in extra_pnginfo:
+                metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+        return metadata
+
+def save_png(image, file, metadata, compress_level):
+    i = 255. * image.cpu().numpy()
+    img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
+    output_writer.write_file_atomic(file, lambda f: img.save(f, format="PNG", pnginfo=metadata, compress_level=compress_level))
+
 class PreviewImage(SaveImage):
     def __init__(self):
         self.output_dir = folder_paths.get_temp_directory()
@@ -1399,12 +1473,13 @@ class LoadImage:
     @classmethod
     def INPUT_TYPES(s):
         input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
+        files = folder_paths.get_file_list(input_dir)
         return {"required":
                     {"image": (sorted(files), {"image_upload": True})},
                 }
 
     CATEGORY = "image"
+    THREAD_SAFE = True
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_image"
@@ -1455,13 +1530,14 @@ class LoadImageMask:
     @classmethod
     def INPUT_TYPES(s):
         input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
+        files = folder_paths.get_file_list(input_dir)
         return {"required":
                     {"image": (sorted(files), {"image_upload": True}),
                      "channel": (s._color_channels, ), }
                 }
 
     CATEGORY = "mask"
+    THREAD_SAFE = True
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "load_image"
@@ -1514,6 +1590,8 @@ class ImageScale:
     FUNCTION = "upscale"
 
     CATEGORY = "image/upscaling"
+    BATCH_INDEPENDENT = True
+    BATCHABLE_LIST = True
 
     def upscale(self, image, upscale_method, width, height, crop):
         if width == 0 and height == 0:
@@ -1541,6 +1619,8 @@ class ImageScaleBy:
     FUNCTION = "upscale"
 
     CATEGORY = "image/upscaling"
+    BATCH_INDEPENDENT = True
+    BATCHABLE_LIST = True
 
     def upscale(self, image, upscale_method, scale_by):
         samples = image.movedim(-1,1)
@@ -1560,6 +1640,9 @@ class ImageInvert:
     FUNCTION = "invert"
 
     CATEGORY = "image"
+    BATCH_INDEPENDENT = True
+    BATCHABLE_LIST = True
+    THREAD_SAFE = True
 
     def invert(self, image):
         s = 1.0 - image
@@ -6,13 +6,20 @@ import traceback
 import nodes
 import folder_paths
 import execution
+from comfy_execution import scheduling
+from comfy_execution import schema
+import uploads
+import view_cache
 import uuid
 import urllib
 import json
 import glob
 import struct
+import time
+import contextvars
+import collections
+import concurrent.futures
 from PIL import Image, ImageOps
-from PIL.PngImagePlugin import PngInfo
 from io import BytesIO
 
 try:
@@ -65,6 +72,180 @@ def create_cors_middleware(allowed_origin: str):
 
     return cors_middleware
 
+# messages of a client that are waiting to be sent, not counting the progress, status and previews
+MAX_QUEUED_MESSAGES = 1024
+# the preview sizes clients can ask for are rounded to a multiple of the step and capped,
+# the clients asking for the same one share an encoder
+PREVIEW_SIZE_STEP = 64
+MAX_PREVIEW_SIZE = 2048
+
+def preview_size(max_size):
+    return min(max(round(int(max_size) / PREVIEW_SIZE_STEP), 1) * PREVIEW_SIZE_STEP, MAX_PREVIEW_SIZE)
+
+class SocketWriter:
+    """
+    Sends the messages of one websocket from its own task so a slow client doesn't hold up the others.
+    Messages with a kind (progress, status, preview) replace the queued message of the same kind.
+    A client that gets more than max_messages other messages behind is disconnected, it gets
+    the current state when it reconnects.
+    """
+    def __init__(self, ws, max_messages=MAX_QUEUED_MESSAGES):
+        self.ws = ws
+        self.max_messages = max_messages
+        self.queue = collections.deque()
+        self.latest = {}
+        self.count = 0
+        self.dropped = 0
+        self.event = asyncio.Event()
+        self.task = None
+        self.closed = False
+        # live previews, set by the client with a preview_settings message
+        self.preview_format = None
+        self.preview_max_size = None
+        self.preview_interval = 0.0
+        self.next_preview = 0.0
+
+    def set_preview_settings(self, settings):
+        image_format = settings.get("format", None)
+        if image_format is not None and image_format.upper() not in PREVIEW_TYPES:
+            raise ValueError("unsupported preview format {}".format(image_format))
+        max_size = settings.get("max_size", None)
+        max_fps = settings.get("max_fps", None)
+        self.preview_format = image_format.upper() if image_format is not None else None
+        self.preview_max_size = preview_size(max_size) if max_size is not None else None
+        self.preview_interval = 1.0 / float(max_fps) if max_fps is not None and float(max_fps) > 0 else 0.0
+
+    def wants_preview(self, now):
+        if self.closed or now < self.next_preview:
+            return False
+        self.next_preview = now + self.preview_interval
+        return True
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, message, kind=None):
+        if self.closed:
+            return
+        entry = [message, kind]
+        if kind is not None:
+            old = self.latest.get(kind, None)
+            if old is not None:
+                old[0] = None
+                self.dropped += 1
+            self.latest[kind] = entry
+            if len(self.queue) > 2 * (self.count + len(self.latest)):
+                self.queue = collections.deque(x for x in self.queue if x[0] is not None)
+        else:
+            self.count += 1
+            if self.count > self.max_messages:
+                print("websocket client too slow, disconnecting")
+                self.close()
+                return
+        self.queue.append(entry)
+        self.event.set()
+
+    async def run(self):
+        while True:
+            while len(self.queue) == 0:
+                self.event.clear()
+                await self.event.wait()
+            entry = self.queue.popleft()
+            message, kind = entry
+            if kind is None:
+                self.count -= 1
+            elif self.latest.get(kind, None) is entry:
+                del self.latest[kind]
+            if message is None:
+                continue
+            if isinstance(message, str):
+                await send_socket_catch_exception(self.ws.send_str, message)
+            else:
+                await send_socket_catch_exception(self.ws.send_bytes, message)
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        if self.task is not None:
+            self.task.cancel()
+        if not self.ws.closed:
+            asyncio.ensure_future(self.ws.close())
+
+PREVIEW_TYPES = {"JPEG": 1, "PNG": 2, "WEBP": 3}
+
+def encode_preview(image, image_format, max_size):
+    if max_size is not None:
+        if hasattr(Image, 'Resampling'):
+            resampling = Image.Resampling.BILINEAR
+        else:
+            resampling = Image.ANTIALIAS
+
+        image = ImageOps.contain(image, (max_size, max_size), resampling)
+
+    bytesIO = BytesIO()
+    header = struct.pack(">I", PREVIEW_TYPES[image_format])
+    bytesIO.write(header)
+    image.save(bytesIO, format=image_format, quality=95, compress_level=1)
+    return bytesIO.getvalue()
+
+class PreviewEncoder:
+    """
+    Encodes the live previews of one format and size on the preview thread, one at a time.
+    A frame waiting for the encoder is replaced by a newer one and its clients get that one instead.
+    It is in server.preview_encoders until it has no frame left to encode.
+    """
+    def __init__(self, server, image_format, max_size):
+        self.server = server
+        self.image_format = image_format
+        self.max_size = max_size
+        self.pending = None
+        self.busy = False
+
+    def submit(self, image, writers):
+        if self.pending is not None:
+            writers = self.pending[1] + [w for w in writers if w not in self.pending[1]]
+        self.pending = (image, writers)
+        if not self.busy:
+            self.busy = True
+            asyncio.ensure_future(self.run())
+
+    async def run(self):
+        try:
+            while self.pending is not None:
+                image, writers = self.pending
+                self.pending = None
+                try:
+                    data = await self.server.loop.run_in_executor(self.server.preview_pool, encode_preview, image, self.image_format, self.max_size)
+                except Exception as e:
+                    print("failed to encode preview:", e)
+                    continue
+                message = bytes(self.server.encode_bytes(BinaryEventTypes.PREVIEW_IMAGE, data))
+                for writer in writers:
+                    writer.put(message, "preview")
+        finally:
+            self.busy = False
+            key = (self.image_format, self.max_size)
+            if self.server.preview_encoders.get(key, None) is self:
+                del self.server.preview_encoders[key]
+
+# index of the prompt worker running in the current thread
+current_worker = contextvars.ContextVar("current_worker", default=0)
+
+class WorkerState:
+    def __init__(self, device=None, interrupt_flag=None):
+        self.device = device
+        # see comfy.model_management.interrupt_worker
+        self.interrupt_flag = interrupt_flag
+        self.client_id = None
+        self.last_node_id = None
+        self.running = []
+
+    def interrupt(self):
+        comfy.model_management.interrupt_worker(self.interrupt_flag)
+
+    def status(self):
+        return {"device": None if self.device is None else str(self.device), "running": list(self.running)}
+
 class PromptServer():
     def __init__(self, loop):
         PromptServer.instance = self
@@ -77,20 +258,29 @@ class PromptServer():
         self.loop = loop
         self.messages = asyncio.Queue()
         self.number = 0
+        # the queue version restarts with the process
+        self.instance_id = uuid.uuid4().hex[:8]
+        self.view_cache = view_cache.TranscodeCache(int(args.view_cache_size * 1024 * 1024), args.view_cache_directory)
+        self.view_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="view")
+        self.view_encoding = {}
+        self.upload_index = uploads.UploadIndex()
+        self.preview_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="preview")
+        self.preview_encoders = {}
 
         middlewares = [cache_control]
         if args.enable_cors_header:
             middlewares.append(create_cors_middleware(args.enable_cors_header))
 
         max_upload_size = round(args.max_upload_size * 1024 * 1024)
+        self.max_upload_size = max_upload_size
         self.app = web.Application(client_max_size=max_upload_size, middlewares=middlewares)
         self.sockets = dict()
+        self.writers = dict()
         self.web_root = os.path.join(os.path.dirname(
             os.path.realpath(__file__)), "web")
         routes = web.RouteTableDef()
         self.routes = routes
-        self.last_node_id = None
-        self.client_id = None
+        self.workers = [WorkerState()]
 
         self.on_prompt_handlers = []
 
@@ -102,23 +292,40 @@ class PromptServer():
             if sid:
                 # Reusing existing session, remove old
                 self.sockets.pop(sid, None)
+                old_writer = self.writers.pop(sid, None)
+                if old_writer is not None:
+                    old_writer.close()
             else:
                 sid = uuid.uuid4().hex
 
             self.sockets[sid] = ws
+            writer = SocketWriter(ws)
+            writer.start()
+            self.writers[sid] = writer
 
             try:
-                # Send initial state to the new client
-                await self.send("status", { "status": self.get_queue_info(), 'sid': sid }, sid)
+                # Send initial state to the new client, it must not be replaced by a newer status
+                await self.send_json("status", { "status": self.get_queue_info(), 'sid': sid }, sid, coalesce=False)
                 # On reconnect if we are the currently executing client send the current node
-                if self.client_id == sid and self.last_node_id is not None:
-                    await self.send("executing", { "node": self.last_node_id }, sid)
+                for worker in self.workers:
+                    if worker.client_id == sid and worker.last_node_id is not None:
+                        await self.send("executing", { "node": worker.last_node_id }, sid)
                     
                 async for msg in ws:
                     if msg.type == aiohttp.WSMsgType.ERROR:
                         print('ws connection closed with exception %s' % ws.exception())
+                    elif msg.type == aiohttp.WSMsgType.TEXT:
+                        try:
+                            message = json.loads(msg.data)
+                            if message.get("type", None) == "preview_settings":
+                                writer.set_preview_settings(message.get("data", {}))
+                        except (ValueError, TypeError, AttributeError) as e:
+                            print("invalid websocket message:", e)
             finally:
-                self.sockets.pop(sid, None)
+                if self.writers.get(sid, None) is writer:
+                    self.sockets.pop(sid, None)
+                    self.writers.pop(sid, None)
+                writer.close()
             return ws
 
         @routes.get("/")
@@ -157,61 +364,111 @@ class PromptServer():
 
             return type_dir, dir_type
 
-        def image_upload(post, image_save_function=None):
-            image = post.get("image")
-            overwrite = post.get("overwrite")
-
-            image_upload_type = post.get("type")
-            upload_dir, image_upload_type = get_dir_by_type(image_upload_type)
-
-            if image and image.file:
-                filename = image.filename
-                if not filename:
-                    return web.Response(status=400)
-
-                subfolder = post.get("subfolder", "")
-                full_output_folder = os.path.join(upload_dir, os.path.normpath(subfolder))
-                filepath = os.path.abspath(os.path.join(full_output_folder, filename))
+        async def receive_upload(request):
+            """
+            Reads the fields of an upload form, the image is streamed to a temporary file by a worker thread.
+            Returns the fields and the UploadWriter of the image or None.
+            """
+            reader = await request.multipart()
+            fields = {}
+            fields_size = 0
+            upload = None
+            try:
+                async for field in reader:
+                    if field.name == "image" and field.filename is not None:
+                        if upload is not None:
+                            continue
+                        upload = await self.loop.run_in_executor(None, uploads.UploadWriter, folder_paths.get_temp_directory(), field.filename, self.max_upload_size)
+                        buffer = bytearray()
+                        while True:
+                            chunk = await field.read_chunk()
+                            if chunk:
+                                buffer += chunk
+                            if len(buffer) >= uploads.CHUNK_SIZE or (not chunk and len(buffer) > 0):
+                                await self.loop.run_in_executor(None, upload.write, bytes(buffer))
+                                buffer = bytearray()
+                            if not chunk:
+                                break
+                    else:
+                        # read in chunks, client_max_size doesn't limit a streamed multipart body
+                        value = bytearray()
+                        while True:
+                            chunk = await field.read_chunk()
+                            if not chunk:
+                                break
+                            fields_size += len(chunk)
+                            if fields_size > uploads.MAX_FIELDS_SIZE:
+                                raise uploads.UploadTooLarge()
+                            value += chunk
+                        fields[field.name] = value.decode(field.get_charset(default="utf-8"))
+            except BaseException:
+                if upload is not None:
+                    await self.loop.run_in_executor(None, upload.discard)
+                raise
+            return fields, upload
+
+        def upload_target(fields):
+            # returns (folder, subfolder, type) or None if the subfolder is outside of the upload directory
+            upload_dir, image_upload_type = get_dir_by_type(fields.get("type"))
+            subfolder = fields.get("subfolder", "")
+            full_output_folder = os.path.abspath(os.path.join(upload_dir, os.path.normpath(subfolder)))
+            if os.path.commonpath((upload_dir, full_output_folder)) != upload_dir:
+                return None
+            return full_output_folder, subfolder, image_upload_type
+
+        async def image_upload(request, process=None):
+            """
+            process(temporary path, fields) runs in a worker thread and returns the path and hash of the file
+            to store instead of the upload or a response.
+            """
+            try:
+                fields, upload = await receive_upload(request)
+            except uploads.UploadTooLarge:
+                return web.Response(status=413)
+            except (UnicodeDecodeError, LookupError):
+                return web.Response(status=400)
+            if upload is None or not upload.filename:
+                if upload is not None:
+                    await self.loop.run_in_executor(None, upload.discard)
+                return web.Response(status=400)
 
-                if os.path.commonpath((upload_dir, filepath)) != upload_dir:
+            def save():
+                digest = upload.close()
+                filename = os.path.basename(upload.filename)
+                target = upload_target(fields)
+                if target is None or filename in ("", ".", ".."):
+                    upload.discard()
                     return web.Response(status=400)
-
-                if not os.path.exists(full_output_folder):
-                    os.makedirs(full_output_folder)
-
-                split = os.path.splitext(filename)
-
-                if overwrite is not None and (overwrite == "true" or overwrite == "1"):
-                    pass
-                else:
-                    i = 1
-                    while os.path.exists(filepath):
-                        filename = f"{split[0]} ({i}){split[1]}"
-                        filepath = os.path.join(full_output_folder, filename)
-                        i += 1
-
-                if image_save_function is not None:
-                    image_save_function(image, post, filepath)
-                else:
-                    with open(filepath, "wb") as f:
-                        f.write(image.file.read())
-
+                path = upload.path
+                if process is not None:
+                    try:
+                        result = process(path, fields)
+                    finally:
+                        upload.discard()
+                    if isinstance(result, web.Response):
+                        return result
+                    path, digest = result
+
+                full_output_folder, subfolder, image_upload_type = target
+                overwrite = fields.get("overwrite")
+                overwrite = overwrite is not None and (overwrite == "true" or overwrite == "1")
+                filename, written = uploads.store(path, digest, full_output_folder, filename, overwrite, self.upload_index)
+                if written:
+                    # the schemas listing this directory get refreshed, the model lists and the other memoized validations stay
+                    folder_paths.notify_directory_changed(full_output_folder)
                 return web.json_response({"name" : filename, "subfolder": subfolder, "type": image_upload_type})
-            else:
-                return web.Response(status=400)
+
+            return await self.loop.run_in_executor(None, save)
 
         @routes.post("/upload/image")
         async def upload_image(request):
-            post = await request.post()
-            return image_upload(post)
+            return await image_upload(request)
 
 
         @routes.post("/upload/mask")
         async def upload_mask(request):
-            post = await request.post()
-
-            def image_save_function(image, post, filepath):
-                original_ref = json.loads(post.get("original_ref"))
+            def composite(mask_path, fields):
+                original_ref = json.loads(fields.get("original_ref"))
                 filename, output_dir = folder_paths.annotated_filepath(original_ref['filename'])
 
                 # validation for security: prevent accessing arbitrary path
@@ -232,22 +489,11 @@ class PromptServer():
                     output_dir = full_output_dir
 
                 file = os.path.join(output_dir, filename)
+                if not os.path.isfile(file):
+                    return web.Response(status=404)
+                return uploads.composite_mask(mask_path, file, folder_paths.get_temp_directory())
 
-                if os.path.isfile(file):
-                    with Image.open(file) as original_pil:
-                        metadata = PngInfo()
-                        if hasattr(original_pil,'text'):
-                            for key in original_pil.text:
-                                metadata.add_text(key, original_pil.text[key])
-                        original_pil = original_pil.convert('RGBA')
-                        mask_pil = Image.open(image.file).convert('RGBA')
-
-                        # alpha copy
-                        new_alpha = mask_pil.getchannel('A')
-                        original_pil.putalpha(new_alpha)
-                        original_pil.save(filepath, compress_level=4, pnginfo=metadata)
-
-            return image_upload(post, image_save_function)
+            return await image_upload(request, composite)
 
         @routes.get("/view")
         async def view_image(request):
@@ -276,65 +522,35 @@ class PromptServer():
                 file = os.path.join(output_dir, filename)
 
                 if os.path.isfile(file):
-                    if 'preview' in request.rel_url.query:
-                        with Image.open(file) as img:
-                            preview_info = request.rel_url.query['preview'].split(';')
-                            image_format = preview_info[0]
-                            if image_format not in ['webp', 'jpeg'] or 'a' in request.rel_url.query.get('channel', ''):
-                                image_format = 'webp'
-
-                            quality = 90
-                            if preview_info[-1].isdigit():
-                                quality = int(preview_info[-1])
-
-                            buffer = BytesIO()
-                            if image_format in ['jpeg'] or request.rel_url.query.get('channel', '') == 'rgb':
-                                img = img.convert("RGB")
-                            img.save(buffer, format=image_format, quality=quality)
-                            buffer.seek(0)
-
-                            return web.Response(body=buffer.read(), content_type=f'image/{image_format}',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-
-                    if 'channel' not in request.rel_url.query:
-                        channel = 'rgba'
-                    else:
-                        channel = request.rel_url.query["channel"]
-
-                    if channel == 'rgb':
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                r, g, b, a = img.split()
-                                new_img = Image.merge('RGB', (r, g, b))
-                            else:
-                                new_img = img.convert("RGB")
-
-                            buffer = BytesIO()
-                            new_img.save(buffer, format='PNG')
-                            buffer.seek(0)
-
-                            return web.Response(body=buffer.read(), content_type='image/png',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-
-                    elif channel == 'a':
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                _, _, _, a = img.split()
-                            else:
-                                a = Image.new('L', img.size, 255)
-
-                            # alpha img
-                            alpha_img = Image.new('RGBA', img.size)
-                            alpha_img.putalpha(a)
-                            alpha_buffer = BytesIO()
-                            alpha_img.save(alpha_buffer, format='PNG')
-                            alpha_buffer.seek(0)
-
-                            return web.Response(body=alpha_buffer.read(), content_type='image/png',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-                    else:
+                    params = view_cache.ViewParams(request.rel_url.query)
+                    if not params.transformed():
                         return web.FileResponse(file, headers={"Content-Disposition": f"filename=\"{filename}\""})
 
+                    key = self.view_cache.key(file, params)
+                    if key is None:
+                        return web.Response(status=404)
+                    etag = '"{}"'.format(key)
+                    headers = {"Content-Disposition": f"filename=\"{filename}\"", "ETag": etag}
+                    if request.headers.get("If-None-Match", None) == etag:
+                        return web.Response(status=304, headers=headers)
+
+                    cached = await self.loop.run_in_executor(self.view_pool, self.view_cache.get, key)
+                    if cached is None:
+                        # the same image requested again while it's being encoded waits for it
+                        future = self.view_encoding.get(key, None)
+                        if future is None:
+                            future = self.loop.run_in_executor(self.view_pool, view_cache.transcode, file, params)
+                            self.view_encoding[key] = future
+                            try:
+                                cached = await future
+                            finally:
+                                self.view_encoding.pop(key, None)
+                            self.loop.run_in_executor(self.view_pool, self.view_cache.set, key, *cached)
+                        else:
+                            cached = await asyncio.shield(future)
+                    body, image_format = cached
+                    return web.Response(body=body, content_type=view_cache.CONTENT_TYPES[image_format], headers=headers)
+
             return web.Response(status=404)
 
         @routes.get("/view_metadata/{folder_name}")
@@ -393,7 +609,7 @@ class PromptServer():
         def node_info(node_class):
             obj_class = nodes.NODE_CLASS_MAPPINGS[node_class]
             info = {}
-            info['input'] = obj_class.INPUT_TYPES()
+            info['input'] = schema.get_input_types(obj_class)
             info['output'] = obj_class.RETURN_TYPES
             info['output_is_list'] = obj_class.OUTPUT_IS_LIST if hasattr(obj_class, 'OUTPUT_IS_LIST') else [False] * len(obj_class.RETURN_TYPES)
             info['output_name'] = obj_class.RETURN_NAMES if hasattr(obj_class, 'RETURN_NAMES') else info['output']
@@ -412,6 +628,9 @@ class PromptServer():
 
         @routes.get("/object_info")
         async def get_object_info(request):
+            # this is how the frontend refreshes the node lists, also pick up the files listed by
+            # custom nodes without going through folder_paths
+            schema.registry.clear()
             out = {}
             for x in nodes.NODE_CLASS_MAPPINGS:
                 try:
@@ -431,23 +650,31 @@ class PromptServer():
 
         @routes.get("/history")
         async def get_history(request):
-            max_items = request.rel_url.query.get("max_items", None)
-            if max_items is not None:
-                max_items = int(max_items)
-            return web.json_response(self.prompt_queue.get_history(max_items=max_items))
+            query = request.rel_url.query
+            try:
+                max_items = int(query["max_items"]) if "max_items" in query else None
+                offset = int(query.get("offset", -1))
+                after = int(query["after"]) if "after" in query else None
+            except ValueError:
+                return web.Response(status=400)
+            text, cursor = self.prompt_queue.get_history_json(max_items=max_items, offset=offset, after=after,
+                                                              client_id=query.get("client_id", None), status=query.get("status", None))
+            return self.history_response(text, cursor)
 
         @routes.get("/history/{prompt_id}")
         async def get_history(request):
             prompt_id = request.match_info.get("prompt_id", None)
-            return web.json_response(self.prompt_queue.get_history(prompt_id=prompt_id))
+            text, cursor = self.prompt_queue.get_history_json(prompt_id=prompt_id)
+            return self.history_response(text, cursor)
 
         @routes.get("/queue")
         async def get_queue(request):
-            queue_info = {}
-            current_queue = self.prompt_queue.get_current_queue()
-            queue_info['queue_running'] = current_queue[0]
-            queue_info['queue_pending'] = current_queue[1]
-            return web.json_response(queue_info)
+            # only serialized when the queue changed, out of the event loop
+            version, text = await self.loop.run_in_executor(None, self.prompt_queue.get_current_queue_json)
+            etag = '"queue-{}-{}"'.format(self.instance_id, version)
+            if request.headers.get("If-None-Match", None) == etag:
+                return web.Response(status=304, headers={"ETag": etag})
+            return web.Response(text=text, content_type='application/json', headers={"ETag": etag})
 
         @routes.post("/prompt")
         async def post_prompt(request):
@@ -476,6 +703,15 @@ class PromptServer():
 
                 if "client_id" in json_data:
                     extra_data["client_id"] = json_data["client_id"]
+                if "priority_class" in json_data:
+                    if json_data["priority_class"] not in scheduling.PRIORITY_CLASSES:
+                        return web.json_response({"error": "priority_class must be one of {}".format(", ".join(scheduling.PRIORITY_CLASSES)), "node_errors": []}, status=400)
+                    extra_data["priority_class"] = json_data["priority_class"]
+                if valid[0] and args.queue_budget is not None:
+                    retry_after = self.prompt_queue.over_budget(prompt, args.queue_budget, len(self.workers))
+                    if retry_after is not None:
+                        error = {"type": "queue_full", "message": "Queue is full", "details": "The queue would take more than {} seconds to execute".format(args.queue_budget), "extra_info": {}}
+                        return web.json_response({"error": error, "node_errors": []}, status=429, headers={"Retry-After": str(retry_after)})
                 if valid[0]:
                     prompt_id = str(uuid.uuid4())
                     outputs_to_execute = valid[2]
@@ -504,7 +740,26 @@ class PromptServer():
 
         @routes.post("/interrupt")
         async def post_interrupt(request):
-            nodes.interrupt_processing()
+            # only the worker running the prompt_id or a prompt of the client_id when one is passed, all of them otherwise
+            json_data = {}
+            if request.body_exists:
+                try:
+                    json_data = await request.json()
+                except ValueError:
+                    return web.Response(status=400)
+                if not isinstance(json_data, dict):
+                    return web.Response(status=400)
+            prompt_id = json_data.get("prompt_id", None)
+            client_id = json_data.get("client_id", None)
+            if prompt_id is not None:
+                # a deduplicated prompt runs as part of its leader
+                prompt_id = self.prompt_queue.get_leader(prompt_id)
+            for worker in self.workers:
+                if prompt_id is not None and prompt_id not in worker.running:
+                    continue
+                if client_id is not None and (client_id != worker.client_id or len(worker.running) == 0):
+                    continue
+                worker.interrupt()
             return web.Response(status=200)
 
         @routes.post("/history")
@@ -520,6 +775,13 @@ class PromptServer():
 
             return web.Response(status=200)
         
+    def history_response(self, text, cursor):
+        headers = {}
+        if cursor is not None:
+            # pass it back as ?after= to only get the newer entries
+            headers["X-History-Cursor"] = str(cursor)
+        return web.Response(text=text, content_type='application/json', headers=headers)
+
     def add_routes(self):
         self.app.add_routes(self.routes)
 
@@ -532,10 +794,42 @@ class PromptServer():
             web.static('/', self.web_root, follow_symlinks=True),
         ])
 
+    def set_workers(self, devices):
+        # the first worker uses the global interrupt flag so nodes.interrupt_processing() still works with a single worker
+        self.workers = [WorkerState(d, None if i == 0 else comfy.model_management.InterruptFlag()) for i, d in enumerate(devices)]
+
+    def set_current_worker(self, index):
+        current_worker.set(index)
+
+    def worker_state(self):
+        return self.workers[current_worker.get()]
+
+    # client_id and last_node_id are the ones of the worker running in the current thread
+    @property
+    def client_id(self):
+        return self.worker_state().client_id
+
+    @client_id.setter
+    def client_id(self, value):
+        self.worker_state().client_id = value
+
+    @property
+    def last_node_id(self):
+        return self.worker_state().last_node_id
+
+    @last_node_id.setter
+    def last_node_id(self, value):
+        self.worker_state().last_node_id = value
+
     def get_queue_info(self):
         prompt_info = {}
         exec_info = {}
         exec_info['queue_remaining'] = self.prompt_queue.get_tasks_remaining()
+        exec_info['workers'] = [w.status() for w in self.workers]
+        exec_info['classes'] = self.prompt_queue.get_class_status()
+        exec_info['estimated_drain_time'] = self.prompt_queue.estimated_drain_time(len(self.workers))
+        if args.model_affinity > 0:
+            exec_info['model_affinity'] = self.prompt_queue.get_affinity_status()
         prompt_info['exec_info'] = exec_info
         return prompt_info
 
@@ -560,43 +854,51 @@ class PromptServer():
         image_type = image_data[0]
         image = image_data[1]
         max_size = image_data[2]
-        if max_size is not None:
-            if hasattr(Image, 'Resampling'):
-                resampling = Image.Resampling.BILINEAR
-            else:
-                resampling = Image.ANTIALIAS
-
-            image = ImageOps.contain(image, (max_size, max_size), resampling)
-        type_num = 1
-        if image_type == "JPEG":
-            type_num = 1
-        elif image_type == "PNG":
-            type_num = 2
-
-        bytesIO = BytesIO()
-        header = struct.pack(">I", type_num)
-        bytesIO.write(header)
-        image.save(bytesIO, format=image_type, quality=95, compress_level=1)
-        preview_bytes = bytesIO.getvalue()
-        await self.send_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid=sid)
-
-    async def send_bytes(self, event, data, sid=None):
-        message = self.encode_bytes(event, data)
-
         if sid is None:
-            for ws in self.sockets.values():
-                await send_socket_catch_exception(ws.send_bytes, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_bytes, message)
-
-    async def send_json(self, event, data, sid=None):
-        message = {"type": event, "data": data}
-
+            writers = list(self.writers.values())
+        elif sid in self.writers:
+            writers = [self.writers[sid]]
+        else:
+            return
+
+        # clients over their frame rate skip this frame, the others get it in the format and size they asked for
+        now = time.monotonic()
+        groups = {}
+        for writer in writers:
+            if not writer.wants_preview(now):
+                continue
+            size = max_size
+            if writer.preview_max_size is not None:
+                size = writer.preview_max_size if max_size is None else min(max_size, writer.preview_max_size)
+            groups.setdefault((writer.preview_format or image_type, size), []).append(writer)
+
+        for key, group in groups.items():
+            encoder = self.preview_encoders.get(key, None)
+            if encoder is None:
+                encoder = PreviewEncoder(self, *key)
+                self.preview_encoders[key] = encoder
+            encoder.submit(image, group)
+
+    def queue_message(self, message, sid, kind):
+        # the message is serialized once and queued for every socket, the writers send it
         if sid is None:
-            for ws in self.sockets.values():
-                await send_socket_catch_exception(ws.send_json, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_json, message)
+            for writer in self.writers.values():
+                writer.put(message, kind)
+        elif sid in self.writers:
+            self.writers[sid].put(message, kind)
+
+    async def send_bytes(self, event, data, sid=None):
+        message = bytes(self.encode_bytes(event, data))
+        kind = "preview" if event == BinaryEventTypes.PREVIEW_IMAGE else None
+        self.queue_message(message, sid, kind)
+
+    async def send_json(self, event, data, sid=None, coalesce=True):
+        message = json.dumps({"type": event, "data": data})
+        kind = None
+        if coalesce and event in ("progress", "status"):
+            # only the latest one matters to a client that lags behind
+            kind = event
+        self.queue_message(message, sid, kind)
 
     def send_sync(self, event, data, sid=None):
         self.loop.call_soon_threadsafe(
@@ -0,0 +1,24 @@
+import pytest
+
+# everything in these tests runs on the cpu, set before comfy.model_management picks the device
+from comfy.cli_args import args
+args.cpu = True
+
+class FakeServer:
+    """Records the messages the executor and the queue send instead of sending them to websocket clients"""
+    def __init__(self):
+        self.client_id = None
+        self.last_node_id = None
+        self.prompt_queue = None
+        self.number = 0
+        self.messages = []
+
+    def send_sync(self, event, data, sid=None):
+        self.messages.append((event, data, sid))
+
+    def queue_updated(self):
+        pass
+
+@pytest.fixture
+def server():
+    return FakeServer()
@@ -0,0 +1,59 @@
+import torch
+
+import execution
+import nodes
+
+class AddOne:
+    # counts the calls, every call gets one batch
+    BATCHABLE_LIST = True
+    FUNCTION = "add"
+    calls = 0
+
+    def add(self, image, amount=1.0):
+        AddOne.calls += 1
+        return (image + amount,)
+
+class AddOneToLatent(AddOne):
+    def add(self, samples):
+        AddOne.calls += 1
+        return ({"samples": samples["samples"] + 1},)
+
+def images(*sizes):
+    return [torch.full((batch, 4, 4, 3), float(i)) for i, batch in enumerate(sizes)]
+
+def test_list_runs_as_one_batch(monkeypatch):
+    monkeypatch.setattr(AddOne, "calls", 0)
+    results = execution.map_node_over_list(AddOne(), {"image": images(1, 2, 1), "amount": [1.0]}, "add")
+    assert AddOne.calls == 1
+    # one result per list element with its own batch size
+    assert [r[0].shape[0] for r in results] == [1, 2, 1]
+    assert [float(r[0].mean()) for r in results] == [1.0, 2.0, 3.0]
+
+def test_latents(monkeypatch):
+    monkeypatch.setattr(AddOne, "calls", 0)
+    latents = [{"samples": torch.zeros((1, 4, 8, 8))}, {"samples": torch.ones((2, 4, 8, 8))}]
+    results = execution.map_node_over_list(AddOneToLatent(), {"samples": latents}, "add")
+    assert AddOne.calls == 1
+    assert [float(r[0]["samples"].mean()) for r in results] == [1.0, 2.0]
+
+def test_elements_that_cant_be_stacked(monkeypatch):
+    monkeypatch.setattr(AddOne, "calls", 0)
+    different = [torch.zeros((1, 4, 4, 3)), torch.zeros((1, 8, 8, 3))]
+    results = execution.map_node_over_list(AddOne(), {"image": different}, "add")
+    assert AddOne.calls == 2
+    assert [r[0].shape[1] for r in results] == [4, 8]
+
+    # lists of different lengths run once per element, the shorter one repeats its last value
+    monkeypatch.setattr(AddOne, "calls", 0)
+    results = execution.map_node_over_list(AddOne(), {"image": images(1, 1, 1), "amount": [1.0, 2.0]}, "add")
+    assert AddOne.calls == 3
+    assert [float(r[0].mean()) for r in results] == [1.0, 3.0, 4.0]
+
+def test_single_element_isnt_batched(monkeypatch):
+    monkeypatch.setattr(AddOne, "calls", 0)
+    results = execution.map_node_over_list(AddOne(), {"image": images(2)}, "add")
+    assert AddOne.calls == 1 and len(results) == 1
+
+def test_image_invert_list():
+    results = execution.map_node_over_list(nodes.ImageInvert(), {"image": images(1, 2)}, "invert")
+    assert [float(r[0].mean()) for r in results] == [1.0, 0.0]
@@ -0,0 +1,157 @@
+import os
+import time
+
+import pytest
+import torch
+
+import execution
+import folder_paths
+import nodes
+from comfy_execution import caching
+from comfy_execution import output_writer
+from comfy_execution import schema
+
+class LoadTestModel:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"model_name": (folder_paths.get_filename_list("test_models"),)}}
+
+    RETURN_TYPES = ("LATENT",)
+    FUNCTION = "load"
+    CATEGORY = "loaders"
+
+@pytest.fixture
+def model_folder(tmp_path, monkeypatch):
+    monkeypatch.setitem(folder_paths.folder_names_and_paths, "test_models", ([str(tmp_path)], {".bin"}))
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "LoadTestModel", LoadTestModel)
+    (tmp_path / "a.bin").write_bytes(b"first")
+    folder_paths.notify_changed()
+    yield tmp_path
+    folder_paths.notify_changed()
+    schema.registry.clear()
+
+def signature(model_name):
+    prompt = {"1": {"class_type": "LoadTestModel", "inputs": {"model_name": model_name}}}
+    return caching.node_signature(prompt, "1", {})
+
+def test_replaced_model_file_changes_the_signature(model_folder):
+    before = signature("a.bin")
+    assert before == signature("a.bin")
+    path = model_folder / "a.bin"
+    path.write_bytes(b"second version")
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 1000))
+    assert signature("a.bin") != before
+
+def test_other_nodes_have_no_file_states():
+    assert caching.file_states(nodes.NODE_CLASS_MAPPINGS["EmptyImage"], {"width": 8}) == {}
+
+def wait_for_writes(cache):
+    for i in range(500):
+        with cache.lock:
+            if len(cache.writing) == 0:
+                return
+        time.sleep(0.01)
+    raise TimeoutError()
+
+def test_disk_cache_spills_evicted_outputs(tmp_path):
+    disk = caching.DiskCache(str(tmp_path), 1024 * 1024)
+    cache = caching.LRUCache(1, disk=disk)
+    latent = {"samples": torch.arange(16, dtype=torch.float32).reshape(1, 1, 4, 4)}
+    cache.set("a", caching.CacheEntry([[latent]], None, ("LATENT",)))
+    cache.set("b", caching.CacheEntry([[latent]], None, ("LATENT",)))
+    wait_for_writes(disk)
+
+    assert os.path.isfile(disk.path("a"))
+    # a new DiskCache finds the files written by the previous run
+    entry = caching.DiskCache(str(tmp_path), 1024 * 1024).get("a")
+    assert torch.equal(entry.outputs[0][0]["samples"], latent["samples"])
+    assert entry.output_types == ["LATENT"]
+
+def test_disk_cache_skips_outputs_it_cant_reload(tmp_path):
+    disk = caching.DiskCache(str(tmp_path), 1024 * 1024)
+    disk.set("model", caching.CacheEntry([[object()]], None, ("MODEL",)))
+    disk.set("output", caching.CacheEntry([], {"images": []}, ()))
+    wait_for_writes(disk)
+    assert os.listdir(tmp_path) == []
+
+def test_spill_is_not_tracked_by_the_prompt(tmp_path):
+    disk = caching.DiskCache(str(tmp_path), 1024 * 1024)
+    with output_writer.writer.track() as writes:
+        disk.set("a", caching.CacheEntry([[torch.zeros(2)]], None, ("IMAGE",)))
+    wait_for_writes(disk)
+    assert writes == []
+    assert disk.get("a") is not None
+
+class CountedImage:
+    # records the colors it is executed with
+    calls = []
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"color": ("INT", {"default": 0})}}
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "generate"
+    CATEGORY = "test"
+
+    def generate(self, color):
+        CountedImage.calls.append(color)
+        return (torch.full((1, 8, 8, 3), color / 10),)
+
+@pytest.fixture
+def counted(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "CountedImage", CountedImage)
+    monkeypatch.setattr(CountedImage, "calls", [])
+    return CountedImage
+
+def counted_prompt(image_id, invert_id, preview_id, color=1):
+    return {image_id: {"class_type": "CountedImage", "inputs": {"color": color}},
+            invert_id: {"class_type": "ImageInvert", "inputs": {"image": [image_id, 0]}},
+            preview_id: {"class_type": "PreviewImage", "inputs": {"images": [invert_id, 0]}}}
+
+def test_renumbered_graph_hits_the_cache(server, counted, monkeypatch):
+    monkeypatch.setattr(execution.args, "cache_lru", 16)
+    e = execution.PromptExecutor(server)
+    e.execute(counted_prompt("1", "2", "3"), "p0", {}, ["3"])
+    # the same graph with other node ids and part of it in a bigger prompt
+    e.execute(counted_prompt("10", "20", "30"), "p1", {}, ["30"])
+    assert counted.calls == [1]
+    p = counted_prompt("a", "b", "c")
+    p.update(counted_prompt("d", "e", "f", color=2))
+    e.execute(p, "p2", {}, ["c", "f"])
+    assert counted.calls == [1, 2]
+    assert e.profile["a"] == e.profile["b"] == {"cached": True}
+    assert set(e.outputs) == {"a", "b", "c", "d", "e", "f"}
+
+    # another executor (prompt worker) doesn't share it
+    other = execution.PromptExecutor(server)
+    other.execute(counted_prompt("1", "2", "3"), "p3", {}, ["3"])
+    assert counted.calls == [1, 2, 1]
+
+class ChangingImage(CountedImage):
+    # IS_CHANGED returns the class attribute, like a node watching a file
+    version = 0
+
+    @classmethod
+    def IS_CHANGED(s, color):
+        return s.version
+
+def test_only_changed_nodes_run_again(server, counted, monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "ChangingImage", ChangingImage)
+    monkeypatch.setattr(ChangingImage, "version", 0)
+    e = execution.PromptExecutor(server)
+
+    def run(color, changing_color=5):
+        p = counted_prompt("1", "2", "3", color)
+        p.update(counted_prompt("4", "5", "6", changing_color))
+        p["4"]["class_type"] = "ChangingImage"
+        e.execute(p, "p", {}, ["3", "6"])
+        return {x for x, profile in e.profile.items() if not profile["cached"]}
+
+    assert run(1) == {"1", "2", "3", "4", "5", "6"}
+    assert run(1) == set()
+    # a changed input runs the node and the ones downstream of it
+    assert run(2) == {"1", "2", "3"}
+    ChangingImage.version = 1
+    assert run(2) == {"4", "5", "6"}
+    assert counted.calls == [1, 5, 2, 5]
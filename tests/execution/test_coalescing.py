@@ -0,0 +1,124 @@
+import pytest
+import torch
+
+import execution
+import nodes
+from comfy_execution import coalescing
+
+class SeededImage:
+    # a coalescing node, gets one seed per coalesced prompt and returns one image for each of them
+    COALESCE_INPUTS = ("seed",)
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"seed": ("INT", {"default": 0})}}
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "generate"
+    CATEGORY = "test"
+
+    def generate(self, seed):
+        seeds = seed if isinstance(seed, coalescing.CoalescedValues) else [seed]
+        return (torch.cat([torch.full((1, 8, 8, 3), s / 10) for s in seeds]),)
+
+class ImageValues:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"images": ("IMAGE",)}}
+
+    RETURN_TYPES = ()
+    FUNCTION = "values"
+    OUTPUT_NODE = True
+    BATCH_INDEPENDENT = True
+    CATEGORY = "test"
+
+    def values(self, images):
+        return {"ui": {"values": [round(float(x.mean()), 3) for x in images]}}
+
+class BatchValues(ImageValues):
+    # could depend on the whole batch
+    BATCH_INDEPENDENT = False
+
+class PromptSeeds(ImageValues):
+    # reports the seeds of the prompts it got as hidden input
+    COALESCED_METADATA = True
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"images": ("IMAGE",)}, "hidden": {"prompt": "PROMPT"}}
+
+    def values(self, images, prompt):
+        prompts = prompt if isinstance(prompt, coalescing.CoalescedValues) else [prompt]
+        return {"ui": {"seeds": [p["1"]["inputs"]["seed"] for p in prompts]}}
+
+class UnawarePromptSeeds(PromptSeeds):
+    COALESCED_METADATA = False
+
+@pytest.fixture(autouse=True)
+def test_nodes(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "SeededImage", SeededImage)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "ImageValues", ImageValues)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "BatchValues", BatchValues)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "PromptSeeds", PromptSeeds)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "UnawarePromptSeeds", UnawarePromptSeeds)
+
+def prompt(seed):
+    return {"1": {"class_type": "SeededImage", "inputs": {"seed": seed}},
+            "2": {"class_type": "ImageValues", "inputs": {"images": ["1", 0]}},
+            "3": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 8, "batch_size": 2, "color": 0}},
+            "4": {"class_type": "ImageValues", "inputs": {"images": ["3", 0]}}}
+
+def test_structure_key():
+    assert coalescing.structure_key(prompt(1), ["2", "4"]) == coalescing.structure_key(prompt(2), ["4", "2"])
+    assert coalescing.structure_key(prompt(1), ["2"]) != coalescing.structure_key(prompt(1), ["2", "4"])
+    other = prompt(1)
+    other["3"]["inputs"]["batch_size"] = 3
+    assert coalescing.structure_key(other, ["2", "4"]) != coalescing.structure_key(prompt(1), ["2", "4"])
+
+def test_batched_nodes():
+    assert coalescing.batched_nodes(prompt(1), {"1"}) == {"1", "2"}
+    unbatchable = prompt(1)
+    unbatchable["2"]["class_type"] = "BatchValues"
+    assert coalescing.batched_nodes(unbatchable, {"1"}) is None
+    assert coalescing.structure_key(unbatchable, ["4"]) is None
+
+def test_only_the_batched_ui_is_split(server):
+    items = [(i, "p{}".format(i), prompt(i + 1), {"client_id": "c{}".format(i)}, ["2", "4"]) for i in range(2)]
+    e = execution.PromptExecutor(server)
+    outputs_ui = e.execute_coalesced(items)
+
+    assert [x["2"] for x in outputs_ui] == [{"values": [0.1]}, {"values": [0.2]}]
+    # node 4 isn't downstream of the coalescing node, every prompt gets its whole ui
+    assert [x["4"] for x in outputs_ui] == [{"values": [0.0, 0.0]}, {"values": [0.0, 0.0]}]
+
+    executed = {(sid, data["node"]): data["output"] for event, data, sid in server.messages if event == "executed"}
+    assert executed[("c0", "2")] == {"values": [0.1]}
+    assert executed[("c1", "2")] == {"values": [0.2]}
+    assert executed[("c0", "4")] == executed[("c1", "4")] == {"values": [0.0, 0.0]}
+
+def test_batch_dependent_samplers():
+    for sampler_name in ["euler_ancestral", "dpmpp_sde", "dpm_adaptive"]:
+        p = prompt(1)
+        p["1"]["inputs"]["sampler_name"] = sampler_name
+        assert coalescing.structure_key(p, ["2"]) is None
+    p["1"]["inputs"]["sampler_name"] = "euler"
+    assert coalescing.structure_key(p, ["2"]) is not None
+
+def test_prompt_metadata(server):
+    def seeds_prompt(seed):
+        p = prompt(seed)
+        p["5"] = {"class_type": "PromptSeeds", "inputs": {"images": ["1", 0]}}
+        # not batched, gets the prompt of the first item, every prompt gets its ui
+        p["6"] = {"class_type": "UnawarePromptSeeds", "inputs": {"images": ["3", 0]}}
+        return p
+
+    assert coalescing.batched_nodes(seeds_prompt(1), {"1"}) == {"1", "2", "5"}
+    items = [(i, "p{}".format(i), seeds_prompt(i + 1), {}, ["5", "6"]) for i in range(2)]
+    outputs_ui = execution.PromptExecutor(server).execute_coalesced(items)
+    assert [x["5"] for x in outputs_ui] == [{"seeds": [1]}, {"seeds": [2]}]
+    assert [x["6"] for x in outputs_ui] == [{"seeds": [1]}, {"seeds": [1]}]
+
+    # a batched node that expects a single prompt isn't coalesced
+    unaware = seeds_prompt(1)
+    unaware["5"]["class_type"] = "UnawarePromptSeeds"
+    assert coalescing.structure_key(unaware, ["5"]) is None
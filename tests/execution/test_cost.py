@@ -0,0 +1,49 @@
+import pytest
+
+from comfy_execution import cost
+
+def txt2img(steps=20, width=512, height=512, batch_size=1):
+    return {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+            "2": {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat", "clip": ["1", 1]}},
+            "3": {"class_type": "EmptyLatentImage", "inputs": {"width": width, "height": height, "batch_size": batch_size}},
+            "4": {"class_type": "KSampler", "inputs": {"model": ["1", 0], "positive": ["2", 0], "negative": ["2", 0],
+                                                       "latent_image": ["3", 0], "steps": steps, "seed": 0}},
+            "5": {"class_type": "VAEDecode", "inputs": {"samples": ["4", 0], "vae": ["1", 2]}},
+            "6": {"class_type": "SaveImage", "inputs": {"images": ["5", 0]}}}
+
+def test_estimate():
+    pixels = 512 * 512 / 1e6
+    expected = 6 * cost.NODE_COST + 20 * cost.SAMPLER_STEP_COST * pixels + cost.VAE_COST * pixels
+    assert cost.estimate(txt2img()) == pytest.approx(expected)
+
+def test_estimate_scales_with_steps_resolution_and_batch():
+    base = cost.estimate(txt2img())
+    assert cost.estimate(txt2img(steps=40)) > base
+    assert cost.estimate(txt2img(width=1024, height=1024)) == pytest.approx(4 * base, rel=0.01)
+    assert cost.estimate(txt2img(batch_size=2)) == pytest.approx(2 * base, rel=0.01)
+
+def test_estimate_step_range_and_unknown_inputs():
+    prompt = txt2img()
+    prompt["4"]["inputs"].update({"start_at_step": 10, "end_at_step": 15})
+    pixels = 512 * 512 / 1e6
+    assert cost.estimate(prompt) == pytest.approx(6 * cost.NODE_COST + 5 * pixels + cost.VAE_COST * pixels)
+
+    # linked steps and a resolution that can't be found use the defaults
+    prompt = txt2img()
+    prompt["4"]["inputs"]["steps"] = ["7", 0]
+    del prompt["3"]
+    assert cost.estimate(prompt) == pytest.approx(5 * cost.NODE_COST + cost.VAE_COST * pixels)
+
+def test_estimate_cycle():
+    prompt = {"1": {"class_type": "KSampler", "inputs": {"latent_image": ["2", 0], "steps": 10}},
+              "2": {"class_type": "VAEEncode", "inputs": {"pixels": ["1", 0]}}}
+    pixels, batch = cost.DEFAULT_RESOLUTION
+    assert cost.estimate(prompt) == pytest.approx(2 * cost.NODE_COST + 10 * pixels / 1e6 + cost.VAE_COST * pixels / 1e6)
+
+def test_cost_model():
+    model = cost.CostModel(seconds_per_unit=1.0, smoothing=0.5)
+    assert model.seconds(2.0) == 2.0
+    model.observe(2.0, 6.0)
+    assert model.seconds_per_unit == 2.0
+    model.observe(0.0, 5.0)
+    assert model.seconds_per_unit == 2.0
@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+
+import execution
+from comfy_execution import coalescing
+from comfy_execution import output_writer
+from tests.execution.test_queue import queue_item
+
+@pytest.fixture
+def queue(server, monkeypatch):
+    monkeypatch.setattr(execution.args, "dedupe_prompts", True)
+    return execution.PromptQueue(server)
+
+def test_dedupe_key():
+    # the client and the priority class don't change the results
+    assert coalescing.dedupe_key(queue_item(0, client_id="a")) == coalescing.dedupe_key(queue_item(1, client_id="b"))
+    item = queue_item(1)
+    item[3]["priority_class"] = "batch"
+    assert coalescing.dedupe_key(queue_item(0)) == coalescing.dedupe_key(item)
+    assert coalescing.dedupe_key(queue_item(0)) != coalescing.dedupe_key(queue_item(1, color=1))
+    item = queue_item(1)
+    item[3]["extra_pnginfo"] = {"workflow": {}}
+    assert coalescing.dedupe_key(queue_item(0)) != coalescing.dedupe_key(item)
+
+def test_identical_prompts_run_once(queue):
+    queue.put(queue_item(0, client_id="a"))
+    queue.put(queue_item(1, client_id="b"))
+    queue.put(queue_item(2, color=1))
+    assert [x[1] for x in queue.get_followers("p0")] == ["p1"]
+    assert queue.get_leader("p1") == "p0" and queue.get_leader("p0") == "p0"
+    running, pending = queue.get_current_queue()
+    assert [x[1] for x in pending] == ["p0", "p1", "p2"]
+    assert queue.get_tasks_remaining() == 3
+
+    item, item_id = queue.get()
+    assert item[1] == "p0"
+    # the follower runs with its leader, it isn't given to another worker
+    running, pending = queue.get_current_queue()
+    assert sorted(x[1] for x in running) == ["p0", "p1"]
+    assert [x[1] for x in pending] == ["p2"]
+
+    # queued while the leader runs
+    queue.put(queue_item(3, client_id="c"))
+    assert [x[1] for x in queue.get_followers("p0")] == ["p1", "p3"]
+    assert queue.get_tasks_remaining() == 4
+
+    finished = queue.task_done(item_id, {"2": {"images": ["x.png"]}})
+    assert [x[1] for x in finished] == ["p0", "p1", "p3"]
+    history = queue.get_history()
+    assert list(history) == ["p0", "p1", "p3"]
+    assert all(history[x]["outputs"] == {"2": {"images": ["x.png"]}} for x in history)
+    assert history["p3"]["prompt"][3] == {"client_id": "c"}
+    assert queue.get_tasks_remaining() == 1
+
+    # a new identical prompt leads again
+    queue.put(queue_item(4))
+    assert queue.get_followers("p4") == []
+    item, item_id = queue.get()
+    assert item[1] == "p2"
+    item, item_id = queue.get()
+    assert item[1] == "p4"
+
+def test_remove_pending_follower(queue):
+    queue.put(queue_item(0))
+    queue.put(queue_item(1))
+    assert queue.delete_queue_item(lambda x: x[1] == "p1")
+    assert queue.get_followers("p0") == []
+    item, item_id = queue.get()
+    assert [x[1] for x in queue.task_done(item_id, {})] == ["p0"]
+    assert list(queue.get_history()) == ["p0"]
+
+def test_remove_pending_leader(queue):
+    queue.put(queue_item(0))
+    queue.put(queue_item(1))
+    queue.put(queue_item(2))
+    assert queue.delete_queue_item(lambda x: x[1] == "p0")
+    # the first follower takes its place
+    assert [x[1] for x in queue.get_followers("p1")] == ["p2"]
+    running, pending = queue.get_current_queue()
+    assert [x[1] for x in pending] == ["p1", "p2"]
+    item, item_id = queue.get()
+    assert item[1] == "p1"
+    assert [x[1] for x in queue.task_done(item_id, {})] == ["p1", "p2"]
+    assert queue.get_tasks_remaining() == 0
+
+def test_followers_get_the_messages(queue, server):
+    queue.put(queue_item(0, client_id="a"))
+    queue.put(queue_item(1, client_id="b"))
+    item, item_id = queue.get()
+    e = execution.PromptExecutor(server)
+    e.execute_with_followers(item, queue.get_followers(item[1]))
+    # the executed messages are sent once the outputs are written
+    written = threading.Event()
+    output_writer.when_done(e.pending_writes, written.set)
+    assert written.wait(10)
+    executed = [(data["prompt_id"], sid) for event, data, sid in server.messages if event == "executed"]
+    assert executed == [("p0", "a"), ("p1", "b")]
+    assert e.server is server
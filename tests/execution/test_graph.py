@@ -0,0 +1,71 @@
+import pytest
+
+import nodes
+from comfy_execution import graph
+
+def run(plan, lazy=None):
+    """executes the plan in order, lazy: node id -> the lazy inputs it asks for the first time it runs"""
+    lazy = dict(lazy or {})
+    order = []
+    while not plan.is_empty():
+        unique_id = plan.next_node()
+        if unique_id in lazy:
+            plan.add_lazy_dependencies(unique_id, lazy.pop(unique_id))
+            continue
+        order.append(unique_id)
+        plan.complete_node(unique_id)
+    return order
+
+def test_topological_order():
+    prompt = {"1": {"class_type": "EmptyImage", "inputs": {}},
+              "2": {"class_type": "ImageInvert", "inputs": {"image": ["1", 0]}},
+              "3": {"class_type": "PreviewImage", "inputs": {"images": ["2", 0]}}}
+    plan = graph.ExecutionPlan(prompt, {})
+    plan.add_node("3")
+    assert run(plan) == ["1", "2", "3"]
+
+def test_cached_nodes_are_skipped():
+    prompt = {"1": {"class_type": "EmptyImage", "inputs": {}},
+              "2": {"class_type": "ImageInvert", "inputs": {"image": ["1", 0]}},
+              "3": {"class_type": "PreviewImage", "inputs": {"images": ["2", 0]}}}
+    plan = graph.ExecutionPlan(prompt, {"2": None})
+    assert plan.uncached_dependencies("3") == 1
+    plan.add_node("3")
+    assert run(plan) == ["3"]
+
+class LazySwitch:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"on_true": ("IMAGE", {"lazy": True}), "on_false": ("IMAGE", {"lazy": True}), "switch": ("BOOLEAN",)}}
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "switch"
+
+def test_lazy_inputs_are_queued_again(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "LazySwitch", LazySwitch)
+    prompt = {"1": {"class_type": "EmptyImage", "inputs": {}},
+              "2": {"class_type": "EmptyImage", "inputs": {}},
+              "3": {"class_type": "LazySwitch", "inputs": {"on_true": ["1", 0], "on_false": ["2", 0], "switch": True}},
+              "4": {"class_type": "PreviewImage", "inputs": {"images": ["3", 0]}}}
+    plan = graph.ExecutionPlan(prompt, {})
+    plan.add_node("4")
+    # the lazy inputs aren't evaluated until the node asks for them, it runs again once on_true is done
+    assert run(plan, {"3": ["on_true"]}) == ["1", "3", "4"]
+
+def test_cycle():
+    prompt = {"1": {"class_type": "ImageInvert", "inputs": {"image": ["2", 0]}},
+              "2": {"class_type": "ImageInvert", "inputs": {"image": ["1", 0]}},
+              "3": {"class_type": "PreviewImage", "inputs": {"images": ["2", 0]}}}
+    plan = graph.ExecutionPlan(prompt, {})
+    plan.add_node("3")
+    with pytest.raises(graph.DependencyCycleError):
+        plan.next_node()
+
+def test_waits_for_executing_nodes():
+    prompt = {"1": {"class_type": "EmptyImage", "inputs": {}},
+              "2": {"class_type": "PreviewImage", "inputs": {"images": ["1", 0]}}}
+    plan = graph.ExecutionPlan(prompt, {})
+    plan.add_node("2")
+    assert plan.next_node() == "1"
+    assert plan.next_node() is None
+    plan.complete_node("1")
+    assert plan.next_node() == "2"
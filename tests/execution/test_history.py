@@ -0,0 +1,129 @@
+import json
+
+import pytest
+
+import execution
+from comfy_execution import history
+from comfy_execution.queue_store import SQLiteQueueStore
+from tests.execution.test_queue import queue_item
+
+def entry(number, client_id=None, status="success"):
+    return {"prompt": queue_item(number, client_id=client_id), "outputs": {}, "status": {"status_str": status, "completed": status == "success"}}
+
+def fill(add, count=10):
+    # clients a and b alternate, every third prompt failed
+    for i in range(count):
+        add("p{}".format(i), entry(i, "a" if i % 2 == 0 else "b", "error" if i % 3 == 0 else "success"))
+
+def ids(items):
+    return [x.prompt_id for x in items]
+
+def test_page():
+    h = history.History(100)
+    fill(h.add)
+    assert ids(h.page()) == ["p{}".format(i) for i in range(10)]
+    # the last entries by default, offset counts from the first one
+    assert ids(h.page(3)) == ["p7", "p8", "p9"]
+    assert ids(h.page(3, 2)) == ["p2", "p3", "p4"]
+    assert ids(h.page(3, 9)) == ["p9"]
+    assert ids(h.page(None, 8)) == ["p8", "p9"]
+    assert h.page(3, 20) == []
+
+def test_page_after_cursor():
+    h = history.History(100)
+    fill(h.add)
+    cursor = h.get_item("p4").cursor
+    # the entries added after the cursor, the first ones of them with max_items
+    assert ids(h.page(after=cursor)) == ["p5", "p6", "p7", "p8", "p9"]
+    assert ids(h.page(2, after=cursor)) == ["p5", "p6"]
+    assert ids(h.page(2, 1, after=cursor)) == ["p6", "p7"]
+    assert h.page(after=h.get_item("p9").cursor) == []
+
+def test_page_filters():
+    h = history.History(100)
+    fill(h.add)
+    assert ids(h.page(client_id="a")) == ["p0", "p2", "p4", "p6", "p8"]
+    assert ids(h.page(status="error")) == ["p0", "p3", "p6", "p9"]
+    assert ids(h.page(2, client_id="a")) == ["p6", "p8"]
+    assert ids(h.page(2, 1, client_id="a")) == ["p2", "p4"]
+    assert ids(h.page(client_id="a", status="error")) == ["p0", "p6"]
+    assert ids(h.page(1, client_id="a", status="error")) == ["p6"]
+    assert ids(h.page(client_id="b", status="error", after=h.get_item("p3").cursor)) == ["p9"]
+    assert ids(h.page(2, after=h.get_item("p1").cursor, client_id="a", status="success")) == ["p2", "p4"]
+    assert h.page(client_id="c") == []
+
+def test_eviction_and_delete():
+    h = history.History(4)
+    fill(h.add)
+    assert list(h) == ["p6", "p7", "p8", "p9"]
+    assert ids(h.page(client_id="a")) == ["p6", "p8"]
+    assert ids(h.page(status="error")) == ["p6", "p9"]
+
+    h.delete("p8")
+    assert list(h) == ["p6", "p7", "p9"] and len(h) == 3
+    assert ids(h.page(client_id="a")) == ["p6"]
+    # adding an entry again moves it to the end with a new cursor
+    cursor = h.get_item("p9").cursor
+    h.add("p6", entry(6, "a", "success"))
+    assert list(h) == ["p7", "p9", "p6"]
+    assert ids(h.page(after=cursor)) == ["p6"]
+    assert ids(h.page(status="error")) == ["p9"]
+
+    h.wipe()
+    assert len(h) == 0 and h.page() == []
+
+@pytest.fixture(params=["memory", "sqlite"])
+def queue(request, server, tmp_path):
+    store = None
+    if request.param == "sqlite":
+        store = SQLiteQueueStore(str(tmp_path / "queue.db"), 100)
+    q = execution.PromptQueue(server, store)
+    for i in range(10):
+        q.put(queue_item(i, client_id="a" if i % 2 == 0 else "b"))
+        item, item_id = q.get()
+        q.task_done(item_id, {}, status="error" if i % 3 == 0 else "success")
+    return q
+
+def page(q, *args, **kwargs):
+    text, cursor = q.get_history_json(None, *args, **kwargs)
+    return list(json.loads(text)), cursor
+
+def test_queue_history_pages(queue):
+    assert list(queue.get_history()) == ["p{}".format(i) for i in range(10)]
+    assert list(queue.get_history(max_items=3)) == ["p7", "p8", "p9"]
+    assert list(queue.get_history(max_items=3, offset=2)) == ["p2", "p3", "p4"]
+    assert queue.get_history("p3")["p3"]["status"]["status_str"] == "error"
+
+    assert page(queue, 3)[0] == ["p7", "p8", "p9"]
+    assert page(queue, 3, 2)[0] == ["p2", "p3", "p4"]
+    assert page(queue, None, 8)[0] == ["p8", "p9"]
+    assert page(queue, client_id="a")[0] == ["p0", "p2", "p4", "p6", "p8"]
+    assert page(queue, 2, client_id="a")[0] == ["p6", "p8"]
+    assert page(queue, client_id="b", status="error")[0] == ["p3", "p9"]
+    assert page(queue, 1, 1, client_id="a", status="success")[0] == ["p4"]
+
+def test_queue_history_cursor(queue):
+    ids, cursor = page(queue, 4, 0)
+    assert ids == ["p0", "p1", "p2", "p3"]
+    ids, cursor = page(queue, 4, after=cursor)
+    assert ids == ["p4", "p5", "p6", "p7"]
+    ids, cursor = page(queue, 4, after=cursor, status="error")
+    assert ids == ["p9"]
+    # an empty page keeps the cursor
+    assert page(queue, after=cursor) == ([], cursor)
+
+    queue.put(queue_item(10, client_id="a"))
+    item, item_id = queue.get()
+    queue.task_done(item_id, {})
+    assert page(queue, after=cursor)[0] == ["p10"]
+
+def test_sqlite_history_eviction(server, tmp_path):
+    q = execution.PromptQueue(server, SQLiteQueueStore(str(tmp_path / "queue.db"), 4))
+    for i in range(6):
+        q.put(queue_item(i))
+        item, item_id = q.get()
+        q.task_done(item_id, {})
+    assert list(q.get_history()) == ["p2", "p3", "p4", "p5"]
+    q.delete_history_item("p3")
+    assert page(q, 2)[0] == ["p4", "p5"]
+    assert page(q, 2, 0)[0] == ["p2", "p4"]
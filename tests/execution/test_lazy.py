@@ -0,0 +1,67 @@
+import pytest
+import torch
+
+import execution
+import nodes
+
+class ColorImage:
+    # records the colors it is executed with
+    calls = []
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"color": ("INT", {"default": 0})}}
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "generate"
+    CATEGORY = "test"
+
+    def generate(self, color):
+        ColorImage.calls.append(color)
+        return (torch.full((1, 8, 8, 3), color / 10),)
+
+class Switch:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"switch": ("BOOLEAN", {"default": True}),
+                             "on_true": ("IMAGE", {"lazy": True}),
+                             "on_false": ("IMAGE", {"lazy": True})}}
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "choose"
+    CATEGORY = "test"
+
+    def check_lazy_status(self, switch, on_true=None, on_false=None):
+        if switch and on_true is None:
+            return ["on_true"]
+        if not switch and on_false is None:
+            return ["on_false"]
+        return []
+
+    def choose(self, switch, on_true=None, on_false=None):
+        return (on_true if switch else on_false,)
+
+@pytest.fixture(autouse=True)
+def test_nodes(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "ColorImage", ColorImage)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "Switch", Switch)
+    monkeypatch.setattr(ColorImage, "calls", [])
+
+def prompt(switch):
+    return {"1": {"class_type": "ColorImage", "inputs": {"color": 1}},
+            "2": {"class_type": "ColorImage", "inputs": {"color": 2}},
+            "3": {"class_type": "Switch", "inputs": {"switch": switch, "on_true": ["1", 0], "on_false": ["2", 0]}},
+            "4": {"class_type": "PreviewImage", "inputs": {"images": ["3", 0]}}}
+
+def test_unused_branch_doesnt_run(server):
+    e = execution.PromptExecutor(server)
+    e.execute(prompt(True), "p0", {}, ["4"])
+    assert e.status == "success"
+    assert ColorImage.calls == [1]
+    assert set(e.outputs) == {"1", "3", "4"}
+    assert float(e.outputs["3"][0][0].mean()) == pytest.approx(0.1)
+
+    # switching runs the other branch, the first one is still there
+    e.execute(prompt(False), "p1", {}, ["4"])
+    assert ColorImage.calls == [1, 2]
+    assert float(e.outputs["3"][0][0].mean()) == pytest.approx(0.2)
@@ -0,0 +1,111 @@
+import os
+import time
+import threading
+
+import pytest
+
+import execution
+import folder_paths
+import nodes
+from comfy_execution import output_writer
+
+def slow(value, seconds=0.05):
+    time.sleep(seconds)
+    return value
+
+def fail():
+    raise OSError("disk full")
+
+@pytest.fixture
+def writer(monkeypatch):
+    writer = output_writer.OutputWriter(2, 2)
+    monkeypatch.setattr(output_writer, "writer", writer)
+    return writer
+
+def test_track(writer):
+    with writer.track() as outer:
+        writer.submit(slow, 1)
+        with writer.track() as inner:
+            writer.submit(slow, 2)
+        # writes the prompt doesn't wait for
+        untracked = writer.submit(slow, 3, track=False)
+    assert [f.result() for f in inner] == [2]
+    assert sorted(f.result() for f in outer) == [1, 2]
+    assert untracked.result() == 3
+
+def test_bounded_pending_writes(writer):
+    start = time.perf_counter()
+    futures = [writer.submit(slow, i, 0.1) for i in range(4)]
+    # the third submit waits for a slot
+    assert time.perf_counter() - start >= 0.09
+    assert [f.result() for f in futures] == [0, 1, 2, 3]
+
+def test_when_done(writer):
+    calls = []
+    output_writer.when_done([], lambda: calls.append("none"))
+    assert calls == ["none"]
+
+    done = threading.Event()
+    futures = [writer.submit(slow, i) for i in range(2)]
+    output_writer.when_done(futures, done.set)
+    assert done.wait(10)
+    assert all(f.done() for f in futures)
+
+def test_remove_failed(writer):
+    ui = {"images": [{"filename": "a.png"}, {"filename": "b.png"}], "text": ["x"]}
+    futures = [writer.submit(slow, 1, ui=ui["images"][0]), writer.submit(fail, ui=ui["images"][1])]
+    for f in futures:
+        f.exception()
+    assert output_writer.remove_failed(ui, futures) == {"images": [{"filename": "a.png"}], "text": ["x"]}
+    assert output_writer.remove_failed(ui, futures[:1]) is ui
+
+def test_synchronous_writer():
+    writer = output_writer.OutputWriter(0, 1)
+    with writer.track() as futures:
+        writer.submit(fail)
+    assert isinstance(futures[0].exception(), OSError)
+
+def test_write_file_atomic(tmp_path):
+    path = str(tmp_path / "a.png")
+    output_writer.write_file_atomic(path, lambda f: f.write(b"data"))
+    assert os.listdir(tmp_path) == ["a.png"]
+
+    def broken(f):
+        f.write(b"partial")
+        raise OSError("disk full")
+    with pytest.raises(OSError):
+        output_writer.write_file_atomic(str(tmp_path / "b.png"), broken)
+    assert os.listdir(tmp_path) == ["a.png"]
+
+def test_save_image_reports_written_files(server, writer, tmp_path, monkeypatch):
+    monkeypatch.setattr(folder_paths, "output_directory", str(tmp_path))
+    save_png = nodes.save_png
+    def save_or_fail(image, file, *args):
+        # the second image can't be written, the first one is slow
+        if file.endswith("_00002_.png"):
+            def broken(f):
+                raise OSError("disk full")
+            output_writer.write_file_atomic(file, broken)
+        time.sleep(0.2)
+        save_png(image, file, *args)
+    monkeypatch.setattr(nodes, "save_png", save_or_fail)
+
+    executed = threading.Event()
+    messages = []
+    def send_sync(event, data, sid=None):
+        if event == "executed":
+            messages.append((data["output"], {f: os.path.getsize(tmp_path / f) for f in os.listdir(tmp_path)}))
+            executed.set()
+    server.send_sync = send_sync
+
+    prompt = {"1": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 8, "batch_size": 2, "color": 0}},
+              "2": {"class_type": "SaveImage", "inputs": {"images": ["1", 0], "filename_prefix": "test"}}}
+    e = execution.PromptExecutor(server)
+    e.execute(prompt, "p0", {"client_id": "c"}, ["2"])
+    # the prompt is done before its files are written
+    assert not executed.is_set()
+    assert executed.wait(10)
+    output, files = messages[0]
+    assert [x["filename"] for x in output["images"]] == ["test_00001_.png"]
+    # the file is complete when the client hears about it
+    assert list(files) == ["test_00001_.png"] and files["test_00001_.png"] > 0
@@ -0,0 +1,90 @@
+import io
+import struct
+import asyncio
+
+from PIL import Image
+
+import server
+
+class FakeSocket:
+    closed = False
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_str(self, data):
+        self.sent.append(data)
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def close(self):
+        self.closed = True
+
+def decode(message):
+    # event type, image type, then the encoded image
+    event, image_type = struct.unpack(">II", message[:8])
+    return event, image_type, Image.open(io.BytesIO(message[8:]))
+
+async def wait_idle(s):
+    # the encoders are removed once they sent their frame
+    for i in range(500):
+        if len(s.preview_encoders) == 0:
+            return
+        await asyncio.sleep(0.01)
+    assert s.preview_encoders == {}
+
+def test_preview_size():
+    assert server.preview_size(16) == server.PREVIEW_SIZE_STEP
+    assert server.preview_size(500) == 512
+    assert server.preview_size(513) == 512
+    assert server.preview_size(10 ** 9) == server.MAX_PREVIEW_SIZE
+
+def test_encode_preview():
+    image = Image.new("RGB", (256, 128), (255, 0, 0))
+    data = server.encode_preview(image, "JPEG", 64)
+    assert struct.unpack(">I", data[:4])[0] == server.PREVIEW_TYPES["JPEG"]
+    with Image.open(io.BytesIO(data[4:])) as img:
+        assert img.format == "JPEG" and img.size == (64, 32)
+    with Image.open(io.BytesIO(server.encode_preview(image, "PNG", None)[4:])) as img:
+        assert img.format == "PNG" and img.size == (256, 128)
+
+def test_previews_per_client_settings():
+    async def run():
+        s = server.PromptServer(asyncio.get_running_loop())
+        writers = {sid: server.SocketWriter(FakeSocket()) for sid in ["a", "b", "c"]}
+        writers["b"].set_preview_settings({"format": "webp", "max_size": 100})
+        writers["c"].set_preview_settings({"format": "webp", "max_size": 120})
+        s.writers = writers
+
+        image = Image.new("RGB", (512, 256))
+        await s.send_image(["JPEG", image, None])
+        # b and c asked for sizes that round to the same one and share an encoder
+        assert sorted(s.preview_encoders) == [("JPEG", None), ("WEBP", 128)]
+        await wait_idle(s)
+
+        previews = {}
+        for sid, writer in writers.items():
+            assert len(writer.queue) == 1
+            event, image_type, img = decode(writer.queue[0][0])
+            assert event == server.BinaryEventTypes.PREVIEW_IMAGE
+            previews[sid] = (img.format, img.size)
+        assert previews == {"a": ("JPEG", (512, 256)), "b": ("WEBP", (128, 64)), "c": ("WEBP", (128, 64))}
+
+    asyncio.run(run())
+
+def test_encoders_are_dropped_when_idle():
+    async def run():
+        s = server.PromptServer(asyncio.get_running_loop())
+        writer = server.SocketWriter(FakeSocket())
+        s.writers = {"a": writer}
+        for max_size in range(16, 2048, 97):
+            writer.set_preview_settings({"max_size": max_size})
+            await s.send_image(["JPEG", Image.new("RGB", (32, 32)), None])
+            assert len(s.preview_encoders) <= 1
+            await wait_idle(s)
+        # only the latest preview is still queued, the others were replaced
+        assert len([x for x in writer.queue if x[0] is not None]) == 1
+        assert writer.dropped == 20
+
+    asyncio.run(run())
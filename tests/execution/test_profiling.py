@@ -0,0 +1,57 @@
+import time
+import threading
+
+import execution
+from comfy_execution import output_writer
+from comfy_execution import profiling
+from tests.execution.test_queue import prompt
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+def test_node_profile():
+    with profiling.NodeProfiler() as profiler:
+        spin(0.05)
+    result = profiler.result()
+    assert result["cached"] is False and "overlapped" not in result
+    assert result["wall_time"] >= 0.05 and result["cpu_time"] > 0.02
+    assert "ram_delta" in result
+
+def test_overlapping_nodes():
+    started = threading.Barrier(2, timeout=10)
+    results = {}
+
+    def run(name, work):
+        with profiling.NodeProfiler() as profiler:
+            started.wait()
+            work(0.2)
+        results[name] = profiler.result()
+
+    threads = [threading.Thread(target=run, args=("busy", spin)), threading.Thread(target=run, args=("sleeping", time.sleep))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # the process wide figures are left out, the cpu time is the one of the thread of the node
+    assert results["busy"]["overlapped"] and results["sleeping"]["overlapped"]
+    assert "ram_delta" not in results["busy"] and "ram_delta" not in results["sleeping"]
+    assert results["busy"]["cpu_time"] > 0.1
+    assert results["sleeping"]["cpu_time"] < 0.1
+    assert profiling.active == set()
+
+def test_executor_profile(server):
+    e = execution.PromptExecutor(server)
+    e.execute(prompt(), "p0", {"client_id": "c"}, ["2"])
+    written = threading.Event()
+    output_writer.when_done(e.pending_writes, written.set)
+    assert written.wait(10)
+    assert set(e.profile) == {"1", "2"}
+    assert all(x["cached"] is False and x["wall_time"] >= 0 for x in e.profile.values())
+    executed = [data for event, data, sid in server.messages if event == "executed"]
+    assert executed[0]["profile"] == e.profile["2"]
+
+    e.execute(prompt(), "p1", {"client_id": "c"}, ["2"])
+    assert e.profile == {"1": {"cached": True}, "2": {"cached": True}}
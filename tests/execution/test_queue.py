@@ -0,0 +1,57 @@
+import json
+
+import execution
+
+def prompt(color=0):
+    return {"1": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 8, "batch_size": 1, "color": color}},
+            "2": {"class_type": "PreviewImage", "inputs": {"images": ["1", 0]}}}
+
+def queue_item(number, color=0, client_id=None):
+    extra_data = {} if client_id is None else {"client_id": client_id}
+    return (number, "p{}".format(number), prompt(color), extra_data, ["2"])
+
+def test_executor_gets_a_copy(server):
+    q = execution.PromptQueue(server)
+    q.put(queue_item(0))
+    q.put(queue_item(1))
+    # a snapshot taken while the item was pending can still be serialized while it runs
+    running, pending = q.get_current_queue()
+    item, item_id = q.get()
+    assert item == pending[0] and item is not pending[0]
+
+    # the executor adds is_changed to the nodes of its prompt, the queue and its snapshots don't change
+    item[2]["1"]["is_changed"] = [0.5]
+    assert "is_changed" not in pending[0][2]["1"]
+    running, pending = q.get_current_queue()
+    assert "is_changed" not in running[0][2]["1"]
+    version, text = q.get_current_queue_json()
+    assert json.loads(text)["queue_running"][0][2] == prompt()
+
+def test_snapshot_is_reused_until_the_queue_changes(server):
+    q = execution.PromptQueue(server)
+    q.put(queue_item(0))
+    first = q.get_current_queue_json()
+    assert q.get_current_queue_json() is first
+    assert q.get_current_queue() is q.get_current_queue()
+
+    q.put(queue_item(1))
+    version, text = q.get_current_queue_json()
+    assert version > first[0]
+    assert [x[1] for x in json.loads(text)["queue_pending"]] == ["p0", "p1"]
+
+    item, item_id = q.get()
+    q.task_done(item_id, {})
+    running, pending = q.get_current_queue()
+    assert running == [] and [x[1] for x in pending] == ["p1"]
+    assert list(q.get_history()) == ["p0"]
+
+def test_delete_and_wipe(server):
+    q = execution.PromptQueue(server)
+    for i in range(4):
+        q.put(queue_item(i))
+    assert q.delete_queue_item(lambda a: a[1] == "p2")
+    assert not q.delete_queue_item(lambda a: a[1] == "missing")
+    assert [x[1] for x in q.queue] == ["p0", "p1", "p3"]
+    assert q.get_tasks_remaining() == 3
+    q.wipe_queue()
+    assert q.queue == [] and q.get_tasks_remaining() == 0
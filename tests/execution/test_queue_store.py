@@ -0,0 +1,41 @@
+import execution
+from comfy_execution import queue_store
+from comfy_execution.queue_store import SQLiteQueueStore
+from tests.execution.test_queue import queue_item
+
+def restart(server, path):
+    q = execution.PromptQueue(server, SQLiteQueueStore(str(path), 100))
+    return q, q.recover()
+
+def test_recover_requeues_pending_and_running(server, tmp_path):
+    path = tmp_path / "queue.db"
+    q, recovered = restart(server, path)
+    for i in range(3):
+        q.put(queue_item(i))
+    item, item_id = q.get()
+    q.task_done(item_id, {})
+    # p1 was running when the process stopped, p2 still pending
+    q.get()
+
+    q, recovered = restart(server, path)
+    assert recovered == 2
+    assert [x[1] for x in q.queue] == ["p1", "p2"]
+    assert list(q.get_history()) == ["p0"]
+
+def test_recover_gives_up_on_prompts_that_keep_stopping_the_process(server, tmp_path):
+    path = tmp_path / "queue.db"
+    q, recovered = restart(server, path)
+    q.put(queue_item(0))
+    q.put(queue_item(1))
+    for attempt in range(queue_store.MAX_ATTEMPTS):
+        # p0 runs, the process dies every time
+        q.get()
+        q, recovered = restart(server, path)
+
+    assert [x[1] for x in q.queue] == ["p1"]
+    entry = q.get_history("p0")["p0"]
+    assert entry["status"] == {"status_str": "error", "completed": False}
+
+    q, recovered = restart(server, path)
+    assert recovered == 1
+    assert [x[1] for x in q.queue] == ["p1"]
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+import torch
+
+import comfy.samplers
+import comfy.sampler_checkpoint
+from comfy.k_diffusion import sampling as k_diffusion_sampling
+
+class ModelSampling:
+    sigma_max = torch.tensor(14.6)
+    sigma_min = torch.tensor(0.03)
+
+class FakeModel:
+    # a deterministic denoiser, counts its calls and can stop the run at one of them
+    class inner_model:
+        model_sampling = ModelSampling
+
+    def __init__(self, interrupt_at=None):
+        self.calls = 0
+        self.interrupt_at = interrupt_at
+
+    def __call__(self, x, sigma, **kwargs):
+        self.calls += 1
+        if self.calls == self.interrupt_at:
+            raise KeyboardInterrupt()
+        return torch.tanh(x) * 0.5
+
+SIGMAS = k_diffusion_sampling.get_sigmas_karras(20, 0.03, 14.6)
+NOISE = torch.randn((1, 4, 8, 8), generator=torch.manual_seed(0))
+
+def run(model, sigmas, checkpoint=None):
+    extra_args = {"cond": None, "uncond": None, "cond_scale": 1.0}
+    return comfy.samplers.ksampler("euler").sample(model, sigmas, extra_args, None, NOISE.clone(), None, None, True, checkpoint=checkpoint)
+
+def checkpoint(directory, sigmas=SIGMAS, key="k", interval=5):
+    return comfy.sampler_checkpoint.SamplerCheckpoint(str(directory), key, interval, sigmas)
+
+def test_interrupted_run_resumes(tmp_path):
+    reference = run(FakeModel(), SIGMAS)
+    with pytest.raises(KeyboardInterrupt):
+        run(FakeModel(interrupt_at=14), SIGMAS, checkpoint(tmp_path))
+    # the latent of the last step that finished is saved on the interrupt, replacing the one of step 10
+    assert os.listdir(tmp_path) == ["k-00012.safetensors"]
+
+    model = FakeModel()
+    result = run(model, SIGMAS, checkpoint(tmp_path))
+    assert model.calls == 20 - 12
+    assert torch.allclose(result, reference)
+    # a finished run with a final sigma of 0 can't be continued, its last checkpoint stays
+    assert os.listdir(tmp_path) == ["k-00015.safetensors"]
+
+def test_longer_run_continues_a_shorter_one(tmp_path):
+    reference = run(FakeModel(), SIGMAS)
+    run(FakeModel(), SIGMAS[:11], checkpoint(tmp_path, SIGMAS[:11]))
+    assert os.listdir(tmp_path) == ["k-00010.safetensors"]
+    model = FakeModel()
+    assert torch.allclose(run(model, SIGMAS, checkpoint(tmp_path)), reference)
+    assert model.calls == 10
+
+def test_load_checks_the_run(tmp_path):
+    c = checkpoint(tmp_path)
+    for i in range(12):
+        c.step(i, torch.full((1, 4, 8, 8), float(i)))
+    assert os.listdir(tmp_path) == ["k-00010.safetensors"]
+
+    step, x = checkpoint(tmp_path).load((1, 4, 8, 8))
+    assert step == 10 and float(x.mean()) == 10.0
+    # other latent shape, other sigmas, other key
+    assert checkpoint(tmp_path).load((1, 4, 16, 16)) is None
+    assert checkpoint(tmp_path, SIGMAS * 2).load((1, 4, 8, 8)) is None
+    assert checkpoint(tmp_path, key="other").load((1, 4, 8, 8)) is None
+
+def test_resumable_samplers():
+    assert comfy.sampler_checkpoint.resumable("euler")
+    assert not comfy.sampler_checkpoint.resumable("euler_ancestral")
+    assert not comfy.sampler_checkpoint.resumable("dpmpp_2m")
+
+def test_prune(tmp_path, monkeypatch):
+    monkeypatch.setattr(comfy.sampler_checkpoint, "MAX_CHECKPOINTS", 2)
+    for i in range(4):
+        c = checkpoint(tmp_path, key="k{}".format(i))
+        c.step(5, torch.zeros((1, 4, 8, 8)))
+        os.utime(c.path(5), (i, i))
+    c = checkpoint(tmp_path, key="k4")
+    c.step(5, torch.zeros((1, 4, 8, 8)))
+    assert sorted(os.listdir(tmp_path)) == ["k3-00005.safetensors", "k4-00005.safetensors"]
@@ -0,0 +1,165 @@
+import pytest
+import torch
+
+import nodes
+from comfy_execution import scheduling
+
+def item(number, client_id=None, priority_class=None, prompt_id=None):
+    extra_data = {}
+    if client_id is not None:
+        extra_data["client_id"] = client_id
+    if priority_class is not None:
+        extra_data["priority_class"] = priority_class
+    return (number, prompt_id or "p{}".format(number), {}, extra_data, [])
+
+def drain(scheduler):
+    out = []
+    while len(scheduler) > 0:
+        out.append(scheduler.pop())
+    return out
+
+def test_clients_alternate():
+    s = scheduling.FairScheduler()
+    # a queues 4 prompts before b queues 2
+    for i in range(4):
+        s.put(item(i, "a"))
+    s.put(item(4, "b"))
+    s.put(item(5, "b"))
+    assert [x[3]["client_id"] for x in drain(s)] == ["a", "b", "a", "b", "a", "a"]
+    assert s.pop() is None
+
+def test_prompts_of_a_client_keep_their_order():
+    s = scheduling.FairScheduler()
+    for i in [3, 1, 2]:
+        s.put(item(i, "a"))
+    assert [x[0] for x in drain(s)] == [1, 2, 3]
+
+def test_weights():
+    s = scheduling.FairScheduler()
+    s.set_weight("a", 2)
+    for i in range(6):
+        s.put(item(i, "a"))
+        s.put(item(10 + i, "b"))
+    order = [x[3]["client_id"] for x in drain(s)][:9]
+    assert order.count("a") == 6 and order.count("b") == 3
+
+    with pytest.raises(ValueError):
+        s.set_weight("a", 0)
+
+def test_idle_clients_dont_keep_credit():
+    s = scheduling.FairScheduler()
+    for i in range(4):
+        s.put(item(i, "a"))
+    drain(s)
+    # b was idle while a ran, it doesn't get to run all of its prompts first
+    for i in range(4, 8):
+        s.put(item(i, "a"))
+        s.put(item(10 + i, "b"))
+    assert [x[3]["client_id"] for x in drain(s)][:4] in (["a", "b", "a", "b"], ["b", "a", "b", "a"])
+
+def test_front_items_go_first():
+    s = scheduling.FairScheduler()
+    s.put(item(0, "a"))
+    s.put(item(1, "b"))
+    s.put(item(-2, "b"))
+    s.put(item(-1, "a"))
+    assert [x[0] for x in drain(s)] == [-2, -1, 0, 1]
+
+def test_priority_classes():
+    s = scheduling.FairScheduler()
+    s.put(item(0, "a", "batch"))
+    s.put(item(1, "b", "batch"))
+    s.put(item(2, "a"))
+    s.put(item(3, "c", "unknown"))
+    assert [x[0] for x in drain(s)] == [2, 3, 0, 1]
+
+    status = s.status()
+    assert status["interactive"]["started"] == 2 and status["batch"]["started"] == 2
+    assert status["batch"]["pending"] == 0
+
+def test_remove_and_clear():
+    s = scheduling.FairScheduler()
+    items = [item(i, "a" if i % 2 else "b") for i in range(5)]
+    for x in items:
+        s.put(x)
+    s.remove(items[2])
+    assert "p2" not in s and "p3" in s
+    assert len(s) == 4
+    assert sorted(x[0] for x in s) == [0, 1, 3, 4]
+    s.clear()
+    assert len(s) == 0 and s.pop() is None
+    assert s.status()["interactive"]["pending"] == 0
+
+def test_client_weights_option(server, monkeypatch):
+    import execution
+    monkeypatch.setattr(execution.args, "client_weights", [("a", 3.0)])
+    q = execution.PromptQueue(server)
+    for i in range(4):
+        q.put(item(i, "a"))
+        q.put(item(10 + i, "b"))
+    order = [q.get()[0][3]["client_id"] for i in range(4)]
+    assert order.count("a") == 3
+
+def checkpoint_item(number, client_id, ckpt_name):
+    prompt = {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt_name}}}
+    return (number, "p{}".format(number), prompt, {"client_id": client_id}, [])
+
+def test_model_affinity():
+    s = scheduling.FairScheduler()
+    # a uses model A, b uses model B and is next
+    s.put(checkpoint_item(0, "b", "B"))
+    s.put(checkpoint_item(1, "a", "A"))
+    s.put(checkpoint_item(2, "a", "A"))
+    resident = scheduling.model_keys(checkpoint_item(1, "a", "A")[2])
+    # the prompts using A run first, b's prompt is skipped at most once
+    assert s.pop(resident, max_skips=1)[0] == 1
+    assert s.pop(resident, max_skips=1)[0] == 0
+    assert s.pop(resident, max_skips=1)[0] == 2
+    assert s.reordered == 1
+
+    s.put(checkpoint_item(3, "b", "B"))
+    s.put(checkpoint_item(4, "a", "A"))
+    assert s.pop(resident)[0] == 3
+    assert s.reordered == 1
+
+class FakeLoader:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"name": ("STRING", {"default": ""})}}
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "load"
+    CATEGORY = "loaders"
+
+    def load(self, name):
+        return (torch.zeros((1, 8, 8, 3)),)
+
+def loader_prompt(name):
+    return {"1": {"class_type": "FakeLoader", "inputs": {"name": name}},
+            "2": {"class_type": "PreviewImage", "inputs": {"images": ["1", 0]}}}
+
+def test_loads_avoided(server, monkeypatch):
+    import execution
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "FakeLoader", FakeLoader)
+    monkeypatch.setattr(execution.args, "model_affinity", 1)
+    q = execution.PromptQueue(server)
+    e = execution.PromptExecutor(server)
+    # b's prompt is next but a's second prompt uses the model that is still loaded
+    q.put((0, "p0", loader_prompt("A"), {"client_id": "a"}, ["2"]))
+    q.put((1, "p1", loader_prompt("B"), {"client_id": "b"}, ["2"]))
+    q.put((2, "p2", loader_prompt("A"), {"client_id": "a"}, ["2"]))
+
+    resident = None
+    order = []
+    for i in range(3):
+        item, item_id = q.get(resident=resident)
+        e.execute(item[2], item[1], item[3], item[4])
+        q.record_execution([item[1]], 0.1, e.reused_loads)
+        q.task_done(item_id, e.outputs_ui)
+        resident = scheduling.model_keys(item[2])
+        order.append((item[1], e.reused_loads))
+
+    # p2 found the loader output of p0, p1 had to load its model
+    assert order == [("p0", 0), ("p2", 1), ("p1", 0)]
+    assert q.get_affinity_status() == {"reordered": 1, "loads_avoided": 1}
+    assert q.scheduler.affinity_picks == set()
@@ -0,0 +1,109 @@
+import json
+import asyncio
+
+import server
+from tests.execution.test_previews import FakeSocket
+
+class BlockedSocket(FakeSocket):
+    # a client that doesn't read, sends never finish until released
+    def __init__(self):
+        super().__init__()
+        self.release = asyncio.Event()
+
+    async def send_str(self, data):
+        await self.release.wait()
+        await super().send_str(data)
+
+async def wait_sent(ws, count):
+    for i in range(500):
+        if len(ws.sent) >= count:
+            return
+        await asyncio.sleep(0.01)
+    assert len(ws.sent) >= count
+
+def events(ws):
+    return [(m["type"], m["data"]) for m in map(json.loads, ws.sent)]
+
+def test_messages_are_sent_in_order():
+    async def run():
+        ws = FakeSocket()
+        writer = server.SocketWriter(ws)
+        writer.start()
+        for i in range(10):
+            writer.put(json.dumps({"type": "executing", "data": i}))
+        writer.put(b"binary")
+        await wait_sent(ws, 11)
+        assert [json.loads(m)["data"] for m in ws.sent[:10]] == list(range(10))
+        assert ws.sent[10] == b"binary"
+        assert writer.count == 0 and len(writer.queue) == 0
+        writer.close()
+    asyncio.run(run())
+
+def test_only_the_latest_message_of_a_kind_is_sent():
+    async def run():
+        ws = FakeSocket()
+        writer = server.SocketWriter(ws)
+        # queued before the writer runs, like for a client that lags behind
+        writer.put(json.dumps({"type": "executing", "data": "a"}))
+        for i in range(20):
+            writer.put(json.dumps({"type": "progress", "data": i}), "progress")
+        writer.put(json.dumps({"type": "status", "data": 0}), "status")
+        writer.put(json.dumps({"type": "executing", "data": "b"}))
+        writer.put(json.dumps({"type": "progress", "data": 20}), "progress")
+        assert writer.dropped == 20
+        # the replaced messages don't pile up in the queue
+        assert len(writer.queue) <= 2 * (writer.count + len(writer.latest)) + 1
+
+        writer.start()
+        await wait_sent(ws, 4)
+        await asyncio.sleep(0.05)
+        assert events(ws) == [("executing", "a"), ("status", 0), ("executing", "b"), ("progress", 20)]
+        writer.close()
+    asyncio.run(run())
+
+def test_slow_client_is_disconnected():
+    async def run():
+        ws = BlockedSocket()
+        writer = server.SocketWriter(ws, max_messages=5)
+        writer.start()
+        for i in range(5):
+            writer.put(json.dumps({"type": "executing", "data": i}))
+        # messages with a kind don't count, they replace each other
+        for i in range(100):
+            writer.put(json.dumps({"type": "progress", "data": i}), "progress")
+        await asyncio.sleep(0.05)
+        # the first message is being sent, it doesn't count
+        writer.put(json.dumps({"type": "executing", "data": 5}))
+        assert not writer.closed and writer.count == 5
+
+        writer.put(json.dumps({"type": "executing", "data": 6}))
+        assert writer.closed
+        await asyncio.sleep(0.05)
+        assert ws.closed and ws.sent == []
+        # nothing is queued once it is closed
+        writer.put(json.dumps({"type": "executing", "data": 7}))
+        assert len(writer.queue) == 0
+    asyncio.run(run())
+
+def test_slow_client_does_not_hold_up_the_others():
+    async def run():
+        s = server.PromptServer(asyncio.get_running_loop())
+        slow, fast = BlockedSocket(), FakeSocket()
+        s.writers = {"slow": server.SocketWriter(slow), "fast": server.SocketWriter(fast)}
+        for writer in s.writers.values():
+            writer.start()
+
+        for i in range(5):
+            await s.send_json("executing", {"node": str(i)})
+        await s.send_json("progress", {"value": 1}, "slow")
+        await wait_sent(fast, 5)
+        assert [data["node"] for event, data in events(fast)] == ["0", "1", "2", "3", "4"]
+        assert slow.sent == []
+
+        slow.release.set()
+        await wait_sent(slow, 6)
+        assert events(slow)[-1] == ("progress", {"value": 1})
+        assert len(fast.sent) == 5
+        for writer in s.writers.values():
+            writer.close()
+    asyncio.run(run())
@@ -0,0 +1,100 @@
+import os
+import asyncio
+import threading
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import execution
+import folder_paths
+import server
+import uploads
+
+def upload(tmp_path, content):
+    writer = uploads.UploadWriter(str(tmp_path / "incoming"), "image.png", 1024)
+    writer.write(content)
+    return writer.path, writer.close()
+
+def store(tmp_path, content, filename="image.png", overwrite=False, index=None):
+    path, digest = upload(tmp_path, content)
+    return uploads.store(path, digest, str(tmp_path / "input"), filename, overwrite, index)
+
+def read(tmp_path, filename):
+    with open(tmp_path / "input" / filename, "rb") as f:
+        return f.read()
+
+def test_store_reuses_identical_content(tmp_path):
+    index = uploads.UploadIndex()
+    assert store(tmp_path, b"a", index=index) == ("image.png", True)
+    assert store(tmp_path, b"a", index=index) == ("image.png", False)
+    # the same content uploaded under another name reuses the stored file
+    assert store(tmp_path, b"a", "other.png", index=index) == ("image.png", False)
+    # a fresh index finds it by comparing with the file of the same name
+    assert store(tmp_path, b"a", index=uploads.UploadIndex()) == ("image.png", False)
+    assert os.listdir(tmp_path / "incoming") == []
+
+def test_store_renames_or_overwrites(tmp_path):
+    index = uploads.UploadIndex()
+    store(tmp_path, b"a", index=index)
+    assert store(tmp_path, b"b", index=index) == ("image (1).png", True)
+    assert store(tmp_path, b"c", index=index) == ("image (2).png", True)
+    assert store(tmp_path, b"d", overwrite=True, index=index) == ("image.png", True)
+    assert read(tmp_path, "image.png") == b"d"
+    assert read(tmp_path, "image (1).png") == b"b"
+
+def test_index_checks_the_file(tmp_path):
+    index = uploads.UploadIndex()
+    store(tmp_path, b"a", index=index)
+    with open(tmp_path / "input" / "image.png", "wb") as f:
+        f.write(b"changed")
+    assert store(tmp_path, b"a", "other.png", index=index) == ("other.png", True)
+
+def test_concurrent_uploads_get_distinct_names(tmp_path):
+    index = uploads.UploadIndex()
+    files = [upload(tmp_path, str(i).encode()) for i in range(8)]
+    results = []
+    barrier = threading.Barrier(len(files))
+
+    def run(path, digest):
+        barrier.wait()
+        results.append(uploads.store(path, digest, str(tmp_path / "input"), "image.png", False, index))
+
+    threads = [threading.Thread(target=run, args=x) for x in files]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(name for name, written in results)) == len(files)
+    assert sorted(read(tmp_path, name) for name, written in results) == [str(i).encode() for i in range(8)]
+
+def test_upload_too_large(tmp_path):
+    writer = uploads.UploadWriter(str(tmp_path), "image.png", 4)
+    writer.write(b"1234")
+    with pytest.raises(uploads.UploadTooLarge):
+        writer.write(b"5")
+    writer.discard()
+    assert os.listdir(tmp_path) == []
+
+def test_form_fields_are_limited(tmp_path, monkeypatch):
+    monkeypatch.setattr(folder_paths, "temp_directory", str(tmp_path))
+
+    async def post(client, **fields):
+        form = aiohttp.FormData()
+        form.add_field("image", b"a", filename="image.png", content_type="image/png")
+        for k, v in fields.items():
+            form.add_field(k, v)
+        return (await client.post("/upload/image", data=form)).status
+
+    async def run():
+        s = server.PromptServer(asyncio.get_running_loop())
+        execution.PromptQueue(s)
+        s.add_routes()
+        async with TestClient(TestServer(s.app)) as client:
+            # the other fields are read with a limit on their total size
+            assert await post(client, type="temp", subfolder="x" * uploads.MAX_FIELDS_SIZE) == 413
+            assert await post(client, type="temp", a="x" * 1024, b="x" * 1024, c="x" * (uploads.MAX_FIELDS_SIZE - 2048)) == 413
+            assert await post(client, type="temp", subfolder="uploaded") == 200
+        assert os.listdir(tmp_path / "uploaded") == ["image.png"]
+
+    asyncio.run(run())
@@ -0,0 +1,52 @@
+import pytest
+
+import execution
+import nodes
+from comfy_execution import validation
+
+class CheckedImage:
+    # valid as long as the class says so, like a node checking a file in VALIDATE_INPUTS
+    valid = True
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"value": ("INT", {"default": 0})}}
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "load"
+    CATEGORY = "test"
+
+    @classmethod
+    def VALIDATE_INPUTS(s, value):
+        return s.valid or "invalid"
+
+@pytest.fixture(autouse=True)
+def test_nodes(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "CheckedImage", CheckedImage)
+    monkeypatch.setattr(CheckedImage, "valid", True)
+
+def prompt():
+    return {"1": {"class_type": "CheckedImage", "inputs": {"value": "3"}},
+            "2": {"class_type": "PreviewImage", "inputs": {"images": ["1", 0]}}}
+
+def validate(p, unique_id="2"):
+    return execution.validate_inputs(p, unique_id, {}, validation.compute_validation_keys(p))
+
+def test_memoized_nodes_keep_their_converted_values():
+    validate(prompt())
+    p = prompt()
+    keys = validation.compute_validation_keys(p)
+    assert validation.cache.get(keys["1"]) is not None and validation.cache.get(keys["2"]) is not None
+    assert validate(p)[0] is True
+    assert p["1"]["inputs"]["value"] == 3
+
+def test_memoized_node_with_a_failing_linked_node():
+    assert validate(prompt())[0] is True
+    # the linked node got evicted and fails now, the memoized node downstream of it fails with it
+    keys = validation.compute_validation_keys(prompt())
+    assert validation.cache.get(keys["2"]) is not None
+    validation.cache.cache.pop(keys["1"])
+    CheckedImage.valid = False
+    validated = {}
+    assert execution.validate_inputs(prompt(), "2", validated, keys)[0] is False
+    assert validated["1"][0] is False
@@ -0,0 +1,46 @@
+import io
+
+from PIL import Image
+
+import view_cache
+
+def test_view_params():
+    params = view_cache.ViewParams({})
+    assert not params.transformed()
+    assert params.values() == [None, 90, "rgba", None]
+
+    assert view_cache.ViewParams({"preview": "jpeg;50"}).values() == ["jpeg", 50, "rgba", None]
+    # unknown formats and previews of the alpha channel are webp
+    assert view_cache.ViewParams({"preview": "gif"}).values() == ["webp", 90, "rgba", None]
+    assert view_cache.ViewParams({"preview": "jpeg", "channel": "a"}).values() == ["webp", 90, "a", None]
+    assert view_cache.ViewParams({"channel": "rgb"}).transformed()
+    assert view_cache.ViewParams({"max_size": "256"}).max_size == 256
+    for max_size in ["0", "-1", "big"]:
+        assert view_cache.ViewParams({"max_size": max_size}).max_size is None
+
+def test_transcode(tmp_path):
+    path = str(tmp_path / "image.png")
+    Image.new("RGBA", (64, 32), (255, 0, 0, 128)).save(path)
+
+    body, image_format = view_cache.transcode(path, view_cache.ViewParams({"max_size": "16"}))
+    with Image.open(io.BytesIO(body)) as img:
+        assert image_format == "png" and img.size == (16, 8)
+    body, image_format = view_cache.transcode(path, view_cache.ViewParams({"channel": "a"}))
+    with Image.open(io.BytesIO(body)) as img:
+        assert img.getpixel((0, 0))[3] == 128
+    body, image_format = view_cache.transcode(path, view_cache.ViewParams({"preview": "jpeg;80"}))
+    assert image_format == "jpeg" and body[:2] == b"\xff\xd8"
+
+def test_transcode_cache(tmp_path):
+    path = str(tmp_path / "image.png")
+    Image.new("RGB", (8, 8)).save(path)
+    cache = view_cache.TranscodeCache(100, str(tmp_path / "cache"))
+    params = view_cache.ViewParams({"preview": "webp"})
+    key = cache.key(path, params)
+    assert key != cache.key(path, view_cache.ViewParams({})) and cache.key(str(tmp_path / "missing.png"), params) is None
+
+    cache.set(key, b"x" * 60, "webp")
+    cache.set("other", b"y" * 60, "webp")
+    # evicted from memory, still on disk
+    assert list(cache.entries) == ["other"]
+    assert cache.get(key) == (b"x" * 60, "webp")
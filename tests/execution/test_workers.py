@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import pytest
+import torch
+from aiohttp.test_utils import TestClient, TestServer
+
+import execution
+import nodes
+import server
+import comfy.model_management
+from tests.execution.conftest import FakeServer
+
+"""
+Several prompt workers, each with its own executor, taking prompts from the same PromptQueue on the cpu
+"""
+
+class WaitForRelease:
+    # blocks until the test releases it, then checks the interrupt flag of the worker running it
+    arrived = None
+    release = None
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"images": ("IMAGE",)}}
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "wait"
+    OUTPUT_NODE = True
+    CATEGORY = "test"
+
+    def wait(self, images):
+        WaitForRelease.arrived.wait()
+        WaitForRelease.release.wait()
+        comfy.model_management.throw_exception_if_processing_interrupted()
+        return {"ui": {"value": [images.shape[0]]}, "result": (images,)}
+
+def prompt(color, wait=False):
+    graph = {"1": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 8, "batch_size": 1, "color": color}},
+             "2": {"class_type": "ImageInvert", "inputs": {"image": ["1", 0]}}}
+    if wait:
+        graph["3"] = {"class_type": "WaitForRelease", "inputs": {"images": ["2", 0]}}
+    return graph
+
+def run_worker(q, index, interrupt_flag, results):
+    comfy.model_management.set_worker_device(torch.device("cpu"))
+    comfy.model_management.set_worker_interrupt(interrupt_flag)
+    e = execution.PromptExecutor(FakeServer())
+    while True:
+        queue_item = q.get(timeout=0.5)
+        if queue_item is None:
+            return
+        item, item_id = queue_item
+        e.execute(item[2], item[1], item[3], item[4])
+        results.append((index, item[1], e.status))
+        q.task_done(item_id, e.outputs_ui, e.profile, e.status)
+
+def start_workers(q, count):
+    results = []
+    flags = [comfy.model_management.InterruptFlag() for i in range(count)]
+    threads = [threading.Thread(target=run_worker, args=(q, i, flags[i], results), daemon=True) for i in range(count)]
+    for t in threads:
+        t.start()
+    return threads, flags, results
+
+@pytest.fixture
+def wait_node(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "WaitForRelease", WaitForRelease)
+    monkeypatch.setattr(WaitForRelease, "arrived", threading.Barrier(3, timeout=30))
+    monkeypatch.setattr(WaitForRelease, "release", threading.Event())
+    return WaitForRelease
+
+def test_two_cpu_workers_share_the_queue(server, wait_node):
+    q = execution.PromptQueue(server)
+    # the first two prompts wait for each other so both workers run one at the same time
+    q.put((0, "p0", prompt(0, wait=True), {}, ["3"]))
+    q.put((1, "p1", prompt(1, wait=True), {}, ["3"]))
+    for i in range(2, 6):
+        q.put((i, "p{}".format(i), prompt(i), {}, ["2"]))
+
+    threads, flags, results = start_workers(q, 2)
+    wait_node.arrived.wait()
+    wait_node.release.set()
+    for t in threads:
+        t.join(timeout=30)
+
+    assert sorted(x[1] for x in results) == ["p{}".format(i) for i in range(6)]
+    assert set(x[0] for x in results) == {0, 1}
+    assert all(x[2] == "success" for x in results)
+    assert q.get_tasks_remaining() == 0
+    history = q.get_history()
+    assert len(history) == 6
+    assert all(history[x]["status"]["status_str"] == "success" for x in history)
+
+def test_interrupt_only_stops_its_worker(server, wait_node):
+    q = execution.PromptQueue(server)
+    q.put((0, "p0", prompt(0, wait=True), {}, ["3"]))
+    q.put((1, "p1", prompt(1, wait=True), {}, ["3"]))
+
+    threads, flags, results = start_workers(q, 2)
+    wait_node.arrived.wait()
+    comfy.model_management.interrupt_worker(flags[1])
+    wait_node.release.set()
+    for t in threads:
+        t.join(timeout=30)
+
+    status = {index: s for index, prompt_id, s in results}
+    assert status == {0: "success", 1: "interrupted"}
+    # the flag was cleared by the worker it interrupted
+    assert not flags[1].value
+
+def test_interrupt_route(monkeypatch):
+    monkeypatch.setattr(execution.args, "dedupe_prompts", True)
+
+    async def run():
+        s = server.PromptServer(asyncio.get_running_loop())
+        q = execution.PromptQueue(s)
+        s.add_routes()
+        s.set_workers([None, None])
+        s.workers[0].interrupt_flag = comfy.model_management.InterruptFlag()
+        q.put((0, "p0", prompt(0), {"client_id": "a"}, ["2"]))
+        q.put((1, "p1", prompt(0), {"client_id": "b"}, ["2"]))
+        q.put((2, "p2", prompt(2), {"client_id": "c"}, ["2"]))
+        for worker in s.workers:
+            item, item_id = q.get()
+            worker.running = [item[1]]
+            worker.client_id = item[3]["client_id"]
+
+        async with TestClient(TestServer(s.app)) as client:
+            for body in ["null", "[]", '"p0"', "{"]:
+                r = await client.post("/interrupt", data=body)
+                assert r.status == 400
+            assert not any(w.interrupt_flag.value for w in s.workers)
+
+            # p1 is identical to p0 and runs with it on the first worker
+            r = await client.post("/interrupt", json={"prompt_id": "p1"})
+            assert r.status == 200
+            assert [w.interrupt_flag.value for w in s.workers] == [True, False]
+            r = await client.post("/interrupt", json={"client_id": "c"})
+            assert [w.interrupt_flag.value for w in s.workers] == [True, True]
+
+    asyncio.run(run())
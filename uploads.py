@@ -0,0 +1,153 @@
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+# the request body is handed to the worker thread in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+# total size of the other fields of an upload form (type, subfolder, overwrite, original_ref)
+MAX_FIELDS_SIZE = 64 * 1024
+
+class UploadTooLarge(Exception):
+    pass
+
+class UploadWriter:
+    """
+    Writes an uploaded file to a temporary file while hashing it. write and close block,
+    call them from a worker thread.
+    """
+    def __init__(self, directory, filename, max_size):
+        self.filename = filename
+        self.max_size = max_size
+        self.size = 0
+        self.hash = hashlib.sha256()
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise UploadTooLarge()
+        self.file.write(chunk)
+        self.hash.update(chunk)
+
+    def close(self):
+        self.file.close()
+        return self.hash.hexdigest()
+
+    def discard(self):
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class UploadIndex:
+    """
+    The content hash of the files uploaded to every folder, an upload with the same content as
+    one of them reuses the stored file. Entries are checked against the file size and mtime.
+    """
+    def __init__(self):
+        self.files = {}
+        self.folder_locks = {}
+        self.lock = threading.Lock()
+
+    def folder_lock(self, folder):
+        with self.lock:
+            return self.folder_locks.setdefault(os.path.abspath(folder), threading.Lock())
+
+    def find(self, folder, digest):
+        with self.lock:
+            entry = self.files.get((folder, digest), None)
+        if entry is None:
+            return None
+        filename, state = entry
+        if file_state(os.path.join(folder, filename)) != state:
+            with self.lock:
+                self.files.pop((folder, digest), None)
+            return None
+        return filename
+
+    def add(self, folder, filename, digest):
+        state = file_state(os.path.join(folder, filename))
+        with self.lock:
+            self.files[(folder, digest)] = (filename, state)
+
+def file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+def unique_filename(folder, filename):
+    """filename or the first free "name (i).ext" in folder, with a single directory listing"""
+    existing = set(os.listdir(folder))
+    if filename not in existing:
+        return filename
+    name, ext = os.path.splitext(filename)
+    pattern = re.compile(re.escape(name) + r" \((\d+)\)" + re.escape(ext) + "$")
+    used = set(int(m.group(1)) for m in map(pattern.match, existing) if m is not None)
+    i = 1
+    while i in used:
+        i += 1
+    return f"{name} ({i}){ext}"
+
+def store(path, digest, folder, filename, overwrite, index):
+    """
+    Moves the temporary file path with content hash digest to folder, returns the name it's stored under and
+    if a new file was written. Unless overwrite is set, identical content that is already stored under the
+    requested name or a previously uploaded one isn't written again and a taken name gets a " (i)" suffix.
+    """
+    os.makedirs(folder, exist_ok=True)
+    # uploads are stored concurrently: the lookup, the choice of the name and the move are done
+    # under a lock per folder so two uploads with the same name can't both pick the same free one
+    with index.folder_lock(folder):
+        target = os.path.join(folder, filename)
+        if not overwrite:
+            existing = index.find(folder, digest)
+            if existing is None and os.path.isfile(target) and os.path.getsize(target) == os.path.getsize(path) and file_hash(target) == digest:
+                existing = filename
+            if existing is not None:
+                os.remove(path)
+                index.add(folder, existing, digest)
+                return existing, False
+            filename = unique_filename(folder, filename)
+            target = os.path.join(folder, filename)
+        shutil.move(path, target)
+        index.add(folder, filename, digest)
+    return filename, True
+
+def composite_mask(mask_path, original_file, directory):
+    """
+    Writes the original image with the alpha channel of the mask to a temporary png in directory,
+    returns its path and content hash.
+    """
+    with Image.open(original_file) as original_pil:
+        metadata = PngInfo()
+        if hasattr(original_pil,'text'):
+            for key in original_pil.text:
+                metadata.add_text(key, original_pil.text[key])
+        original_pil = original_pil.convert('RGBA')
+        with Image.open(mask_path) as mask_pil:
+            mask_pil = mask_pil.convert('RGBA')
+
+            # alpha copy
+            new_alpha = mask_pil.getchannel('A')
+            original_pil.putalpha(new_alpha)
+    fd, path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+    with os.fdopen(fd, "wb") as f:
+        original_pil.save(f, format="PNG", compress_level=4, pnginfo=metadata)
+    return path, file_hash(path)
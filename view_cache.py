@@ -0,0 +1,167 @@
+import os
+import io
+import glob
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+# encoded images kept in the directory of the disk cache
+DISK_CACHE_SIZE = 1024 * 1024 * 1024
+
+CONTENT_TYPES = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+
+class ViewParams:
+    """
+    How /view transforms an image: preview format and quality, channel split and maximum size.
+    """
+    def __init__(self, query):
+        self.preview = None
+        self.quality = 90
+        if 'preview' in query:
+            preview_info = query['preview'].split(';')
+            self.preview = preview_info[0]
+            if self.preview not in ['webp', 'jpeg'] or 'a' in query.get('channel', ''):
+                self.preview = 'webp'
+            if preview_info[-1].isdigit():
+                self.quality = int(preview_info[-1])
+        self.channel = query.get('channel', 'rgba')
+        self.max_size = None
+        if query.get('max_size', '').isdigit() and int(query['max_size']) > 0:
+            self.max_size = int(query['max_size'])
+
+    def transformed(self):
+        return self.preview is not None or self.channel in ('rgb', 'a') or self.max_size is not None
+
+    def values(self):
+        return [self.preview, self.quality, self.channel, self.max_size]
+
+def transcode(file, params):
+    """returns (body, image format) of the image transformed like /view does"""
+    with Image.open(file) as img:
+        if params.max_size is not None and max(img.size) > params.max_size:
+            img.thumbnail((params.max_size, params.max_size), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        if params.preview is not None:
+            image_format = params.preview
+            if image_format in ['jpeg'] or params.channel == 'rgb':
+                img = img.convert("RGB")
+            img.save(buffer, format=image_format, quality=params.quality)
+            return buffer.getvalue(), image_format
+
+        if params.channel == 'rgb':
+            if img.mode == "RGBA":
+                r, g, b, a = img.split()
+                new_img = Image.merge('RGB', (r, g, b))
+            else:
+                new_img = img.convert("RGB")
+        elif params.channel == 'a':
+            if img.mode == "RGBA":
+                _, _, _, a = img.split()
+            else:
+                a = Image.new('L', img.size, 255)
+
+            # alpha img
+            new_img = Image.new('RGBA', img.size)
+            new_img.putalpha(a)
+        else:
+            new_img = img
+        new_img.save(buffer, format='PNG')
+        return buffer.getvalue(), 'png'
+
+class TranscodeCache:
+    """
+    Bounded LRU cache of the images transformed by /view in memory, and optionally in a directory.
+    The keys change with the file modification time so there is nothing to invalidate.
+    """
+    def __init__(self, max_size, directory=None, max_disk_size=DISK_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.directory = directory
+        self.max_disk_size = max_disk_size
+        self.disk_size = None
+        self.lock = threading.Lock()
+
+    def key(self, file, params):
+        """key of the transformed file, also used as its ETag. None if the file doesn't exist"""
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+        data = repr([os.path.abspath(file), stat.st_mtime_ns, stat.st_size] + params.values())
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key):
+        """returns (body, image format) or None"""
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.directory is None:
+            return None
+        for path in glob.glob(os.path.join(glob.escape(self.directory), key + ".*")):
+            try:
+                with open(path, "rb") as f:
+                    body = f.read()
+                os.utime(path)
+            except OSError:
+                continue
+            image_format = os.path.splitext(path)[1][1:]
+            self.set_memory(key, body, image_format)
+            return body, image_format
+        return None
+
+    def set(self, key, body, image_format):
+        self.set_memory(key, body, image_format)
+        if self.directory is not None:
+            self.set_disk(key, body, image_format)
+
+    def set_memory(self, key, body, image_format):
+        if len(body) > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (body, image_format)
+            self.size += len(body)
+            while self.size > self.max_size:
+                _, (old, _) = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+    def set_disk(self, key, body, image_format):
+        path = os.path.join(self.directory, "{}.{}".format(key, image_format))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(body)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning("Failed to write view cache file {}: {}".format(path, e))
+            return
+
+        with self.lock:
+            if self.disk_size is None:
+                self.disk_size = sum(os.path.getsize(x) for x in self.disk_files())
+            else:
+                self.disk_size += len(body)
+            if self.disk_size <= self.max_disk_size:
+                return
+            # the least recently used files until it's back under 90% of the size
+            files = sorted(self.disk_files(), key=lambda a: os.path.getmtime(a))
+            for x in files:
+                if self.disk_size <= self.max_disk_size * 0.9:
+                    break
+                try:
+                    size = os.path.getsize(x)
+                    os.remove(x)
+                    self.disk_size -= size
+                except OSError:
+                    pass
+
+    def disk_files(self):
+        return [x for x in glob.glob(os.path.join(glob.escape(self.directory), "*.*")) if not x.endswith(".tmp")]
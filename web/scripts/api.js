@@ -1,5 +1,6 @@
 class ComfyApi extends EventTarget {
 	#registered = new Set();
+	#previewSettings = null;
 
 	constructor() {
 		super();
@@ -35,6 +36,17 @@ class ComfyApi extends EventTarget {
 		}, 1000);
 	}
 
+	/**
+	 * Sets how this client gets the live previews, kept across reconnects
+	 * @param {{max_fps?: number, max_size?: number, format?: "jpeg" | "png" | "webp"}} settings
+	 */
+	setPreviewSettings(settings) {
+		this.#previewSettings = settings;
+		if (this.socket?.readyState === WebSocket.OPEN) {
+			this.socket.send(JSON.stringify({ type: "preview_settings", data: settings }));
+		}
+	}
+
 	/**
 	 * Creates and connects a WebSocket for realtime updates
 	 * @param {boolean} isReconnect If the socket is connection is a reconnect attempt
@@ -56,6 +68,9 @@ class ComfyApi extends EventTarget {
 
 		this.socket.addEventListener("open", () => {
 			opened = true;
+			if (this.#previewSettings) {
+				this.socket.send(JSON.stringify({ type: "preview_settings", data: this.#previewSettings }));
+			}
 			if (isReconnect) {
 				this.dispatchEvent(new CustomEvent("reconnected"));
 			}
@@ -97,6 +112,9 @@ class ComfyApi extends EventTarget {
 								break;
 							case 2:
 								imageMime = "image/png"
+								break;
+							case 3:
+								imageMime = "image/webp";
 						}
 						const imageBlob = new Blob([buffer.slice(4)], { type: imageMime });
 						this.dispatchEvent(new CustomEvent("b_preview", { detail: imageBlob }));
@@ -240,7 +258,7 @@ class ComfyApi extends EventTarget {
 				// Running action uses a different endpoint for cancelling
 				Running: data.queue_running.map((prompt) => ({
 					prompt,
-					remove: { name: "Cancel", cb: () => api.interrupt() },
+					remove: { name: "Cancel", cb: () => api.interrupt(prompt[1]) },
 				})),
 				Pending: data.queue_pending.map((prompt) => ({ prompt })),
 			};
@@ -311,9 +329,10 @@ class ComfyApi extends EventTarget {
 
 	/**
 	 * Interrupts the execution of the running prompt
+	 * @param {string} promptId The prompt to interrupt, the prompts running on every worker if it's not set
 	 */
-	async interrupt() {
-		await this.#postItem("interrupt", null);
+	async interrupt(promptId) {
+		await this.#postItem("interrupt", promptId ? { prompt_id: promptId } : null);
 	}
 }
 